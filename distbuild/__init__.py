@@ -28,7 +28,8 @@ from mainloop import MainLoop
 from sockserv import ListenServer
 from jm import JsonMachine, JsonNewMessage, JsonEof
 
-from serialise import serialise_artifact, deserialise_artifact
+from serialise import (serialise_artifact, deserialise_artifact,
+                       ArtifactGraphDecoder)
 from idgen import IdentifierGenerator
 from route_map import RouteMap
 from timer_event_source import TimerEventSource, Timer
@@ -55,7 +56,8 @@ from build_controller import (BuildController, BuildFailed, BuildProgress,
                               BuildStepAlreadyStarted, BuildOutput,
                               BuildStepFinished, BuildStepFailed,
                               BuildFinished, BuildCancel,
-                              build_step_name, map_build_graph)
+                              build_step_name, map_build_graph,
+                              critical_path_priorities)
 from initiator import Initiator
 from protocol import message
 
@@ -16,8 +16,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import collections
+import heapq
+import itertools
 import logging
 import httplib
+import time
 import traceback
 import urllib
 import urlparse
@@ -54,6 +58,12 @@ class _GraphFailed(object):
     pass
 
 
+class _BuiltElsewhere(object):
+
+    def __init__(self, basenames):
+        self.basenames = basenames
+
+
 class BuildCancel(object):
 
     def __init__(self, id):
@@ -147,6 +157,109 @@ def map_build_graph(artifact, callback):
     return result
 
 
+def critical_path_priorities(artifact, cost):
+    '''Return the priority of building each artifact in a build graph.
+
+    The priority of an artifact is the longest time it can take from
+    starting to build it to finishing the build of ``artifact``: its own
+    ``cost(artifact)`` plus the highest priority of the artifacts that
+    depend on it. Building the artifacts with the highest priority first
+    starts the longest chains of builds as early as possible.
+
+    '''
+
+    artifacts = map_build_graph(artifact, lambda a: a)
+    dependencies = dict((a, set(a.source.dependencies)) for a in artifacts)
+
+    # Visit each artifact after everything that depends on it.
+    dependents_left = dict((a, 0) for a in artifacts)
+    for deps in dependencies.itervalues():
+        for dep in deps:
+            dependents_left[dep] += 1
+
+    downstream = dict((a, 0) for a in artifacts)
+    priorities = {}
+    queue = [artifact]
+    while queue:
+        a = queue.pop()
+        priorities[a] = downstream[a] + cost(a)
+        for dep in dependencies[a]:
+            downstream[dep] = max(downstream[dep], priorities[a])
+            dependents_left[dep] -= 1
+            if dependents_left[dep] == 0:
+                queue.append(dep)
+    return priorities
+
+
+class SharedBuildGraph(object):
+
+    '''What the running builds know about the artifacts they want.
+
+    Builds of several systems from the same definitions share most of
+    their artifacts. Every BuildController adds the artifacts of its build
+    graph here, by basename, which includes the cache key. This means
+    what one build learns about an artifact is known to the others:
+
+    * whether it is in the artifact cache, so that each artifact is only
+      asked about by the first build that wants it
+    * when it has been built, so that the other builds that want it can
+      carry on with what depends on it
+
+    An artifact is forgotten when no running build wants it any more.
+
+    '''
+
+    def __init__(self):
+        self._wanted_by = {}
+        self._in_cache = {}
+
+    def add(self, controller, basenames):
+        for basename in basenames:
+            self._wanted_by.setdefault(basename, set()).add(controller)
+
+    def remove(self, controller, basenames):
+        for basename in basenames:
+            wanted_by = self._wanted_by.get(basename, set())
+            wanted_by.discard(controller)
+            if not wanted_by:
+                self._wanted_by.pop(basename, None)
+                self._in_cache.pop(basename, None)
+
+    def get_cache_state(self, basenames):
+        '''Return a dict of whether each known artifact is in the cache.'''
+
+        return dict((b, self._in_cache[b])
+                    for b in basenames if b in self._in_cache)
+
+    def set_cache_state(self, cache_state):
+        '''Record the answer of the artifact cache about some artifacts.
+
+        An artifact that is already known to have been built stays built,
+        since it may have been built while the artifact cache was asked.
+
+        '''
+
+        for basename, is_in_cache in cache_state.iteritems():
+            if (basename in self._wanted_by and
+                    not self._in_cache.get(basename)):
+                self._in_cache[basename] = is_in_cache
+
+    def set_built(self, controller, basenames):
+        '''Record that artifacts have been built.
+
+        Return the other builds that want any of the artifacts.
+
+        '''
+
+        others = set()
+        for basename in basenames:
+            if basename in self._wanted_by:
+                self._in_cache[basename] = True
+                others.update(self._wanted_by[basename])
+        others.discard(controller)
+        return others
+
+
 class BuildController(distbuild.StateMachine):
 
     '''Control one build-request fulfillment.
@@ -160,6 +273,13 @@ class BuildController(distbuild.StateMachine):
     '''
     
     _idgen = distbuild.IdentifierGenerator('BuildController')
+
+    # How long the last build of each source took, in seconds, by source
+    # name. This is shared by every build, so that the builds after the
+    # first can be scheduled critical path first.
+    _build_times = {}
+
+    _shared_graph = SharedBuildGraph()
     
     def __init__(self, initiator_connection, build_request_message,
                  artifact_cache_server, morph_instance):
@@ -170,6 +290,25 @@ class BuildController(distbuild.StateMachine):
         self._artifact_cache_server = artifact_cache_server
         self._morph_instance = morph_instance
         self._helper_id = None
+        self._priorities = {}
+        self._step_start_times = {}
+
+        # Indexes of the build graph, so that nothing needs to walk the
+        # whole graph once building has started.
+        self._by_basename = {}
+        self._by_cache_key = {}
+        self._by_source = {}
+        self._dependents = {}
+        self._unmet_dependencies = {}
+        # A heap of (-priority, sequence number, artifact) for every
+        # artifact whose dependencies are all built. Artifacts that have
+        # started building since they were added are skipped.
+        self._ready = []
+        self._sequence = itertools.count()
+        # Artifacts that other builds built before the artifact cache
+        # answered, and whether its answer has been applied yet.
+        self._built_elsewhere = set()
+        self._cache_state_applied = False
         self.debug_transitions = False
         self.debug_graph_state = False
 
@@ -202,8 +341,11 @@ class BuildController(distbuild.StateMachine):
                 self._notify_annotation_failed),
             ('annotating', self, _Annotated, 'building', 
                 self._queue_worker_builds),
+            ('annotating', self, _BuiltElsewhere, 'annotating',
+                self._note_built_elsewhere),
             ('annotating', self._initiator_connection,
-                distbuild.InitiatorDisconnect, None, None),
+                distbuild.InitiatorDisconnect, None,
+                self._release_build_graph),
 
             # The exact WorkerConnection that is doing our building changes
             # from build to build. We must listen to all messages from all
@@ -234,7 +376,9 @@ class BuildController(distbuild.StateMachine):
             ('building', distbuild.WorkerConnection,
                 distbuild.WorkerBuildFailed, 'building',
                 self._maybe_notify_build_failed),
-            ('building', self, _Abort, None, None),
+            ('building', self, _BuiltElsewhere, 'building',
+                self._carry_on_after_built_elsewhere),
+            ('building', self, _Abort, None, self._release_build_graph),
             ('building', self, _Built, None, self._notify_build_done),
             ('building', distbuild.InitiatorConnection,
                 distbuild.InitiatorDisconnect, 'building',
@@ -248,7 +392,8 @@ class BuildController(distbuild.StateMachine):
         distbuild.crash_point()
 
         logging.info('Start constructing build graph')
-        self._artifact_data = distbuild.StringBuffer()
+        # The graph is decoded as it arrives, rather than all at the end.
+        self._graph_decoder = distbuild.ArtifactGraphDecoder()
         self._artifact_error = distbuild.StringBuffer()
         argv = [
             self._morph_instance,
@@ -275,7 +420,7 @@ class BuildController(distbuild.StateMachine):
         distbuild.crash_point()
 
         if event.msg['id'] == self._helper_id:
-            self._artifact_data.add(event.msg['stdout'])
+            self._graph_decoder.feed(event.msg['stdout'])
             self._artifact_error.add(event.msg['stderr'])
 
     def _maybe_finish_graph(self, event_source, event):
@@ -314,9 +459,8 @@ class BuildController(distbuild.StateMachine):
             if event.msg['exit'] != 0:
                 return
             
-            text = self._artifact_data.peek()
             try:
-                artifact = distbuild.deserialise_artifact(text)
+                artifact = self._graph_decoder.finish()
             except ValueError, e:
                 logging.error(traceback.format_exc())
                 notify_failure(str(e))
@@ -329,13 +473,23 @@ class BuildController(distbuild.StateMachine):
 
         self._artifact = event.artifact
         self._helper_id = self._idgen.next()
-        artifact_names = []
 
-        def set_state_and_append(artifact):
+        def set_state(artifact):
             artifact.state = UNKNOWN
-            artifact_names.append(artifact.basename())
 
-        map_build_graph(self._artifact, set_state_and_append)
+        map_build_graph(self._artifact, set_state)
+        self._index_build_graph()
+        self._shared_graph.add(self, self._by_basename)
+
+        # Only ask about the artifacts that no other build has asked about.
+        known = self._shared_graph.get_cache_state(self._by_basename)
+        artifact_names = [name for name in self._by_basename
+                          if name not in known]
+        if not artifact_names:
+            logging.debug('State of all artifacts is already known')
+            self._helper_id = None
+            self._set_cache_state({})
+            return
 
         url = urlparse.urljoin(self._artifact_cache_server, '/1.0/artifacts')
         msg = distbuild.message('http-request',
@@ -351,11 +505,6 @@ class BuildController(distbuild.StateMachine):
             '(helper id: %s)' % self._helper_id)
 
     def _maybe_handle_cache_response(self, event_source, event):
-
-        def set_status(artifact):
-            is_in_cache = cache_state[artifact.basename()]
-            artifact.state = BUILT if is_in_cache else UNBUILT
-
         if self._helper_id != event.msg['id']:
             return    # this event is not for us
 
@@ -371,12 +520,24 @@ class BuildController(distbuild.StateMachine):
                 _AnnotationFailed(http_status_code, error_msg))
             return
 
-        cache_state = json.loads(event.msg['body'])
-        map_build_graph(self._artifact, set_status)
+        self._set_cache_state(json.loads(event.msg['body']))
+
+    def _set_cache_state(self, cache_state):
+        self._shared_graph.set_cache_state(cache_state)
+        cache_state = self._shared_graph.get_cache_state(self._by_basename)
+        for basename, artifact in self._by_basename.iteritems():
+            if cache_state.get(basename) or basename in self._built_elsewhere:
+                artifact.state = BUILT
+            else:
+                artifact.state = UNBUILT
+
+        self._priorities = critical_path_priorities(
+            self._artifact, self._estimate_build_time)
+        self._find_ready_artifacts()
+        self._cache_state_applied = True
         self.mainloop.queue_event(self, _Annotated())
 
-        count = sum(map_build_graph(self._artifact,
-                    lambda a: 1 if a.state == UNBUILT else 0))
+        count = len([a for a in self._dependents if a.state == UNBUILT])
 
         progress = BuildProgress(
             self._request['id'],
@@ -387,15 +548,87 @@ class BuildController(distbuild.StateMachine):
             logging.info('There seems to be nothing to build')
             self.mainloop.queue_event(self, _Built())
 
-    def _find_artifacts_that_are_ready_to_build(self):
-        def is_ready_to_build(artifact):
-            return (artifact.state == UNBUILT and
-                    all(a.state == BUILT
-                        for a in artifact.source.dependencies))
-
-        return [a 
-                for a in map_build_graph(self._artifact, lambda a: a)
-                if is_ready_to_build(a)]
+    def _estimate_build_time(self, artifact):
+        if artifact.state != UNBUILT:
+            return 0
+        times = self._build_times
+        if artifact.source.name in times:
+            return times[artifact.source.name]
+        # Nothing is known about this source, so guess it takes as long
+        # as an average build. Until anything is known, this makes the
+        # priority of an artifact the number of builds after it.
+        return sum(times.itervalues()) / len(times) if times else 1.0
+
+    def _index_build_graph(self):
+        self._by_basename = {}
+        self._by_cache_key = collections.defaultdict(list)
+        self._by_source = collections.defaultdict(list)
+        self._dependents = {}
+        for artifact in map_build_graph(self._artifact, lambda a: a):
+            self._by_basename[artifact.basename()] = artifact
+            self._by_cache_key[artifact.source.cache_key].append(artifact)
+            self._by_source[artifact.source].append(artifact)
+            self._dependents.setdefault(artifact, [])
+            for dep in set(artifact.source.dependencies):
+                self._dependents.setdefault(dep, []).append(artifact)
+
+    def _release_build_graph(self, event_source=None, event=None):
+        self._shared_graph.remove(self, self._by_basename)
+
+    def _note_built_elsewhere(self, event_source, event):
+        '''Record that another build built artifacts we want.
+
+        Until the answer of the artifact cache has been applied, the
+        artifacts have no state to change, so they are remembered and
+        marked as built along with the answer. Building starts once the
+        answer has been applied, so there is nothing more to do here.
+
+        '''
+
+        if self._cache_state_applied:
+            self._set_built_elsewhere(event.basenames)
+        else:
+            self._built_elsewhere.update(event.basenames)
+
+    def _carry_on_after_built_elsewhere(self, event_source, event):
+        '''Carry on after another build built artifacts we want.'''
+
+        self._set_built_elsewhere(event.basenames)
+        self._queue_worker_builds(None, None)
+
+    def _set_built_elsewhere(self, basenames):
+        for basename in basenames:
+            artifact = self._by_basename.get(basename)
+            if artifact is not None:
+                self._set_built(artifact)
+
+    def _find_ready_artifacts(self):
+        self._unmet_dependencies = {}
+        self._ready = []
+        for artifact in self._dependents:
+            self._unmet_dependencies[artifact] = len(
+                [a for a in set(artifact.source.dependencies)
+                 if a.state != BUILT])
+            if (artifact.state == UNBUILT and
+                    self._unmet_dependencies[artifact] == 0):
+                self._add_ready(artifact)
+
+    def _add_ready(self, artifact):
+        heapq.heappush(self._ready,
+                       (-self._priorities.get(artifact, 0),
+                        next(self._sequence), artifact))
+
+    def _set_built(self, artifact):
+        '''Mark an artifact as built, and find what can now be built.'''
+
+        if artifact.state == BUILT:
+            return
+        artifact.state = BUILT
+        for dependent in self._dependents[artifact]:
+            self._unmet_dependencies[dependent] -= 1
+            if (dependent.state == UNBUILT and
+                    self._unmet_dependencies[dependent] == 0):
+                self._add_ready(dependent)
 
     def _queue_worker_builds(self, event_source, event):
         distbuild.crash_point()
@@ -416,20 +649,19 @@ class BuildController(distbuild.StateMachine):
                             '    depends on %s which is %s' %
                                 (dep.name, dep.state))
 
-        while True:
-            ready = self._find_artifacts_that_are_ready_to_build()
-
-            if len(ready) == 0:
-                logging.debug('No new artifacts queued for building')
-                break
+        while self._ready:
+            _, _, artifact = heapq.heappop(self._ready)
+            if artifact.state != UNBUILT:
+                continue
 
-            artifact = ready[0]
+            priority = self._priorities.get(artifact, 0)
 
             logging.debug(
-                'Requesting worker-build of %s (%s)' %
-                    (artifact.name, artifact.source.cache_key))
+                'Requesting worker-build of %s (%s) with priority %.1f' %
+                    (artifact.name, artifact.source.cache_key, priority))
             request = distbuild.WorkerBuildRequest(artifact,
-                                                   self._request['id'])
+                                                   self._request['id'],
+                                                   priority)
             self.mainloop.queue_event(distbuild.WorkerBuildQueuer, request)
 
             artifact.state = BUILDING
@@ -438,10 +670,11 @@ class BuildController(distbuild.StateMachine):
                 # so when we're building any chunk artifact
                 # we're also building all the chunk artifacts
                 # in this source
-                for a in ready:
-                    if a.source == artifact.source:
+                for a in self._by_source[artifact.source]:
+                    if a.state == UNBUILT:
                         a.state = BUILDING
 
+        logging.debug('No new artifacts queued for building')
 
     def _maybe_notify_initiator_disconnected(self, event_source, event):
         if event.id != self._request['id']:
@@ -490,6 +723,7 @@ class BuildController(distbuild.StateMachine):
             return
 
         logging.debug('BC: got build step started: %s' % artifact.name)
+        self._step_start_times[artifact.source.cache_key] = time.time()
         started = BuildStepStarted(
             self._request['id'], build_step_name(artifact), event.worker_name)
         self.mainloop.queue_event(BuildController, started)
@@ -542,8 +776,7 @@ class BuildController(distbuild.StateMachine):
         self.mainloop.queue_event(BuildController, progress)
 
     def _find_artifact(self, cache_key):
-        artifacts = map_build_graph(self._artifact, lambda a: a)
-        wanted = [a for a in artifacts if a.source.cache_key == cache_key]
+        wanted = self._by_cache_key.get(cache_key)
         if wanted:
             return wanted[0]
         else:
@@ -566,18 +799,24 @@ class BuildController(distbuild.StateMachine):
             self._request['id'], build_step_name(artifact))
         self.mainloop.queue_event(BuildController, finished)
 
-        artifact.state = BUILT
-
-        def set_state(a):
-            if a.source == artifact.source:
-                a.state = BUILT
+        started = self._step_start_times.pop(artifact.source.cache_key, None)
+        if started is not None:
+            self._build_times[artifact.source.name] = time.time() - started
 
         if artifact.source.morphology['kind'] == 'chunk':
             # Building a single chunk artifact
             # yields all chunk artifacts for the given source
             # so we set the state of this source's artifacts
             # to BUILT
-            map_build_graph(self._artifact, set_state)
+            built = self._by_source[artifact.source]
+        else:
+            built = [artifact]
+        for a in built:
+            self._set_built(a)
+
+        basenames = [a.basename() for a in built]
+        for other in self._shared_graph.set_built(self, basenames):
+            self.mainloop.queue_event(other, _BuiltElsewhere(basenames))
 
         self._queue_worker_builds(None, event)
 
@@ -588,6 +827,7 @@ class BuildController(distbuild.StateMachine):
         logging.error(errmsg)
         failed = BuildFailed(self._request['id'], errmsg)
         self.mainloop.queue_event(BuildController, failed)
+        self._release_build_graph()
 
     def _maybe_notify_build_failed(self, event_source, event):
         distbuild.crash_point()
@@ -637,6 +877,7 @@ class BuildController(distbuild.StateMachine):
         distbuild.crash_point()
 
         logging.debug('Notifying initiator of successful build')
+        self._release_build_graph()
         baseurl = urlparse.urljoin(
             self._artifact_cache_server, '/1.0/artifacts')
         filename = ('%s.%s.%s' % 
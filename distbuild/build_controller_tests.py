@@ -0,0 +1,264 @@
+# distbuild/build_controller_tests.py -- unit tests for build controller
+#
+# Copyright (C) 2015  Codethink Limited
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import unittest
+
+import distbuild
+
+
+class FakeSource(object):
+
+    def __init__(self, name, dependencies):
+        self.name = name
+        self.cache_key = name + '-key'
+        self.morphology = {'kind': 'stratum'}
+        self.dependencies = dependencies
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name, *dependencies):
+        self.name = name
+        self.source = FakeSource(name, list(dependencies))
+
+    def basename(self):
+        return '%s.stratum.%s' % (self.source.cache_key, self.name)
+
+    def __repr__(self):
+        return 'FakeArtifact(%s)' % self.name
+
+
+class CriticalPathPrioritiesTests(unittest.TestCase):
+
+    def test_gives_longest_time_to_end_of_build(self):
+        # gcc and glibc are a long chain, tar is a quick leaf.
+        gcc = FakeArtifact('gcc')
+        glibc = FakeArtifact('glibc', gcc)
+        tar = FakeArtifact('tar')
+        stratum = FakeArtifact('stratum', glibc, tar)
+        system = FakeArtifact('system', stratum, gcc)
+        costs = {'gcc': 50, 'glibc': 30, 'tar': 5, 'stratum': 1, 'system': 10}
+
+        priorities = distbuild.critical_path_priorities(
+            system, lambda a: costs[a.name])
+
+        self.assertEqual(priorities, {
+            system: 10,
+            stratum: 11,
+            glibc: 41,
+            tar: 16,
+            gcc: 91,
+        })
+
+    def test_handles_long_chains(self):
+        artifact = FakeArtifact('0')
+        for i in xrange(1, 5000):
+            artifact = FakeArtifact(str(i), artifact)
+
+        priorities = distbuild.critical_path_priorities(
+            artifact, lambda a: 1)
+
+        self.assertEqual(max(priorities.itervalues()), 5000)
+
+
+class FakeMainLoop(object):
+
+    def __init__(self):
+        self.events = []
+        self.queued = []
+
+    def queue_event(self, event_source, event):
+        self.events.append(event)
+        self.queued.append((event_source, event))
+
+
+class SharedBuildGraphTests(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = distbuild.build_controller.SharedBuildGraph()
+
+    def test_knows_cache_state_of_wanted_artifacts(self):
+        self.graph.add('one', ['a', 'b'])
+        self.graph.set_cache_state({'a': True, 'b': False, 'c': True})
+        self.assertEqual(self.graph.get_cache_state(['a', 'b', 'c']),
+                         {'a': True, 'b': False})
+
+    def test_keeps_built_artifacts_built(self):
+        self.graph.add('one', ['a'])
+        self.graph.set_built('one', ['a'])
+        self.graph.set_cache_state({'a': False})
+        self.assertEqual(self.graph.get_cache_state(['a']), {'a': True})
+
+    def test_tells_who_else_wants_built_artifacts(self):
+        self.graph.add('one', ['a', 'b'])
+        self.graph.add('two', ['a'])
+        self.graph.add('three', ['b'])
+        self.assertEqual(self.graph.set_built('one', ['a']), set(['two']))
+
+    def test_forgets_artifacts_nobody_wants(self):
+        self.graph.add('one', ['a'])
+        self.graph.add('two', ['a'])
+        self.graph.set_cache_state({'a': True})
+        self.graph.remove('one', ['a'])
+        self.assertEqual(self.graph.get_cache_state(['a']), {'a': True})
+        self.graph.remove('two', ['a'])
+        self.assertEqual(self.graph.get_cache_state(['a']), {})
+
+
+class BuildControllerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FakeArtifact('a')
+        self.b = FakeArtifact('b', self.a)
+        self.c = FakeArtifact('c')
+        self.d = FakeArtifact('d', self.b, self.c)
+        self.shared_graph = distbuild.build_controller.SharedBuildGraph()
+        self.controller = self.new_controller(self.d)
+
+    def new_controller(self, artifact):
+        controller = distbuild.BuildController(
+            None, {'id': 'request'}, 'http://cache/', 'morph')
+        controller._shared_graph = self.shared_graph
+        controller.mainloop = FakeMainLoop()
+        controller._artifact = artifact
+        controller._index_build_graph()
+        return controller
+
+    def start(self, built=()):
+        for artifact in (self.a, self.b, self.c, self.d):
+            artifact.state = distbuild.build_controller.UNBUILT
+        for artifact in built:
+            artifact.state = distbuild.build_controller.BUILT
+        self.controller._priorities = distbuild.critical_path_priorities(
+            self.d, lambda a: 1)
+        self.controller._find_ready_artifacts()
+        self.controller._queue_worker_builds(None, None)
+
+    def requested(self):
+        names = [e.artifact.name for e in self.controller.mainloop.events
+                 if isinstance(e, distbuild.WorkerBuildRequest)]
+        self.controller.mainloop.events = []
+        return names
+
+    def finish(self, artifact):
+        self.controller._set_built(artifact)
+        self.controller._queue_worker_builds(None, None)
+
+    def test_requests_ready_artifacts_longest_chain_first(self):
+        self.start()
+        self.assertEqual(self.requested(), ['a', 'c'])
+
+    def test_requests_artifacts_once_dependencies_are_built(self):
+        self.start()
+        self.requested()
+        self.finish(self.c)
+        self.assertEqual(self.requested(), [])
+        self.finish(self.a)
+        self.assertEqual(self.requested(), ['b'])
+        self.finish(self.b)
+        self.assertEqual(self.requested(), ['d'])
+
+    def test_does_not_request_artifacts_that_are_built(self):
+        self.start(built=[self.a, self.c])
+        self.assertEqual(self.requested(), ['b'])
+
+    def test_finds_artifact_by_cache_key(self):
+        self.assertEqual(self.controller._find_artifact('b-key'), self.b)
+        self.assertEqual(self.controller._find_artifact('x-key'), None)
+
+    def test_only_asks_cache_about_artifacts_it_does_not_know(self):
+        self.controller.mainloop = FakeMainLoop()
+        self.controller._start_annotating(None, distbuild.build_controller.
+                                          _GotGraph(self.d))
+        self.controller._set_cache_state(
+            {self.a.basename(): True, self.b.basename(): False,
+             self.c.basename(): True, self.d.basename(): False})
+
+        e = FakeArtifact('e', self.b)
+        other = self.new_controller(e)
+        other._start_annotating(None, distbuild.build_controller.
+                                _GotGraph(e))
+        requests = [ev for ev in other.mainloop.events
+                    if isinstance(ev, distbuild.HelperRequest)]
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(json.loads(requests[0].msg['body']),
+                         [e.basename()])
+
+    def start_other(self):
+        # Each build has its own copy of the graph.
+        e = FakeArtifact('e', FakeArtifact('b', FakeArtifact('a')))
+        other = self.new_controller(e)
+        for controller in (self.controller, other):
+            self.shared_graph.add(controller, controller._by_basename)
+        self.start(built=[self.a])
+        self.requested()
+        return other, e
+
+    def finish_b_elsewhere(self, other):
+        event = distbuild.WorkerBuildFinished(
+            {'ids': ['request']}, self.b.source.cache_key)
+        self.controller._maybe_check_result_and_queue_more_builds(None, event)
+        notices = [ev for source, ev in self.controller.mainloop.queued
+                   if source is other and
+                      isinstance(ev, distbuild.build_controller.
+                                 _BuiltElsewhere)]
+        self.assertEqual(len(notices), 1)
+        return notices[0]
+
+    def worker_builds_requested(self, controller):
+        names = [ev.artifact.name for ev in controller.mainloop.events
+                 if isinstance(ev, distbuild.WorkerBuildRequest)]
+        controller.mainloop.events = []
+        return names
+
+    def test_carries_on_when_another_build_builds_an_artifact(self):
+        other, e = self.start_other()
+        other._set_cache_state(
+            {self.a.basename(): True, self.b.basename(): False,
+             e.basename(): False})
+        other._queue_worker_builds(None, None)
+        self.assertEqual(self.worker_builds_requested(other), ['b'])
+
+        notice = self.finish_b_elsewhere(other)
+        other._carry_on_after_built_elsewhere(self.controller, notice)
+        self.assertEqual(self.worker_builds_requested(other), ['e'])
+
+    def test_uses_artifact_built_elsewhere_after_cache_answered(self):
+        other, e = self.start_other()
+        other._set_cache_state(
+            {self.a.basename(): True, self.b.basename(): False,
+             e.basename(): False})
+
+        # Still annotating, until _Annotated is handled.
+        notice = self.finish_b_elsewhere(other)
+        other._note_built_elsewhere(self.controller, notice)
+        other._queue_worker_builds(None, None)
+        self.assertEqual(self.worker_builds_requested(other), ['e'])
+
+    def test_uses_artifact_built_elsewhere_before_cache_answered(self):
+        other, e = self.start_other()
+        notice = self.finish_b_elsewhere(other)
+        other._note_built_elsewhere(self.controller, notice)
+
+        # The answer was made before the artifact was built.
+        other._set_cache_state(
+            {self.a.basename(): True, self.b.basename(): False,
+             e.basename(): False})
+        other._queue_worker_builds(None, None)
+        self.assertEqual(self.worker_builds_requested(other), ['e'])
@@ -24,9 +24,25 @@ class EventSource(object):
     
     An event source watches one file descriptor, and returns events
     related to it. The events may vary depending on the file descriptor.
-    The actual watching is done using select.select.
+    The actual watching is done by the main loop's poller.
+
+    An event source that sets ``notifies_interest_changes`` calls
+    ``interest_changed`` whenever what ``get_select_params`` returns
+    changes, and when it becomes finished. The main loop then does not
+    need to ask it again every time it wakes up.
     
     '''
+
+    notifies_interest_changes = False
+    _interest_callback = None
+
+    def set_interest_callback(self, callback):
+        '''Set the function to call when the select parameters change.'''
+        self._interest_callback = callback
+
+    def interest_changed(self):
+        if self._interest_callback is not None:
+            self._interest_callback(self)
     
     def get_select_params(self):
         '''Return parameters to use for select for this event source.
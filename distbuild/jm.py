@@ -21,6 +21,7 @@ import json
 import logging
 import os
 import socket
+import struct
 import sys
 import yaml
 
@@ -46,6 +47,81 @@ class _Close2(object):
     pass
 
 
+# Messages are sent in one of two formats:
+#
+# 1. A line of JSON, containing a string of YAML, containing the message.
+#    This is slow to produce and parse, but is all that older versions
+#    understand.
+#
+# 2. A frame of one byte with the format version, the length of the
+#    payload as a 4 byte big-endian integer, and the payload, which is
+#    the message as compact JSON (see _to_wire).
+#
+# A line in format 1 never starts with the version byte of format 2.
+# Every line in format 1 starts with _ADVERTISE_FORMAT_2, which parsers
+# of format 1 ignore as JSON whitespace, to show that format 2 is
+# understood. Once the other side is known to understand it, messages
+# are sent in format 2.
+#
+# The JSON of every message, in either format, also starts with
+# _ADVERTISE_GRAPH_2, which is JSON whitespace too, to show that this
+# version of Morph reads build graphs in version 2 of the format of
+# distbuild.serialise. Older versions only read version 1.
+
+_FORMAT_2 = '\x02'
+_ADVERTISE_FORMAT_2 = '\t'
+_ADVERTISE_GRAPH_2 = ' '
+_FRAME_HEADER = struct.Struct('!cI')
+
+
+def _to_wire(obj):
+    '''Prepare a message for JSON so that its strings keep their bytes.
+
+    Strings in messages are byte strings, which may hold build output
+    that is not valid UTF-8. Each byte is sent as the Unicode character
+    of the same value. Unicode strings are sent as their UTF-8 encoding.
+
+    '''
+
+    if isinstance(obj, str):
+        return obj.decode('latin-1')
+    elif isinstance(obj, unicode):
+        return obj.encode('utf-8').decode('latin-1')
+    elif isinstance(obj, dict):
+        return dict((_to_wire(k), _to_wire(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        return [_to_wire(x) for x in obj]
+    else:
+        return obj
+
+
+def _from_wire(obj):
+    '''Reverse _to_wire, giving byte strings.'''
+
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    elif isinstance(obj, dict):
+        return dict((_from_wire(k), _from_wire(v))
+                    for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [_from_wire(x) for x in obj]
+    else:
+        return obj
+
+
+def encode_frame(msg):
+    '''Return a message in format 2.'''
+    payload = _ADVERTISE_GRAPH_2 + json.dumps(_to_wire(msg),
+                                              separators=(',', ':'))
+    return _FRAME_HEADER.pack(_FORMAT_2, len(payload)) + payload
+
+
+def encode_line(msg):
+    '''Return a message in format 1.'''
+    return '%s%s%s\n' % (_ADVERTISE_FORMAT_2, _ADVERTISE_GRAPH_2,
+                         json.dumps(yaml.safe_dump(msg)))
+
+
 class JsonMachine(StateMachine):
 
     '''A state machine for sending/receiving JSON messages across TCP.'''
@@ -56,6 +132,8 @@ class JsonMachine(StateMachine):
         StateMachine.__init__(self, 'rw')
         self.conn = conn
         self.debug_json = False
+        self.peer_understands_frames = False
+        self.peer_understands_graph_2 = False
 
     def __repr__(self):
         return '<JsonMachine at 0x%x: socket %s, max_buffer %s>' % \
@@ -82,10 +160,13 @@ class JsonMachine(StateMachine):
         '''Send a message to the other side.'''
         if self.debug_json:
             logging.debug('JsonMachine: Sending message %s' % repr(msg))
-        s = json.dumps(yaml.safe_dump(msg))
+        if self.peer_understands_frames:
+            s = encode_frame(msg)
+        else:
+            s = encode_line(msg)
         if self.debug_json:
             logging.debug('JsonMachine: As %s' % repr(s))
-        self.sockbuf.write('%s\n' % s)
+        self.sockbuf.write(s)
     
     def close(self):
         '''Tell state machine it should shut down.
@@ -103,15 +184,44 @@ class JsonMachine(StateMachine):
         if self.debug_json:
             logging.debug('JsonMachine: Received: %s' % repr(data))
         while True:
-            line = self.receive_buf.readline()
-            if line is None:
+            if self.receive_buf.read(1) == _FORMAT_2:
+                msg = self._read_frame()
+            else:
+                msg = self._read_line()
+            if msg is None:
                 break
-            line = line.rstrip()
-            if self.debug_json:
-                logging.debug('JsonMachine: line: %s' % repr(line))
-            msg = yaml.load(json.loads(line))
             self.mainloop.queue_event(self, JsonNewMessage(msg))
 
+    def _read_frame(self):
+        header = self.receive_buf.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            return None
+        version, length = _FRAME_HEADER.unpack(header)
+        if len(self.receive_buf) < _FRAME_HEADER.size + length:
+            return None
+        frame = self.receive_buf.read(_FRAME_HEADER.size + length)
+        self.receive_buf.remove(_FRAME_HEADER.size + length)
+        payload = frame[_FRAME_HEADER.size:]
+        if self.debug_json:
+            logging.debug('JsonMachine: frame: %s' % repr(payload))
+        self.peer_understands_frames = True
+        if payload.startswith(_ADVERTISE_GRAPH_2):
+            self.peer_understands_graph_2 = True
+        return _from_wire(json.loads(payload))
+
+    def _read_line(self):
+        line = self.receive_buf.readline()
+        if line is None:
+            return None
+        if line.startswith(_ADVERTISE_FORMAT_2):
+            self.peer_understands_frames = True
+            if line[len(_ADVERTISE_FORMAT_2):].startswith(_ADVERTISE_GRAPH_2):
+                self.peer_understands_graph_2 = True
+        line = line.strip()
+        if self.debug_json:
+            logging.debug('JsonMachine: line: %s' % repr(line))
+        return yaml.load(json.loads(line))
+
     def _send_eof(self, event_source, event):
         self.mainloop.queue_event(self, JsonEof())
 
@@ -0,0 +1,127 @@
+# distbuild/jm_tests.py -- unit tests for JSON message framing
+#
+# Copyright (C) 2015  Codethink Limited
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import unittest
+
+import yaml
+
+import distbuild
+from distbuild import jm
+
+
+class FakeMainLoop(object):
+
+    def __init__(self):
+        self.events = []
+
+    def queue_event(self, event_source, event):
+        self.events.append(event)
+
+
+class FakeSocketBuffer(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class FakeNewData(object):
+
+    def __init__(self, data):
+        self.data = data
+
+
+class JsonMachineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.jm = distbuild.JsonMachine(None)
+        self.jm.mainloop = FakeMainLoop()
+        self.jm.sockbuf = FakeSocketBuffer()
+        self.jm.receive_buf = distbuild.StringBuffer()
+        self.msg = {
+            'type': 'step-output',
+            'id': 1,
+            'ids': [1, 2],
+            'stdout': 'caf\xc3\xa9 and \xff invalid',
+            'stderr': '',
+            'unicode': u'caf\xe9',
+        }
+
+    def receive(self, *pieces):
+        for piece in pieces:
+            self.jm._parse(None, FakeNewData(piece))
+        received = [e.msg for e in self.jm.mainloop.events]
+        self.jm.mainloop.events = []
+        return received
+
+    def test_frames_keep_bytes_of_strings(self):
+        msg = jm._from_wire(json.loads(json.dumps(jm._to_wire(self.msg))))
+        self.assertEqual(msg['stdout'], self.msg['stdout'])
+        self.assertEqual(msg['unicode'], 'caf\xc3\xa9')
+        self.assertEqual(msg['ids'], [1, 2])
+
+    def test_sends_lines_that_old_versions_understand(self):
+        self.jm.send({'type': 'exec-cancel', 'id': 1})
+        line = self.jm.sockbuf.written[0]
+        self.assertTrue(line.endswith('\n'))
+        self.assertEqual(yaml.load(json.loads(line.rstrip())),
+                         {'type': 'exec-cancel', 'id': 1})
+
+    def test_receives_lines_from_old_versions(self):
+        line = '%s\n' % json.dumps(yaml.safe_dump({'type': 'foo'}))
+        self.assertEqual(self.receive(line[:5], line[5:] + line),
+                         [{'type': 'foo'}, {'type': 'foo'}])
+        self.assertFalse(self.jm.peer_understands_frames)
+
+    def test_sends_frames_once_peer_understands_them(self):
+        self.assertEqual(self.receive(jm.encode_line({'type': 'foo'})),
+                         [{'type': 'foo'}])
+        self.assertTrue(self.jm.peer_understands_frames)
+        self.jm.send(self.msg)
+        self.assertEqual(self.jm.sockbuf.written[0],
+                         jm.encode_frame(self.msg))
+
+    def test_receives_frames_in_pieces(self):
+        frame = jm.encode_frame(self.msg)
+        line = jm.encode_line({'type': 'foo'})
+        received = self.receive(frame[:3], frame[3:10],
+                                frame[10:] + line + frame)
+        self.assertEqual([m['type'] for m in received],
+                         ['step-output', 'foo', 'step-output'])
+        self.assertEqual(received[0]['stdout'], self.msg['stdout'])
+        self.assertEqual(len(self.jm.receive_buf), 0)
+
+    def test_knows_peer_reads_graph_2_from_lines(self):
+        self.receive(jm.encode_line({'type': 'foo'}))
+        self.assertTrue(self.jm.peer_understands_graph_2)
+
+    def test_knows_peer_reads_graph_2_from_frames(self):
+        self.receive(jm.encode_frame({'type': 'foo'}))
+        self.assertTrue(self.jm.peer_understands_graph_2)
+
+    def test_peers_without_graph_2_do_not_advertise_it(self):
+        old_line = '\t%s\n' % json.dumps(yaml.safe_dump({'type': 'foo'}))
+        payload = json.dumps({'type': 'foo'})
+        old_frame = jm._FRAME_HEADER.pack(jm._FORMAT_2, len(payload)) + payload
+        self.assertEqual(self.receive(old_line, old_frame),
+                         [{'type': 'foo'}, {'type': 'foo'}])
+        self.assertTrue(self.jm.peer_understands_frames)
+        self.assertFalse(self.jm.peer_understands_graph_2)
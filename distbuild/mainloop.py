@@ -16,15 +16,17 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import collections
 import fcntl
 import logging
 import os
-import select
+
+from poller import make_poller, READ, WRITE, EXCEPTION
 
 
 class MainLoop(object):
 
-    '''A select-based main loop.
+    '''A poll-based main loop.
     
     The main loop watches a set of file descriptors wrapped in 
     EventSource objects, and when something happens with them,
@@ -32,15 +34,36 @@ class MainLoop(object):
     feeds into user-supplied state machines. The state machines
     can create further events, which are processed further.
     
-    When nothing is happening, the main loop sleeps in the
-    select.select call.
+    When nothing is happening, the main loop sleeps in a poller, which
+    uses epoll where it is available (see ``distbuild.poller``).
+
+    Event sources that tell the main loop when the file descriptors
+    they watch change (see ``EventSource.set_interest_callback``) are
+    only asked for their select parameters then, and only asked for
+    events when one of their file descriptors is ready. Other event
+    sources are asked for both every time the main loop wakes up.
+
+    Each event is only given to the state machines that have a
+    transition for its event source and class, in any state, so the
+    cost of an event does not depend on how many machines are running.
+    State machines must add all their transitions in their ``setup``
+    method.
     
     '''
 
-    def __init__(self):
+    def __init__(self, poller=None):
         self._machines = []
-        self._sources = []
-        self._events = []
+        self._sources = collections.OrderedDict()
+        self._polled_sources = collections.OrderedDict()
+        self._poller = poller or make_poller()
+        # What each event source watches its file descriptors for, and
+        # the event sources watching each file descriptor.
+        self._source_masks = {}
+        self._fd_sources = {}
+        self._events = collections.deque()
+        # The machines interested in each (event source, event class),
+        # in the order they were added.
+        self._routes = collections.defaultdict(collections.OrderedDict)
         self.dump_filename = None
         
     def add_state_machine(self, machine):
@@ -48,6 +71,8 @@ class MainLoop(object):
         machine.mainloop = self
         machine.setup()
         self._machines.append(machine)
+        for key in machine.get_event_keys():
+            self._routes[key][machine] = None
         if self.dump_filename:
             filename = '%s%s.dot' % (self.dump_filename, 
                                      machine.__class__.__name__)
@@ -56,49 +81,112 @@ class MainLoop(object):
     def remove_state_machine(self, machine):
         logging.debug('MainLoop.remove_state_machine: %s' % machine)
         self._machines.remove(machine)
+        for key in machine.get_event_keys():
+            routes = self._routes.get(key)
+            if routes is not None:
+                routes.pop(machine, None)
+                if not routes:
+                    del self._routes[key]
     
     def add_event_source(self, event_source):
         logging.debug('MainLoop.add_event_source: %s' % event_source)
-        self._sources.append(event_source)
+        self._sources[event_source] = None
+        if getattr(event_source, 'notifies_interest_changes', False):
+            event_source.set_interest_callback(self._update_interest)
+            self._update_interest(event_source)
+        else:
+            self._polled_sources[event_source] = None
     
     def remove_event_source(self, event_source):
         logging.debug('MainLoop.remove_event_source: %s' % event_source)
-        self._sources.remove(event_source)
-    
-    def _setup_select(self):
-        r = []
-        w = []
-        x = []
-        timeout = None
+        del self._sources[event_source]
+        if event_source in self._polled_sources:
+            del self._polled_sources[event_source]
+        else:
+            event_source.set_interest_callback(None)
+        self._set_masks(event_source, {})
+
+    def _update_interest(self, event_source):
+        if event_source.is_finished():
+            self.remove_event_source(event_source)
+        else:
+            r, w, x, timeout = event_source.get_select_params()
+            self._set_masks(event_source, self._masks(r, w, x))
+
+    def _masks(self, r, w, x):
+        masks = collections.defaultdict(int)
+        for fds, bit in ((r, READ), (w, WRITE), (x, EXCEPTION)):
+            for fd in fds:
+                masks[fd] |= bit
+        return masks
+
+    def _set_masks(self, event_source, masks, reregister=False):
+        old = self._source_masks.pop(event_source, {})
+        if masks:
+            self._source_masks[event_source] = masks
+
+        for fd in set(old) | set(masks):
+            if old.get(fd) == masks.get(fd) and not reregister:
+                continue
+            sources = self._fd_sources.setdefault(fd, {})
+            if fd in masks:
+                sources[event_source] = masks[fd]
+            else:
+                sources.pop(event_source, None)
+            if not sources:
+                del self._fd_sources[fd]
 
-        self._sources = [s for s in self._sources if not s.is_finished()]
-        
-        for event_source in self._sources:
-            sr, sw, sx, st = event_source.get_select_params()
-            r.extend(sr)
-            w.extend(sw)
-            x.extend(sx)
+            if reregister:
+                self._poller.forget(fd)
+            mask = 0
+            for source_mask in sources.itervalues():
+                mask |= source_mask
+            self._poller.set_mask(fd, mask)
+
+    def _run_once(self):
+        timeout = None
+        for event_source in self._polled_sources.keys():
+            if event_source.is_finished():
+                self.remove_event_source(event_source)
+                continue
+            r, w, x, st = event_source.get_select_params()
+            # These may be watching a file descriptor that was closed and
+            # opened again without them knowing, so the poller must not
+            # rely on what it was told about the file descriptor before.
+            self._set_masks(event_source, self._masks(r, w, x),
+                            reregister=True)
             if timeout is None:
                 timeout = st
             elif st is not None:
                 timeout = min(timeout, st)
 
-        return r, w, x, timeout
+        assert self._fd_sources or timeout is not None
+        r, w, x = self._poller.poll(timeout)
 
-    def _run_once(self):
-        r, w, x, timeout = self._setup_select()
-        assert r or w or x or timeout is not None
-        r, w, x = select.select(r, w, x, timeout)
+        ready = collections.OrderedDict()
+        for fd in r | w | x:
+            for event_source in self._fd_sources.get(fd, ()):
+                ready[event_source] = None
+        for event_source in self._polled_sources:
+            ready[event_source] = None
 
-        for event_source in self._sources:
+        for event_source in ready:
+            if event_source not in self._sources:
+                continue
             if event_source.is_finished():
                 self.remove_event_source(event_source)
             else:
                 for event in event_source.get_events(r, w, x):
                     self.queue_event(event_source, event)
 
+        self._dispatch_events()
+
+    def _dispatch_events(self):
         for event_source, event in self._dequeue_events():
-            for machine in self._machines[:]:
+            routes = self._routes.get((event_source, event.__class__))
+            if not routes:
+                continue
+            for machine in routes.keys():
                 for new_event in machine.handle_event(event_source, event):
                     self.queue_event(event_source, new_event)
                 if machine.state is None:
@@ -124,6 +212,6 @@ class MainLoop(object):
 
     def _dequeue_events(self):
         while self._events:
-            event_source, event = self._events.pop(0)
+            event_source, event = self._events.popleft()
 
             yield event_source, event
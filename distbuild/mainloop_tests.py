@@ -0,0 +1,182 @@
+# distbuild/mainloop_tests.py -- unit tests for main loop
+#
+# Copyright (C) 2015  Codethink Limited
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import unittest
+
+import distbuild
+
+
+class Ping(object):
+
+    pass
+
+
+class Pong(object):
+
+    pass
+
+
+class Stop(object):
+
+    pass
+
+
+class RecordingMachine(distbuild.StateMachine):
+
+    def __init__(self, name, source, log):
+        distbuild.StateMachine.__init__(self, 'idle')
+        self.name = name
+        self.source = source
+        self.log = log
+
+    def setup(self):
+        self.add_transitions([
+            ('idle', self.source, Ping, 'idle', self._ping),
+            ('idle', self.source, Stop, None, None),
+        ])
+
+    def _ping(self, event_source, event):
+        self.log.append(self.name)
+        return [Pong()]
+
+    def handle_event(self, event_source, event):
+        self.log.append((self.name, event.__class__.__name__))
+        return distbuild.StateMachine.handle_event(self, event_source, event)
+
+
+class MainLoopTests(unittest.TestCase):
+
+    def setUp(self):
+        self.mainloop = distbuild.MainLoop()
+        self.log = []
+
+    def add_machine(self, name, source):
+        machine = RecordingMachine(name, source, self.log)
+        self.mainloop.add_state_machine(machine)
+        return machine
+
+    def test_gives_events_only_to_interested_machines(self):
+        self.add_machine('one', 'source1')
+        self.add_machine('two', 'source2')
+        self.mainloop.queue_event('source2', Ping())
+        self.mainloop._dispatch_events()
+        self.assertEqual(self.log, [('two', 'Ping'), 'two'])
+
+    def test_gives_events_to_machines_in_order_they_were_added(self):
+        self.add_machine('one', 'source')
+        self.add_machine('two', 'source')
+        self.mainloop.queue_event('source', Ping())
+        self.mainloop.queue_event('source', Ping())
+        self.mainloop._dispatch_events()
+        self.assertEqual([x for x in self.log if isinstance(x, str)],
+                         ['one', 'two', 'one', 'two'])
+
+    def test_removes_stopped_machines(self):
+        one = self.add_machine('one', 'source')
+        self.add_machine('two', 'other')
+        self.mainloop.queue_event('source', Stop())
+        self.mainloop.queue_event('source', Ping())
+        self.mainloop._dispatch_events()
+        self.assertEqual(one.state, None)
+        self.assertEqual(self.log, [('one', 'Stop')])
+        self.assertEqual(len(self.mainloop._machines), 1)
+
+
+class FakePoller(object):
+
+    def __init__(self):
+        self.masks = {}
+        self.forgotten = []
+        self.ready = (set(), set(), set())
+
+    def set_mask(self, fd, mask):
+        if mask:
+            self.masks[fd] = mask
+        else:
+            self.masks.pop(fd, None)
+
+    def forget(self, fd):
+        self.forgotten.append(fd)
+        self.masks.pop(fd, None)
+
+    def poll(self, timeout):
+        return self.ready
+
+
+class FakeEventSource(distbuild.EventSource):
+
+    notifies_interest_changes = True
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.reading = True
+        self.asked = 0
+
+    def get_select_params(self):
+        return [self.fd] if self.reading else [], [], [], None
+
+    def get_events(self, r, w, x):
+        self.asked += 1
+        return [Ping()] if self.fd in r else []
+
+
+class PolledEventSource(FakeEventSource):
+
+    notifies_interest_changes = False
+
+
+class MainLoopPollingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = FakePoller()
+        self.mainloop = distbuild.MainLoop(self.poller)
+        self.log = []
+
+    def test_watches_what_event_sources_ask_for(self):
+        one = FakeEventSource(3)
+        self.mainloop.add_event_source(one)
+        self.assertEqual(self.poller.masks, {3: distbuild.poller.READ})
+        one.reading = False
+        one.interest_changed()
+        self.assertEqual(self.poller.masks, {})
+
+    def test_only_asks_ready_event_sources_for_events(self):
+        one = FakeEventSource(3)
+        two = FakeEventSource(4)
+        self.mainloop.add_event_source(one)
+        self.mainloop.add_event_source(two)
+        self.mainloop.add_state_machine(RecordingMachine('one', one, self.log))
+        self.poller.ready = (set([3]), set(), set())
+        self.mainloop._run_once()
+        self.assertEqual((one.asked, two.asked), (1, 0))
+        self.assertEqual(self.log, [('one', 'Ping'), 'one'])
+
+    def test_asks_other_event_sources_every_time(self):
+        one = PolledEventSource(3)
+        self.mainloop.add_event_source(one)
+        self.mainloop._run_once()
+        self.mainloop._run_once()
+        self.assertEqual(one.asked, 2)
+        self.assertEqual(self.poller.forgotten, [3, 3])
+
+    def test_combines_event_sources_watching_same_fd(self):
+        one = FakeEventSource(3)
+        self.mainloop.add_event_source(one)
+        self.mainloop.add_event_source(FakeEventSource(3))
+        self.mainloop.remove_event_source(one)
+        self.assertEqual(self.poller.masks, {3: distbuild.poller.READ})
@@ -0,0 +1,229 @@
+# distbuild/poller.py -- wait for file descriptors to become ready
+#
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import errno
+import select
+
+
+# What a file descriptor is watched for. These can be combined.
+READ = 1
+WRITE = 2
+EXCEPTION = 4
+
+
+class Poller(object):
+
+    '''Wait for a set of file descriptors to become ready.
+
+    This is a base class. The file descriptors to watch are kept between
+    calls to ``poll``, and only changed by ``set_mask``, so that there
+    is no need to tell the kernel about every file descriptor again
+    every time the main loop wakes up.
+
+    '''
+
+    def __init__(self):
+        self._masks = {}
+
+    def set_mask(self, fd, mask):
+        '''Set what to watch a file descriptor for.
+
+        ``mask`` is a combination of READ, WRITE and EXCEPTION, or 0 to
+        stop watching the file descriptor.
+
+        '''
+
+        old = self._masks.get(fd, 0)
+        if mask == old:
+            return
+        if mask:
+            self._masks[fd] = mask
+        else:
+            del self._masks[fd]
+
+        if not old:
+            self._register(fd, mask)
+        elif not mask:
+            self._unregister(fd)
+        else:
+            self._modify(fd, mask)
+
+    def forget(self, fd):
+        '''Stop watching a file descriptor that may have been closed.
+
+        The file descriptor is watched again the next time it is given
+        to ``set_mask``, even with the same mask as before.
+
+        '''
+
+        if fd in self._masks:
+            del self._masks[fd]
+            self._unregister(fd)
+
+    def poll(self, timeout):
+        '''Wait until a file descriptor is ready, or for timeout seconds.
+
+        A timeout of None means to wait for as long as it takes. Return
+        three sets of file descriptors: those that are readable, writeable
+        and have an exceptional condition, like ``select.select`` does.
+
+        '''
+
+        r, w, x = set(), set(), set()
+        for fd, readable, writeable, exceptional, error in \
+                self._poll(timeout):
+            mask = self._masks.get(fd, 0)
+            if readable or (error and mask & READ):
+                r.add(fd)
+            if writeable or (error and mask & WRITE):
+                w.add(fd)
+            if exceptional or (error and not mask & (READ | WRITE)):
+                x.add(fd)
+        return r, w, x
+
+
+class SelectPoller(Poller):
+
+    '''A poller using select, for systems without anything better.'''
+
+    def _register(self, fd, mask):
+        pass
+
+    def _unregister(self, fd):
+        pass
+
+    def _modify(self, fd, mask):
+        pass
+
+    def _poll(self, timeout):
+        masks = self._masks
+        r, w, x = select.select(
+            [fd for fd in masks if masks[fd] & READ],
+            [fd for fd in masks if masks[fd] & WRITE],
+            [fd for fd in masks if masks[fd] & EXCEPTION],
+            timeout)
+        r, w, x = set(r), set(w), set(x)
+        return [(fd, fd in r, fd in w, fd in x, False) for fd in r | w | x]
+
+
+class PollPoller(Poller):
+
+    '''A poller using poll, which has no limit on file descriptor numbers.'''
+
+    _flags = [
+        (READ, select.POLLIN),
+        (WRITE, select.POLLOUT),
+        (EXCEPTION, select.POLLPRI),
+    ]
+
+    def __init__(self):
+        Poller.__init__(self)
+        self._poll_object = self._new_poll_object()
+
+    def _new_poll_object(self):
+        return select.poll()
+
+    def _events(self, mask):
+        events = 0
+        for bit, flag in self._flags:
+            if mask & bit:
+                events |= flag
+        return events
+
+    def _register(self, fd, mask):
+        self._poll_object.register(fd, self._events(mask))
+
+    def _unregister(self, fd):
+        try:
+            self._poll_object.unregister(fd)
+        except (KeyError, IOError, OSError): # pragma: no cover
+            pass
+
+    def _modify(self, fd, mask):
+        self._poll_object.modify(fd, self._events(mask))
+
+    def _wait(self, timeout):
+        if timeout is not None:
+            timeout = max(0, int(timeout * 1000 + 0.5))
+        return self._poll_object.poll(timeout)
+
+    def _poll(self, timeout):
+        read, write, exception = [flag for bit, flag in self._flags]
+        error = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        return [(fd, bool(events & read), bool(events & write),
+                 bool(events & exception), bool(events & error))
+                for fd, events in self._wait(timeout)]
+
+
+class EpollPoller(PollPoller):
+
+    '''A poller using epoll, where waiting costs nothing per idle socket.
+
+    The kernel forgets a file descriptor when it is closed, so one that
+    may have been closed and opened again as something else must be
+    given to ``forget`` before it is watched again.
+
+    '''
+
+    def _new_poll_object(self):
+        return select.epoll()
+
+    @property
+    def _flags(self):
+        return [
+            (READ, select.EPOLLIN),
+            (WRITE, select.EPOLLOUT),
+            (EXCEPTION, select.EPOLLPRI),
+        ]
+
+    def _register(self, fd, mask):
+        try:
+            self._poll_object.register(fd, self._events(mask))
+        except IOError, e: # pragma: no cover
+            if e.errno != errno.EEXIST:
+                raise
+            self._poll_object.modify(fd, self._events(mask))
+
+    def _modify(self, fd, mask):
+        try:
+            self._poll_object.modify(fd, self._events(mask))
+        except IOError, e: # pragma: no cover
+            # The file descriptor was closed and opened again.
+            if e.errno != errno.ENOENT:
+                raise
+            self._poll_object.register(fd, self._events(mask))
+
+    def _wait(self, timeout):
+        return self._poll_object.poll(-1 if timeout is None else timeout)
+
+    def _poll(self, timeout):
+        read, write, exception = [flag for bit, flag in self._flags]
+        error = select.EPOLLERR | select.EPOLLHUP
+        return [(fd, bool(events & read), bool(events & write),
+                 bool(events & exception), bool(events & error))
+                for fd, events in self._wait(timeout)]
+
+
+def make_poller():
+    '''Return the best poller available on this system.'''
+
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'): # pragma: no cover
+        return PollPoller()
+    return SelectPoller() # pragma: no cover
@@ -0,0 +1,89 @@
+# distbuild/poller_tests.py -- unit tests for pollers
+#
+# Copyright (C) 2015  Codethink Limited
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import unittest
+
+from distbuild import poller
+
+
+class PollerTests(object):
+
+    def setUp(self):
+        self.poller = self.make_poller()
+        self.read_fd, self.write_fd = os.pipe()
+
+    def tearDown(self):
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def test_times_out_when_nothing_is_ready(self):
+        self.poller.set_mask(self.read_fd, poller.READ)
+        self.assertEqual(self.poller.poll(0), (set(), set(), set()))
+
+    def test_reports_readable_and_writeable(self):
+        self.poller.set_mask(self.read_fd, poller.READ)
+        self.poller.set_mask(self.write_fd, poller.WRITE)
+        self.assertEqual(self.poller.poll(0),
+                         (set(), set([self.write_fd]), set()))
+        os.write(self.write_fd, 'x')
+        self.assertEqual(self.poller.poll(0),
+                         (set([self.read_fd]), set([self.write_fd]), set()))
+
+    def test_stops_watching_when_mask_changes(self):
+        self.poller.set_mask(self.write_fd, poller.WRITE)
+        self.poller.set_mask(self.write_fd, poller.READ)
+        self.assertEqual(self.poller.poll(0), (set(), set(), set()))
+        self.poller.set_mask(self.write_fd, 0)
+        self.assertEqual(self.poller.poll(0), (set(), set(), set()))
+
+    def test_reports_closed_pipe_as_readable(self):
+        self.poller.set_mask(self.read_fd, poller.READ)
+        os.close(self.write_fd)
+        self.assertEqual(self.poller.poll(0),
+                         (set([self.read_fd]), set(), set()))
+
+    def test_watches_reused_file_descriptor_after_forget(self):
+        self.poller.set_mask(self.read_fd, poller.READ)
+        os.close(self.read_fd)
+        self.read_fd, write_fd = os.pipe()
+        os.close(self.write_fd)
+        self.write_fd = write_fd
+        os.write(self.write_fd, 'x')
+        self.poller.forget(self.read_fd)
+        self.poller.set_mask(self.read_fd, poller.READ)
+        self.assertEqual(self.poller.poll(0),
+                         (set([self.read_fd]), set(), set()))
+
+
+class SelectPollerTests(PollerTests, unittest.TestCase):
+
+    make_poller = poller.SelectPoller
+
+
+class PollPollerTests(PollerTests, unittest.TestCase):
+
+    make_poller = poller.PollPoller
+
+
+class EpollPollerTests(PollerTests, unittest.TestCase):
+
+    make_poller = poller.EpollPoller
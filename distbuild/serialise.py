@@ -22,9 +22,314 @@ import yaml
 import morphlib
 import logging
 
+from stringbuffer import StringBuffer
 
-def serialise_artifact(artifact):
-    '''Serialise an Artifact object and its dependencies into string form.'''
+
+# The serialised build graph is a series of lines, each holding a JSON
+# record. The first is a header:
+#
+#   {"format": "morph-artifact-graph", "version": 2,
+#    "default_split_rules": {...}}
+#
+# The rest are lists, whose first item says what they are:
+#
+#   ["m", ID, MORPHOLOGY]      a morphology
+#   ["s", {SOURCE}]            a source, after its morphology
+#   ["a", {ARTIFACT}]          an artifact, after its source
+#   ["end", ID]                the root artifact; this is always last
+#
+# Morphologies, sources and artifacts each have their own series of
+# integer ids. Morphologies are stored once for each different content,
+# however many sources use them. A source lists the ids of its artifacts
+# and dependencies, and an artifact the ids of the sources that depend
+# on it, which may come later.
+#
+# Older versions of Morph use version 1: a YAML document in a JSON
+# string, on a single line, which starts with a '"'. It is still read,
+# and written for workers that may not read version 2 (see
+# distbuild.JsonMachine.peer_understands_graph_2).
+
+_FORMAT = 'morph-artifact-graph'
+_VERSION = 2
+
+
+def _to_str(obj):
+    '''Turn the unicode strings JSON gives into UTF-8 byte strings.'''
+
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [_to_str(x) for x in obj]
+    else:
+        return obj
+
+
+def serialise_artifact(artifact, version=_VERSION):
+    '''Serialise an Artifact object and its dependencies into string form.
+
+    Version 1 is the format of older versions of Morph, for giving to
+    them. It is a single line, which is all they read.
+
+    '''
+
+    if version == 1:
+        return _serialise_version_1(artifact)
+    elif version != _VERSION:
+        raise ValueError('Unknown build graph version %s' % version)
+
+    lines = [json.dumps({
+        'format': _FORMAT,
+        'version': _VERSION,
+        'default_split_rules': {
+            'chunk': morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES,
+            'stratum': morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES,
+        },
+    })]
+
+    morphology_ids = {}
+    morphology_table = {}
+    source_ids = {}
+    artifact_ids = {}
+    encoded_sources = set()
+
+    def record(*items):
+        lines.append(json.dumps(items, separators=(',', ':')))
+
+    def new_id(ids, obj):
+        if id(obj) not in ids:
+            ids[id(obj)] = len(ids)
+        return ids[id(obj)]
+
+    def encode_morphology(morphology):
+        if id(morphology) not in morphology_ids:
+            text = json.dumps(dict((k, morphology[k])
+                                   for k in morphology.keys()),
+                              sort_keys=True, separators=(',', ':'))
+            if text not in morphology_table:
+                morphology_table[text] = len(morphology_table)
+                lines.append('["m",%d,%s]' % (morphology_table[text], text))
+            morphology_ids[id(morphology)] = morphology_table[text]
+        return morphology_ids[id(morphology)]
+
+    def encode_source(source, prune_leaf=False):
+        source_dic = {
+            'id': new_id(source_ids, source),
+            'morphology': encode_morphology(source.morphology),
+            'name': source.name,
+            'repo_name': source.repo_name,
+            'original_ref': source.original_ref,
+            'sha1': source.sha1,
+            'tree': source.tree,
+            'filename': source.filename,
+            'cache_id': source.cache_id,
+            'cache_key': source.cache_key,
+            'artifacts': [],
+            'dependencies': [],
+        }
+        if not prune_leaf:
+            source_dic['artifacts'].extend(
+                new_id(artifact_ids, a) for a in source.artifacts.itervalues())
+            source_dic['dependencies'].extend(
+                new_id(artifact_ids, d) for d in source.dependencies)
+
+        if source.morphology['kind'] == 'chunk':
+            source_dic['build_mode'] = source.build_mode
+            source_dic['prefix'] = source.prefix
+        record('s', source_dic)
+        encoded_sources.add(id(source))
+
+    def encode_artifact(a):
+        if artifact.source.morphology['kind'] == 'system': # pragma: no cover
+            arch = artifact.source.morphology['arch']
+        else:
+            arch = artifact.arch
+
+        record('a', {
+            'id': new_id(artifact_ids, a),
+            'source': new_id(source_ids, a.source),
+            'name': a.name,
+            'arch': arch,
+            'dependents': [new_id(source_ids, d) for d in a.dependents],
+        })
+
+    dependents = {}
+    for a in artifact.walk():
+        if id(a.source) not in encoded_sources:
+            encode_source(a.source)
+            for sa in a.source.artifacts.itervalues():
+                encode_artifact(sa)
+                for source in sa.dependents:
+                    dependents[id(source)] = source
+
+    # Include one level of dependents above encoded artifacts, as we need
+    # them to be able to tell whether two sources are in the same stratum.
+    for source_id, source in dependents.iteritems():
+        if source_id not in encoded_sources: # pragma: no cover
+            encode_source(source, prune_leaf=True)
+
+    record('end', new_id(artifact_ids, artifact))
+    return '\n'.join(lines) + '\n'
+
+
+class ArtifactGraphDecoder(object):
+
+    '''Re-construct a serialised Artifact object graph as it arrives.
+
+    Give the output of ``serialise_artifact`` to ``feed``, in as many
+    pieces as it arrives in. Each record is decoded as soon as all of it
+    has arrived, so that most of the work is done by the time the last
+    piece does. Then ``finish`` returns the root artifact, or raises
+    ValueError if the graph could not be decoded.
+
+    The reconstructed Artifact objects will be sufficiently like the
+    originals that they can be used as a build graph, and other such
+    purposes, by Morph.
+
+    '''
+
+    def __init__(self):
+        self._buffer = StringBuffer()
+        self._version = None
+        self._error = None
+        self._default_split_rules = None
+        self._morphologies = {}
+        self._split_rules = {}
+        self._sources = {}
+        self._source_links = {}
+        self._artifacts = {}
+        self._artifact_dependents = {}
+        self._root = None
+
+    def feed(self, data):
+        self._buffer.add(data)
+        if self._version is None and len(self._buffer) > 0:
+            self._version = 1 if self._buffer.read(1) == '"' else _VERSION
+        if self._version != _VERSION or self._error is not None:
+            return
+        while True:
+            line = self._buffer.readline()
+            if line is None:
+                break
+            if line.strip():
+                self._decode_line(line)
+
+    def _decode_line(self, line):
+        try:
+            if self._root is not None:
+                raise ValueError('Build graph continues after its end')
+            self._decode_record(_to_str(json.loads(line)))
+        except (ValueError, KeyError, IndexError, TypeError), e:
+            logging.debug('Could not decode build graph: %s' % line)
+            self._error = ValueError('Could not decode build graph: %s' % e)
+
+    def _decode_record(self, record):
+        if isinstance(record, dict):
+            if (record.get('format') != _FORMAT or
+                    record.get('version') != _VERSION):
+                raise ValueError('Unknown build graph format %s version %s' %
+                                 (record.get('format'),
+                                  record.get('version')))
+            self._default_split_rules = record['default_split_rules']
+        elif self._default_split_rules is None:
+            raise ValueError('Build graph has no header')
+        elif record[0] == 'm':
+            self._morphologies[record[1]] = \
+                morphlib.morphology.Morphology(record[2])
+        elif record[0] == 's':
+            self._decode_source(record[1])
+        elif record[0] == 'a':
+            self._decode_artifact(record[1])
+        elif record[0] == 'end':
+            self._root = record[1]
+        else:
+            raise ValueError('Unknown build graph record %s' % record[0])
+
+    def _get_split_rules(self, morphology_id):
+        # Split sources of one morphology share their rules, as they do
+        # when the graph is first created.
+        if morphology_id not in self._split_rules:
+            morphology = self._morphologies[morphology_id]
+            kind = morphology['kind']
+            ruler = getattr(morphlib.artifactsplitrule,
+                            'unify_%s_matches' % kind)
+            if kind in ('chunk', 'stratum'):
+                rules = ruler(morphology, self._default_split_rules[kind])
+            else: # pragma: no cover
+                rules = ruler(morphology)
+            self._split_rules[morphology_id] = rules
+        return self._split_rules[morphology_id]
+
+    def _decode_source(self, le_dict):
+        morphology = self._morphologies[le_dict['morphology']]
+        source = morphlib.source.Source(
+            le_dict['name'], le_dict['repo_name'], le_dict['original_ref'],
+            le_dict['sha1'], le_dict['tree'], morphology, le_dict['filename'],
+            self._get_split_rules(le_dict['morphology']))
+        if morphology['kind'] == 'chunk':
+            source.build_mode = le_dict['build_mode']
+            source.prefix = le_dict['prefix']
+        source.cache_id = le_dict['cache_id']
+        source.cache_key = le_dict['cache_key']
+        self._sources[le_dict['id']] = source
+        self._source_links[le_dict['id']] = (le_dict['artifacts'],
+                                             le_dict['dependencies'])
+
+    def _decode_artifact(self, le_dict):
+        source = self._sources[le_dict['source']]
+        artifact = morphlib.artifact.Artifact(source, le_dict['name'])
+        artifact.arch = le_dict['arch']
+        self._artifacts[le_dict['id']] = artifact
+        self._artifact_dependents[le_dict['id']] = le_dict['dependents']
+
+    def finish(self):
+        '''Return the root artifact, once all of the graph has been fed.'''
+
+        if self._version == 1:
+            return _deserialise_version_1(self._buffer.peek())
+
+        rest = self._buffer.peek()
+        if rest.strip():
+            self._buffer.remove(len(rest))
+            self._decode_line(rest)
+        if self._error is not None:
+            raise self._error
+        if self._root is None:
+            raise ValueError('Build graph is incomplete')
+
+        try:
+            for source_id, source in self._sources.iteritems():
+                artifact_ids, dependency_ids = self._source_links[source_id]
+                source.artifacts = dict((self._artifacts[a].name,
+                                         self._artifacts[a])
+                                        for a in artifact_ids)
+                source.dependencies = [self._artifacts[a]
+                                       for a in dependency_ids]
+            for artifact_id, artifact in self._artifacts.iteritems():
+                artifact.dependents = [
+                    self._sources[s]
+                    for s in self._artifact_dependents[artifact_id]]
+            return self._artifacts[self._root]
+        except KeyError, e:
+            raise ValueError('Build graph refers to unknown id %s' % e)
+
+
+def deserialise_artifact(encoded):
+    '''Re-construct the Artifact object (and dependencies).
+    
+    The argument should be a string returned by ``serialise_artifact``.
+    See ``ArtifactGraphDecoder``.
+    
+    '''
+
+    decoder = ArtifactGraphDecoder()
+    decoder.feed(encoded)
+    return decoder.finish()
+
+
+def _serialise_version_1(artifact):
+    '''Serialise an artifact in the format of older versions.'''
 
     def encode_morphology(morphology):
         result = {}
@@ -114,14 +419,12 @@ def serialise_artifact(artifact):
     return json.dumps(yaml.dump(content))
 
 
-def deserialise_artifact(encoded):
-    '''Re-construct the Artifact object (and dependencies).
-    
-    The argument should be a string returned by ``serialise_artifact``.
-    The reconstructed Artifact objects will be sufficiently like the
-    originals that they can be used as a build graph, and other such
-    purposes, by Morph.
-    
+def _deserialise_version_1(encoded):
+    '''Re-construct an artifact from the format of older versions.
+
+    This was a YAML document in a JSON string, with everything keyed by
+    the ``id()`` of the original objects.
+
     '''
 
     def decode_morphology(le_dict):
@@ -16,8 +16,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import json
+import StringIO
 import unittest
 
+import yaml
+
 import distbuild
 
 
@@ -172,3 +176,104 @@ class SerialisationTests(unittest.TestCase):
         self.art1.source.dependencies = [self.art2, self.art3]
         self.verify_round_trip(self.art1)
 
+
+    def test_decodes_graph_fed_in_pieces(self):
+        self.art2.source.dependencies = [self.art4]
+        self.art1.source.dependencies = [self.art2, self.art3]
+        encoded = distbuild.serialise_artifact(self.art1) + '\n'
+        decoder = distbuild.ArtifactGraphDecoder()
+        for i in range(0, len(encoded), 7):
+            decoder.feed(encoded[i:i+7])
+        self.assertEqualArtifacts(self.art1, decoder.finish())
+
+    def test_stores_identical_morphologies_once(self):
+        self.art3.source.morphology = self.art2.source.morphology
+        self.art4.source.morphology = MockMorphology('name2', 'chunk')
+        self.art1.source.dependencies = [self.art2, self.art3, self.art4]
+        encoded = distbuild.serialise_artifact(self.art1)
+        records = [json.loads(line) for line in encoded.splitlines()[1:]]
+        self.assertEqual(len([r for r in records if r[0] == 'm']), 2)
+
+        decoded = distbuild.deserialise_artifact(encoded)
+        self.assertEqualArtifacts(self.art1, decoded)
+        deps = decoded.source.dependencies
+        self.assertTrue(deps[0].source.morphology is
+                        deps[2].source.morphology)
+
+    def test_links_dependents(self):
+        self.art1.source.dependencies = [self.art2]
+        self.art2.dependents = [self.art1.source]
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art1))
+        dep = decoded.source.dependencies[0]
+        self.assertEqual(dep.dependents, [decoded.source])
+
+    def test_rejects_incomplete_graph(self):
+        self.art1.source.dependencies = [self.art2]
+        encoded = distbuild.serialise_artifact(self.art1)
+        last_line = encoded.rstrip('\n').rfind('\n') + 1
+        self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                          encoded[:last_line])
+
+    def test_rejects_garbage(self):
+        self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                          '{"format": "something else"}\n')
+        self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                          'Traceback (most recent call last):\n')
+
+    def test_decodes_format_of_older_versions(self):
+        source = self.art1.source
+        content = {
+            'sources': {
+                1: {
+                    'name': source.name,
+                    'repo': None,
+                    'repo_name': source.repo_name,
+                    'original_ref': source.original_ref,
+                    'sha1': source.sha1,
+                    'tree': source.tree,
+                    'morphology': 2,
+                    'filename': source.filename,
+                    'artifact_ids': [3],
+                    'cache_id': source.cache_id,
+                    'cache_key': source.cache_key,
+                    'dependencies': [],
+                },
+            },
+            'artifacts': {
+                3: {
+                    'source_id': 1,
+                    'name': self.art1.name,
+                    'arch': self.art1.arch,
+                    'dependents': [],
+                },
+            },
+            'morphologies': {2: source.morphology.dict},
+            'root_artifact': 3,
+            'default_split_rules': {'chunk': [], 'stratum': []},
+        }
+        decoded = distbuild.deserialise_artifact(
+            json.dumps(yaml.dump(content)))
+        self.assertEqualArtifacts(self.art1, decoded)
+
+    def read_like_older_versions(self, encoded):
+        # Older versions of worker-build read one line of stdin.
+        line = StringIO.StringIO(encoded).readline()
+        return distbuild.serialise._deserialise_version_1(line)
+
+    def test_older_versions_read_version_1(self):
+        self.art2.source.dependencies = [self.art4]
+        self.art1.source.dependencies = [self.art2, self.art3]
+        encoded = distbuild.serialise_artifact(self.art1, 1)
+        self.assertEqualArtifacts(self.art1,
+                                  self.read_like_older_versions(encoded))
+        self.assertEqualArtifacts(self.art1,
+                                  distbuild.deserialise_artifact(encoded))
+
+    def test_older_versions_cannot_read_version_2(self):
+        encoded = distbuild.serialise_artifact(self.art1)
+        self.assertRaises(Exception, self.read_like_older_versions, encoded)
+
+    def test_rejects_unknown_version(self):
+        self.assertRaises(ValueError, distbuild.serialise_artifact,
+                          self.art1, 3)
@@ -56,7 +56,8 @@ class StateMachine(object):
     def setup(self):
         '''Set up machine for execution.
         
-        This is called when the machine is added to the main loop.
+        This is called when the machine is added to the main loop, and
+        is where the machine adds its transitions.
         
         '''
         
@@ -89,6 +90,12 @@ class StateMachine(object):
         for t in specification:
             self.add_transition(*t)
     
+    def get_event_keys(self):
+        '''Return the (source, event class) pairs handled in any state.'''
+
+        return set((source, event_class)
+                   for state, source, event_class in self._transitions)
+
     def handle_event(self, event_source, event):
         '''Handle a given event.
         
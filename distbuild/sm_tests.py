@@ -96,3 +96,14 @@ class StateMachineTests(unittest.TestCase):
         self.assertEqual(self.event_sources, [self.event_source])
         self.assertEqual(self.events, [self.event])
 
+
+    def test_lists_event_keys_of_all_states(self):
+        self.sm.add_transition('init', self.event_source, DummyEvent,
+                               'next', None)
+        self.sm.add_transition('next', self.event_source, DummyEvent,
+                               'init', None)
+        self.sm.add_transition('next', DummyEventSource, DummyEvent,
+                               'init', None)
+        self.assertEqual(self.sm.get_event_keys(),
+                         set([(self.event_source, DummyEvent),
+                              (DummyEventSource, DummyEvent)]))
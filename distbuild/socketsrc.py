@@ -61,6 +61,8 @@ class ListeningSocketEventSource(EventSource):
 
     '''An event source for a socket that listens for connections.'''
 
+    notifies_interest_changes = True
+
     def __init__(self, addr, port):
         self.sock = distbuild.create_socket()
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -89,10 +91,14 @@ class ListeningSocketEventSource(EventSource):
         return []
 
     def start_accepting(self):
-        self._accepting = True
+        if not self._accepting:
+            self._accepting = True
+            self.interest_changed()
         
     def stop_accepting(self):
-        self._accepting = False
+        if self._accepting:
+            self._accepting = False
+            self.interest_changed()
 
 
 class SocketReadable(object):
@@ -126,6 +132,8 @@ class SocketEventSource(EventSource):
     
     '''
 
+    notifies_interest_changes = True
+
     def __init__(self, sock):
         self.sock = sock
         self._reading = True
@@ -154,16 +162,24 @@ class SocketEventSource(EventSource):
         return events
 
     def start_reading(self):
-        self._reading = True
+        if not self._reading:
+            self._reading = True
+            self.interest_changed()
         
     def stop_reading(self):
-        self._reading = False
+        if self._reading:
+            self._reading = False
+            self.interest_changed()
 
     def start_writing(self):
-        self._writing = True
+        if not self._writing:
+            self._writing = True
+            self.interest_changed()
         
     def stop_writing(self):
-        self._writing = False
+        if self._writing:
+            self._writing = False
+            self.interest_changed()
 
     def read(self, max_bytes):
         fd = self.sock.fileno()
@@ -174,10 +190,14 @@ class SocketEventSource(EventSource):
         return os.write(fd, data)
 
     def close(self):
-        self.stop_reading()
-        self.stop_writing()
-        self.sock.close()
+        self._reading = False
+        self._writing = False
+        sock = self.sock
         self.sock = None
+        # Let the main loop stop watching the socket before it is closed,
+        # since its file descriptor may be reused straight away.
+        self.interest_changed()
+        sock.close()
         
     def is_finished(self):
         return self.sock is None
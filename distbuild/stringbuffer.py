@@ -20,43 +20,48 @@ class StringBuffer(object):
 
     '''Buffer data for a file descriptor.
     
-    The data may arrive in small pieces, and it is buffered in a way that
-    avoids excessive string catenation or splitting.
+    The data may arrive in small pieces. It is kept in one bytearray, and
+    data removed from the start is only dropped once it is at least half
+    of the buffer, so adding and removing data costs time in proportion
+    to its size, however it is split into pieces. ``readline`` remembers
+    how far it has looked for a newline, so a long line arriving in many
+    pieces is only searched once.
     
     '''
 
+    # Do not bother dropping removed data until there is this much.
+    _min_compact = 64 * 1024
+
     def __init__(self):
-        self.strings = []
-        self.len = 0
+        self._buf = bytearray()
+        # The data in the buffer starts at _start, and has no newline
+        # before _scanned.
+        self._start = 0
+        self._scanned = 0
         
     def add(self, data):
         '''Add data to buffer.'''
-        self.strings.append(data)
-        self.len += len(data)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._buf.extend(data)
         
     def remove(self, num_bytes):
         '''Remove specified number of bytes from buffer.'''
-        while num_bytes > 0 and self.strings:
-            first = self.strings[0]
-            if len(first) <= num_bytes:
-                num_bytes -= len(first)
-                del self.strings[0]
-                self.len -= len(first)
-            else:
-                self.strings[0] = first[num_bytes:]
-                self.len -= num_bytes
-                num_bytes = 0
+        if num_bytes <= 0:
+            return
+        self._start = min(self._start + num_bytes, len(self._buf))
+        if self._start == len(self._buf):
+            del self._buf[:]
+            self._start = self._scanned = 0
+        elif (self._start >= self._min_compact and
+                self._start * 2 >= len(self._buf)):
+            del self._buf[:self._start]
+            self._scanned = max(0, self._scanned - self._start)
+            self._start = 0
 
     def peek(self):
         '''Return contents of buffer as one string.'''
-        
-        if len(self.strings) == 0:
-            return ''
-        elif len(self.strings) == 1:
-            return self.strings[0]
-        else:
-            self.strings = [''.join(self.strings)]
-            return self.strings[0]
+        return str(self._buf[self._start:])
 
     def read(self, max_bytes):
         '''Return up to max_bytes from the buffer.
@@ -67,36 +72,18 @@ class StringBuffer(object):
         
         '''
         
-        use = []
-        size = 0
-        for s in self.strings:
-            n = max_bytes - size
-            if len(s) <= n:
-                use.append(s)
-                size += len(s)
-            else:
-                use.append(s[:n])
-                size += n
-                break
-        return ''.join(use)
+        return str(self._buf[self._start:self._start + max_bytes])
 
     def readline(self):
         '''Return a complete line (ends with '\n') or None.'''
 
-        for i, s in enumerate(self.strings):
-            newline = s.find('\n')
-            if newline != -1:
-                if newline+1 == len(s):
-                    use = self.strings[:i+1]
-                    del self.strings[:i+1]
-                else:
-                    pre = s[:newline+1]
-                    use = self.strings[:i] + [pre]
-                    del self.strings[:i]
-                    self.strings[0] = s[newline+1:]
-                return ''.join(use)
-        return None
+        newline = self._buf.find('\n', max(self._start, self._scanned))
+        if newline == -1:
+            self._scanned = len(self._buf)
+            return None
+        line = str(self._buf[self._start:newline + 1])
+        self.remove(len(line))
+        return line
             
     def __len__(self):
-        return self.len
-
+        return len(self._buf) - self._start
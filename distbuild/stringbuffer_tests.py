@@ -150,3 +150,44 @@ class StringBufferReadlineTests(unittest.TestCase):
         self.assertEqual(self.buf.readline(), 'foo\n')
         self.assertEqual(self.buf.peek(), 'bar')
 
+
+    def test_updates_length(self):
+        self.buf.add('fo')
+        self.buf.add('o\nbar')
+        self.buf.readline()
+        self.assertEqual(len(self.buf), 3)
+
+    def test_extracts_line_added_in_many_pieces(self):
+        for i in xrange(1000):
+            self.buf.add('x')
+            self.assertEqual(self.buf.readline(), None)
+        self.buf.add('\nfoo\n')
+        self.assertEqual(self.buf.readline(), 'x' * 1000 + '\n')
+        self.assertEqual(self.buf.readline(), 'foo\n')
+        self.assertEqual(self.buf.readline(), None)
+
+
+class StringBufferCompactionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.buf = distbuild.StringBuffer()
+        self.buf._min_compact = 4
+
+    def test_keeps_data_when_dropping_removed_data(self):
+        self.buf.add('abcdefgh')
+        self.buf.remove(5)
+        self.buf.add('ij\nkl')
+        self.assertEqual(self.buf.peek(), 'fghij\nkl')
+        self.assertEqual(self.buf.readline(), 'fghij\n')
+        self.assertEqual(len(self.buf), 2)
+
+    def test_finds_newline_after_dropping_removed_data(self):
+        self.buf.add('abcdef')
+        self.assertEqual(self.buf.readline(), None)
+        self.buf.remove(5)
+        self.buf.add('g\n')
+        self.assertEqual(self.buf.readline(), 'fg\n')
+
+    def test_stores_unicode_as_utf8(self):
+        self.buf.add(u'caf\xe9')
+        self.assertEqual(self.buf.peek(), 'caf\xc3\xa9')
@@ -17,7 +17,9 @@
 
 
 import collections
+import heapq
 import httplib
+import itertools
 import logging
 import socket
 import urllib
@@ -28,9 +30,10 @@ import distbuild
 
 class WorkerBuildRequest(object):
 
-    def __init__(self, artifact, initiator_id):
+    def __init__(self, artifact, initiator_id, priority=0):
         self.artifact = artifact
         self.initiator_id = initiator_id
+        self.priority = priority
 
 class WorkerCancelPending(object):
     
@@ -95,10 +98,11 @@ class _HaveAJob(object):
 
 class Job(object):
 
-    def __init__(self, job_id, artifact, initiator_id):
+    def __init__(self, job_id, artifact, initiator_id, priority=0):
         self.id = job_id
         self.artifact = artifact
         self.initiators = [initiator_id]
+        self.priority = priority
         self.who = None  # we don't know who's going to do this yet
         self.running = False
         self.failed = False
@@ -106,19 +110,48 @@ class Job(object):
 
 class Jobs(object):
 
+    '''The jobs that are waiting for a worker or being built.
+
+    Waiting jobs are handed out highest priority first, and in the order
+    they were created when their priorities are equal. The priority of
+    a job is the expected time from the start of the job to the end of
+    the build that wants it (see ``distbuild.critical_path_priorities``),
+    so the jobs that hold up their builds for longest are started first.
+
+    '''
+
     def __init__(self, idgen):
         self._idgen = idgen
         self._jobs = {}
+        # A heap of (-priority, sequence number, artifact basename) for
+        # every waiting job. Entries for jobs that were removed, given to
+        # a worker or given a higher priority are left in the heap and
+        # skipped when they reach the top.
+        self._waiting = []
+        self._sequence = itertools.count()
 
     def get(self, artifact_basename):
         return (self._jobs[artifact_basename]
             if artifact_basename in self._jobs else None)
 
-    def create(self, artifact, initiator_id):
-        job = Job(self._idgen.next(), artifact, initiator_id)
+    def create(self, artifact, initiator_id, priority=0):
+        job = Job(self._idgen.next(), artifact, initiator_id, priority)
         self._jobs[job.artifact.basename()] = job
+        self._push(job)
         return job
 
+    def _push(self, job):
+        heapq.heappush(self._waiting,
+                       (-job.priority, next(self._sequence),
+                        job.artifact.basename()))
+
+    def raise_priority(self, job, priority):
+        '''Give a job a higher priority, if it is not started yet.'''
+
+        if priority > job.priority and job.who is None:
+            job.priority = priority
+            self._push(job)
+
     def remove(self, job):
         if job.artifact.basename() in self._jobs:
             del self._jobs[job.artifact.basename()]
@@ -137,11 +170,19 @@ class Jobs(object):
         return artifact_basename in self._jobs
 
     def get_next_job(self):
-        # for now just return the first thing we find that's not being built
-        waiting = [job for (_, job) in
-            self._jobs.iteritems() if job.who == None]
+        '''Return the waiting job with the highest priority, or None.
+
+        The caller must give the job to a worker.
 
-        return waiting.pop() if len(waiting) > 0 else None
+        '''
+
+        while self._waiting:
+            negative_priority, _, basename = heapq.heappop(self._waiting)
+            job = self._jobs.get(basename)
+            if (job is not None and job.who is None and
+                    job.priority == -negative_priority):
+                return job
+        return None
 
     def __repr__(self):
         return str([job.artifact.basename()
@@ -257,6 +298,7 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         if self._jobs.exists(event.artifact.basename()):
             job = self._jobs.get(event.artifact.basename())
             job.initiators.append(event.initiator_id)
+            self._jobs.raise_priority(job, event.priority)
 
             if job.running:
                 logging.debug('Worker build step already started: %s' %
@@ -273,7 +315,8 @@ class WorkerBuildQueuer(distbuild.StateMachine):
             self.mainloop.queue_event(WorkerConnection, progress)
         else:
             logging.debug('WBQ: Creating job for: %s' % event.artifact.name)
-            job = self._jobs.create(event.artifact, event.initiator_id)
+            job = self._jobs.create(event.artifact, event.initiator_id,
+                                    event.priority)
 
             if self._available_workers:
                 self._give_job(job)
@@ -471,10 +514,16 @@ class WorkerConnection(distbuild.StateMachine):
             '--build-log-on-stdout',
             self._job.artifact.name,
         ]
+        # Workers running an older version of Morph only read the build
+        # graph format of that version.
+        if self._jm.peer_understands_graph_2:
+            graph = distbuild.serialise_artifact(self._job.artifact)
+        else:
+            graph = distbuild.serialise_artifact(self._job.artifact, 1)
         msg = distbuild.message('exec-request',
             id=self._job.id,
             argv=argv,
-            stdin_contents=distbuild.serialise_artifact(self._job.artifact),
+            stdin_contents=graph,
         )
         self._jm.send(msg)
 
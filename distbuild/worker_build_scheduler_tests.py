@@ -0,0 +1,76 @@
+# distbuild/worker_build_scheduler_tests.py -- unit tests for job queue
+#
+# Copyright (C) 2015  Codethink Limited
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import unittest
+
+import distbuild
+from distbuild.worker_build_scheduler import Jobs
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def basename(self):
+        return self.name
+
+
+class JobsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs = Jobs(distbuild.IdentifierGenerator('Job'))
+
+    def next_job_name(self):
+        job = self.jobs.get_next_job()
+        if job is None:
+            return None
+        job.who = 'worker'
+        return job.artifact.name
+
+    def test_gives_no_job_when_none_are_waiting(self):
+        self.assertEqual(self.jobs.get_next_job(), None)
+
+    def test_gives_highest_priority_job_first(self):
+        self.jobs.create(FakeArtifact('low'), 'initiator', 1)
+        self.jobs.create(FakeArtifact('high'), 'initiator', 10)
+        self.jobs.create(FakeArtifact('middle'), 'initiator', 5)
+        self.assertEqual(self.next_job_name(), 'high')
+        self.assertEqual(self.next_job_name(), 'middle')
+        self.assertEqual(self.next_job_name(), 'low')
+        self.assertEqual(self.next_job_name(), None)
+
+    def test_gives_oldest_job_first_when_priorities_are_equal(self):
+        for name in ('a', 'b', 'c'):
+            self.jobs.create(FakeArtifact(name), 'initiator')
+        self.assertEqual(self.next_job_name(), 'a')
+        self.assertEqual(self.next_job_name(), 'b')
+
+    def test_uses_raised_priority(self):
+        self.jobs.create(FakeArtifact('a'), 'initiator', 5)
+        job = self.jobs.create(FakeArtifact('b'), 'initiator', 1)
+        self.jobs.raise_priority(job, 10)
+        self.assertEqual(self.next_job_name(), 'b')
+        self.assertEqual(self.next_job_name(), 'a')
+        self.assertEqual(self.next_job_name(), None)
+
+    def test_skips_removed_jobs(self):
+        job = self.jobs.create(FakeArtifact('a'), 'initiator', 5)
+        self.jobs.create(FakeArtifact('b'), 'initiator', 1)
+        self.jobs.remove(job)
+        self.assertEqual(self.next_job_name(), 'b')
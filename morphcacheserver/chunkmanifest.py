@@ -0,0 +1,301 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Chunk artifacts stored as a manifest and blobs.
+
+This is the storage format of the 'dedup' artifact cache backend of
+Morph (see ``morphlib.dedupartifactcache``). It is kept apart from the
+rest of Morph so that the cache server can serve such chunks without
+importing morphlib.
+
+'''
+
+
+import errno
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import time
+
+
+MANIFEST_MAGIC = 'morph-dedup-manifest 1\n'
+
+_COPY_BUFSIZE = 1024 * 1024
+
+
+def is_manifest(filename):
+    '''Is ``filename`` a chunk manifest rather than a tarball?'''
+
+    with open(filename, 'rb') as f:
+        return f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC
+
+
+class BlobStore(object):
+
+    '''Files stored by their contents and attributes.
+
+    Each blob is a regular file named after the SHA-1 of its contents
+    together with its mode, owner and mtime, so a blob can be hardlinked
+    anywhere it is needed without changing its attributes.
+
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def path(self, blob):
+        return os.path.join(self.dirname, blob[:2], blob)
+
+    def add(self, src, tarinfo):
+        '''Store the data read from ``src`` for a tar member.
+
+        Return the name of the blob.
+
+        '''
+
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        fd, tempname = tempfile.mkstemp(dir=self.dirname, prefix='tmp')
+        try:
+            sha = hashlib.sha1()
+            with os.fdopen(fd, 'wb') as f:
+                remaining = tarinfo.size
+                while remaining > 0:
+                    buf = src.read(min(remaining, _COPY_BUFSIZE))
+                    if not buf:
+                        raise tarfile.ReadError('unexpected end of data')
+                    sha.update(buf)
+                    f.write(buf)
+                    remaining -= len(buf)
+            blob = '%s-%o-%d-%d-%d' % (sha.hexdigest(), tarinfo.mode & 07777,
+                                       tarinfo.uid, tarinfo.gid,
+                                       tarinfo.mtime)
+            path = self.path(blob)
+            try:
+                # Update the ctime, which protects the blob from prune()
+                # until the manifest using it has been written.
+                os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise  # pragma: no cover
+            else:
+                os.remove(tempname)
+                return blob
+            os.chmod(tempname, tarinfo.mode & 07777)
+            os.utime(tempname, (tarinfo.mtime, tarinfo.mtime))
+            if os.geteuid() == 0:  # pragma: no cover
+                os.chown(tempname, tarinfo.uid, tarinfo.gid)
+            if not os.path.exists(os.path.dirname(path)):
+                try:
+                    os.mkdir(os.path.dirname(path))
+                except OSError, e:  # pragma: no cover
+                    if e.errno != errno.EEXIST:
+                        raise
+            os.rename(tempname, path)
+        except BaseException:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+            raise
+        return blob
+
+    def prune(self, referenced, min_age):
+        '''Remove blobs that are not in ``referenced``.
+
+        Blobs changed less than ``min_age`` seconds ago are kept, since
+        they may belong to an artifact that is still being stored. Return
+        the number of blobs removed.
+
+        '''
+
+        if not os.path.exists(self.dirname):
+            return 0
+        removed = 0
+        too_new = time.time() - min_age
+        for dirname, subdirs, basenames in os.walk(self.dirname):
+            for basename in basenames:
+                if basename in referenced:
+                    continue
+                filename = os.path.join(dirname, basename)
+                if os.lstat(filename).st_ctime > too_new:
+                    continue
+                os.remove(filename)
+                if not basename.startswith('tmp'):
+                    removed += 1
+        return removed
+
+
+def blob_dir(artifact_dir):
+    '''Return the blob directory of a cache directory of artifacts.
+
+    Morph keeps blobs in ``blobs``, next to the ``artifacts`` directory.
+
+    '''
+
+    return os.path.join(os.path.dirname(os.path.normpath(artifact_dir)),
+                        'blobs')
+
+
+def open_artifact(filename):
+    '''Open a cached artifact for reading it as it was stored.
+
+    A chunk stored as a manifest is read as the tarball it was made
+    from, and any other artifact is read as it is.
+
+    '''
+
+    if is_manifest(filename):
+        return ManifestReader(
+            filename, BlobStore(blob_dir(os.path.dirname(filename))))
+    return open(filename, 'rb')
+
+
+# Names in tarballs are bytes, which are kept as they are by storing them
+# in the manifest as if they were Latin-1.
+MANIFEST_ENCODING = 'latin-1'
+_NAME_FIELDS = ('name', 'linkname', 'uname', 'gname')
+
+
+def manifest_entry(tarinfo, blob):
+    '''Describe a tar member, stored in ``blob``, in a manifest.'''
+    return {
+        'name': tarinfo.name,
+        'type': tarfile.REGTYPE if blob else tarinfo.type,
+        'mode': tarinfo.mode,
+        'uid': tarinfo.uid,
+        'gid': tarinfo.gid,
+        'uname': tarinfo.uname,
+        'gname': tarinfo.gname,
+        'mtime': tarinfo.mtime,
+        'linkname': tarinfo.linkname,
+        'size': tarinfo.size if blob else 0,
+        'devmajor': tarinfo.devmajor,
+        'devminor': tarinfo.devminor,
+        'blob': blob,
+    }
+
+
+def entry_tarinfo(entry):
+    '''Make a tar member from its manifest entry.'''
+    tarinfo = tarfile.TarInfo()
+    for key in ('type', 'mode', 'uid', 'gid', 'mtime', 'size', 'devmajor',
+                'devminor'):
+        setattr(tarinfo, key, entry[key])
+    for key in _NAME_FIELDS:
+        setattr(tarinfo, key, entry[key].encode(MANIFEST_ENCODING))
+    tarinfo.type = str(tarinfo.type)
+    tarinfo.blob = entry['blob'] and str(entry['blob'])
+    return tarinfo
+
+
+def read_manifest(filename):
+    '''Return the contents of a manifest file.'''
+    with open(filename, 'rb') as f:
+        f.read(len(MANIFEST_MAGIC))
+        return json.load(f, encoding=MANIFEST_ENCODING)
+
+
+class ManifestReader(object):
+
+    '''A chunk artifact reconstructed from its manifest and blobs.
+
+    This is a read-only file object giving the chunk as a tarball,
+    generated on demand. It can only be read from start to end, and
+    only seek back into what the last ``read`` returned.
+
+    '''
+
+    def __init__(self, filename, blobs):
+        self.name = filename
+        self.blobs = blobs
+        self.entries = read_manifest(filename)['entries']
+        self.size = sum(entry['size'] for entry in self.entries)
+        self._stream = self._generate()
+        self._buf = ''
+        self._pos = 0
+        self._last = ''
+
+    def _generate(self):
+        offset = 0
+        for entry in self.entries:
+            tarinfo = entry_tarinfo(entry)
+            buf = tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING,
+                                'strict')
+            yield buf
+            offset += len(buf)
+            if tarinfo.blob is not None:
+                with open(self.blobs.path(tarinfo.blob), 'rb') as f:
+                    while True:
+                        buf = f.read(_COPY_BUFSIZE)
+                        if not buf:
+                            break
+                        yield buf
+                blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+                if remainder > 0:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+                    blocks += 1
+                offset += blocks * tarfile.BLOCKSIZE
+        end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        offset += len(end)
+        blocks, remainder = divmod(offset, tarfile.RECORDSIZE)
+        if remainder > 0:
+            end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+        yield end
+
+    def read(self, size=-1):
+        pieces = [self._buf]
+        length = len(self._buf)
+        while size < 0 or length < size:
+            try:
+                buf = next(self._stream)
+            except StopIteration:
+                break
+            pieces.append(buf)
+            length += len(buf)
+        data = ''.join(pieces)
+        if size >= 0:
+            data, self._buf = data[:size], data[size:]
+        else:
+            self._buf = ''
+        self._pos += len(data)
+        self._last = data
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        '''Seek back to somewhere in the data returned by the last read.'''
+
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        back = self._pos - pos
+        if whence == os.SEEK_END or back < 0 or back > len(self._last):
+            raise IOError(errno.ESPIPE, 'Cannot seek in chunk manifest')
+        if back:
+            self._buf = self._last[-back:] + self._buf
+            self._last = self._last[:-back]
+            self._pos = pos
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, exctraceback):
+        self.close()
@@ -48,6 +48,7 @@ class Error(cliapp.AppException):
 
 import artifact
 import artifactcachereference
+import artifactprefetcher
 import artifactresolver
 import artifactsplitrule
 import branchmanager
@@ -55,10 +56,13 @@ import bins
 import buildbranch
 import buildcommand
 import buildenvironment
+import buildplan
+import buildscheduler
 import buildsystem
 import builder
 import cachedrepo
 import cachekeycomputer
+import dedupartifactcache
 import extensions
 import extractedtarball
 import fsutils
@@ -78,12 +82,14 @@ import remoterepocache
 import repoaliasresolver
 import savefile
 import source
+import sourcecache
 import sourcepool
 import sourceresolver
 import stagingarea
 import stopwatch
 import sysbranchdir
 import systemmetadatadir
+import unpackedchunkcache
 import util
 import workspace
 
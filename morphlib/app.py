@@ -83,6 +83,16 @@ class Morph(cliapp.Application):
                               'do not update the cached git repositories '
                               'automatically',
                               group=group_advanced)
+        self.settings.integer(['ref-cache-ttl'],
+                              'reuse what named refs (branches and tags) '
+                              'resolved to in earlier runs for up to '
+                              'SECONDS; 0 means always resolve them again '
+                              '(refs that are commit SHA1s, and the '
+                              'morphologies in each commit, are always '
+                              'cached)',
+                              metavar='SECONDS',
+                              default=0,
+                              group=group_advanced)
         self.settings.boolean(['build-log-on-stdout'],
                               'write build log on stdout',
                               group=group_advanced)
@@ -107,6 +117,13 @@ class Morph(cliapp.Application):
             metavar='URL',
             default=None,
             group=group_advanced)
+        self.settings.integer(
+            ['artifact-fetch-connections'],
+            'fetch artifacts from the artifact cache server over at most N '
+            'connections at once (default: %default)',
+            metavar='N',
+            default=4,
+            group=group_advanced)
         self.settings.string(
             ['git-resolve-cache-server'],
             'HTTP URL for the git ref resolving cache server; '
@@ -130,6 +147,41 @@ class Morph(cliapp.Application):
                               metavar='N',
                               default=defaults['max-jobs'],
                               group=group_build)
+        self.settings.integer(['parallel-builds'],
+                              'build at most N independent chunks or strata '
+                              'at the same time, each in its own staging '
+                              'area and each running up to max-jobs jobs '
+                              '(default: %default)',
+                              metavar='N',
+                              default=1,
+                              group=group_build)
+        self.settings.boolean(['dry-run'],
+                              'do not build anything, but show what would '
+                              'be built and how long it is expected to take, '
+                              'from the times of earlier builds',
+                              group=group_build)
+        self.settings.string(['plan-file'],
+                             'with --dry-run, also write the plan to FILE '
+                             'as JSON',
+                             metavar='FILE',
+                             default='',
+                             group=group_build)
+        self.settings.choice(['artifact-compression'],
+                             list(morphlib.bins.COMPRESSION_FORMATS),
+                             'compress chunk and system artifacts that are '
+                             'built with this format, which needs the '
+                             'matching command-line tool; compressed '
+                             'artifacts get different cache keys from '
+                             'uncompressed ones (default: none)',
+                             group=group_build)
+        self.settings.choice(['staging-area-backend'],
+                             ['hardlink', 'overlayfs'],
+                             'how to install build dependencies into staging '
+                             'areas: `hardlink` every file, or mount them '
+                             'with `overlayfs`, falling back to hardlinks if '
+                             'the overlay cannot be mounted (default: '
+                             'hardlink)',
+                             group=group_build)
         self.settings.boolean(['no-ccache'], 'do not use ccache',
                               group=group_build)
         self.settings.boolean(['no-distcc'],
@@ -183,6 +235,14 @@ class Morph(cliapp.Application):
                                metavar='SIZE',
                                group=group_storage,
                                default='4G')
+        self.settings.bytesize(['chunk-cache-max-size'],
+                               'keep at most SIZE bytes of unpacked chunks in '
+                               'TEMPDIR/chunks, removing the least recently '
+                               'used ones that are not in use when there are '
+                               'more; 0 means no limit (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='0')
         # The cachedir default size of 4G comes from twice the size of the
         # largest system artifact.
         # It's twice the size because it needs space for all the chunks that
@@ -198,6 +258,13 @@ class Morph(cliapp.Application):
                                metavar='SIZE',
                                group=group_storage,
                                default='4G')
+        self.settings.choice(['artifact-cache-backend'],
+                             ['plain', 'dedup'],
+                             'how to store artifacts in CACHEDIR/artifacts: '
+                             '`plain` files, or `dedup` to store chunks as '
+                             'manifests of files kept once in CACHEDIR/blobs '
+                             '(default: plain)',
+                             group=group_storage)
 
     def check_time(self):
         # Check that the current time is not far in the past.
@@ -264,6 +331,7 @@ class Morph(cliapp.Application):
 
         tmpdir = self.settings['tempdir']
         for required_dir in (os.path.join(tmpdir, 'chunks'),
+                             os.path.join(tmpdir, 'ldconfig'),
                              os.path.join(tmpdir, 'staging'),
                              os.path.join(tmpdir, 'failed'),
                              os.path.join(tmpdir, 'deployments'),
@@ -0,0 +1,138 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import Queue
+import shutil
+import threading
+
+import morphlib
+
+
+class ArtifactPrefetcher(object):
+
+    '''Fetch many artifacts from a remote artifact cache at once.
+
+    Artifacts are copied into the local artifact cache by several worker
+    threads in parallel, each using its own persistent connection to the
+    remote cache (see ``RemoteArtifactCache.connection``).
+
+    An artifact and the metadata files requested with it are fetched as
+    a group: if any of them is missing from the remote cache, or fails to
+    transfer, every file of the group is aborted, so the local cache
+    never has an artifact without its metadata.
+
+    '''
+
+    def __init__(self, lac, rac, connections=4):
+        self.lac = lac
+        self.rac = rac
+        self.connections = max(connections, 1)
+
+    def fetch(self, requests):
+        '''Fetch artifacts and their metadata into the local cache.
+
+        ``requests`` is an iterable of ``(artifact, metadata_names)``
+        pairs. Files that are already in the local cache are skipped.
+
+        Return the list of artifacts that could not be fetched because
+        the remote cache does not have them. Any other error is raised
+        once every worker has stopped.
+
+        '''
+
+        groups = []
+        seen = set()
+        for artifact, metadata_names in requests:
+            if artifact in seen:
+                continue
+            seen.add(artifact)
+            files = []
+            if not self.lac.has(artifact):
+                files.append(None)
+            for name in metadata_names:
+                if not self.lac.has_artifact_metadata(artifact, name):
+                    files.append(name)
+            if files:
+                groups.append((artifact, files))
+
+        if not groups:
+            return []
+
+        queue = Queue.Queue()
+        for group in groups:
+            queue.put(group)
+
+        missing = []
+        errors = []
+        workers = [threading.Thread(target=self._worker,
+                                    args=(queue, missing, errors))
+                   for i in xrange(min(self.connections, len(groups)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if errors:
+            raise errors[0]
+        return missing
+
+    def _worker(self, queue, missing, errors):
+        conn = self.rac.connection()
+        try:
+            while not errors:
+                try:
+                    artifact, files = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    self._fetch_group(conn, artifact, files)
+                except morphlib.remoteartifactcache.GetError:
+                    missing.append(artifact)
+                except BaseException, e:
+                    logging.exception('Fetching %s failed' %
+                                      artifact.basename())
+                    errors.append(e)
+        finally:
+            conn.close()
+
+    def _fetch_group(self, conn, artifact, files):
+        '''Fetch the files of one artifact atomically.'''
+
+        fetched = []
+        try:
+            for name in files:
+                if name is None:
+                    remote = conn.get(artifact)
+                    local = self.lac.put(artifact)
+                else:
+                    remote = conn.get_artifact_metadata(artifact, name)
+                    local = self.lac.put_artifact_metadata(artifact, name)
+                fetched.append(local)
+                try:
+                    shutil.copyfileobj(remote, local)
+                finally:
+                    remote.close()
+        except BaseException:
+            for local in fetched:
+                local.abort()
+            raise
+        else:
+            for local in fetched:
+                local.close()
+            logging.debug('Fetched %s to the local cache' %
+                          artifact.basename())
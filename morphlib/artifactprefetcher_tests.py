@@ -0,0 +1,158 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import StringIO
+import unittest
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def basename(self):
+        return self.name
+
+    def metadata_basename(self, metadata_name):
+        return '%s.%s' % (self.name, metadata_name)
+
+
+class FakeSaveFile(StringIO.StringIO):
+
+    def __init__(self, cache, filename):
+        StringIO.StringIO.__init__(self)
+        self.cache = cache
+        self.filename = filename
+
+    def close(self):
+        self.cache.files[self.filename] = self.getvalue()
+
+    def abort(self):
+        self.cache.aborted.append(self.filename)
+
+
+class FakeLocalArtifactCache(object):
+
+    def __init__(self):
+        self.files = {}
+        self.aborted = []
+
+    def has(self, artifact):
+        return artifact.basename() in self.files
+
+    def has_artifact_metadata(self, artifact, name):
+        return artifact.metadata_basename(name) in self.files
+
+    def put(self, artifact):
+        return FakeSaveFile(self, artifact.basename())
+
+    def put_artifact_metadata(self, artifact, name):
+        return FakeSaveFile(self, artifact.metadata_basename(name))
+
+
+class FakeRemoteArtifactCache(object):
+
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.connections = 0
+        self.closed = 0
+
+    def connection(self):
+        self.connections += 1
+        return self
+
+    def close(self):
+        self.closed += 1
+
+    def _get(self, artifact, filename):
+        if filename not in self.filenames:
+            raise morphlib.remoteartifactcache.GetError(self, artifact)
+        return StringIO.StringIO('data of %s' % filename)
+
+    def get(self, artifact):
+        return self._get(artifact, artifact.basename())
+
+    def get_artifact_metadata(self, artifact, name):
+        return self._get(artifact, artifact.metadata_basename(name))
+
+
+class ArtifactPrefetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lac = FakeLocalArtifactCache()
+        self.rac = FakeRemoteArtifactCache(
+            set(['a', 'a.meta', 'b', 'c', 'd']))
+        self.prefetcher = morphlib.artifactprefetcher.ArtifactPrefetcher(
+            self.lac, self.rac, connections=2)
+        self.a, self.b, self.c, self.d, self.e = (
+            FakeArtifact(n) for n in 'abcde')
+
+    def test_fetches_artifacts_and_metadata(self):
+        missing = self.prefetcher.fetch([(self.a, ['meta']), (self.b, []),
+                                         (self.c, []), (self.d, [])])
+        self.assertEqual(missing, [])
+        self.assertEqual(sorted(self.lac.files),
+                         ['a', 'a.meta', 'b', 'c', 'd'])
+        self.assertEqual(self.lac.files['a.meta'], 'data of a.meta')
+
+    def test_uses_no_more_connections_than_asked_for(self):
+        self.prefetcher.fetch([(self.a, []), (self.b, []), (self.c, [])])
+        self.assertEqual(self.rac.connections, 2)
+        self.assertEqual(self.rac.closed, 2)
+
+    def test_skips_locally_cached_files(self):
+        self.lac.files['a'] = 'local a'
+        self.prefetcher.fetch([(self.a, ['meta'])])
+        self.assertEqual(self.lac.files['a'], 'local a')
+        self.assertTrue('a.meta' in self.lac.files)
+
+    def test_does_not_connect_when_everything_is_local(self):
+        self.lac.files['a'] = 'local a'
+        self.assertEqual(self.prefetcher.fetch([(self.a, [])]), [])
+        self.assertEqual(self.rac.connections, 0)
+
+    def test_reports_missing_artifacts(self):
+        missing = self.prefetcher.fetch([(self.b, []), (self.e, [])])
+        self.assertEqual(missing, [self.e])
+        self.assertTrue('b' in self.lac.files)
+
+    def test_aborts_artifact_when_metadata_is_missing(self):
+        missing = self.prefetcher.fetch([(self.b, ['meta'])])
+        self.assertEqual(missing, [self.b])
+        self.assertFalse('b' in self.lac.files)
+        self.assertEqual(self.lac.aborted, ['b'])
+
+    def test_raises_other_errors(self):
+        def broken_get(artifact):
+            raise IOError('connection lost')
+        self.rac.get = broken_get
+        self.assertRaises(IOError, self.prefetcher.fetch, [(self.a, [])])
+        self.assertEqual(self.lac.files, {})
+
+    def test_closes_remote_file_when_copying_fails(self):
+        class BrokenFile(object):
+            closed = False
+            def read(self, *args):
+                raise IOError('connection lost')
+            def close(self):
+                self.closed = True
+        remote = BrokenFile()
+        self.rac.get = lambda artifact: remote
+        self.assertRaises(IOError, self.prefetcher.fetch, [(self.a, [])])
+        self.assertTrue(remote.closed)
+        self.assertEqual(self.lac.aborted, ['a'])
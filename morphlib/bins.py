@@ -22,15 +22,21 @@ Binaries are chunks, strata, and system images.
 
 
 import cliapp
+import contextlib
+import grp
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import pwd
 import sys
 import re
 import errno
 import stat
 import shutil
+import subprocess
 import tarfile
 
+import morphcacheserver.chunkmanifest
 import morphlib
 
 from morphlib.extractedtarball import ExtractedTarball
@@ -79,10 +85,282 @@ if sys.version_info < (2, 7, 3): # pragma: no cover
                 raise ExtractError("could not change owner")
     tarfile.TarFile.chown = fixed_chown
 
-def create_chunk(rootdir, f, include, dump_memory_profile=None):
+# Compressed binaries are written and read by piping them through these
+# commands, which use every CPU. They are recognised by their magic
+# numbers, so uncompressed binaries can still be read.
+COMPRESSION_FORMATS = ('none', 'zstd', 'xz')
+_COMPRESS_COMMANDS = {
+    'zstd': ['zstd', '-q', '-T0', '-c'],
+    'xz': ['xz', '-q', '-T0', '-c'],
+}
+_DECOMPRESS_COMMANDS = {
+    'zstd': ['zstd', '-q', '-d', '-c'],
+    'xz': ['xz', '-q', '-d', '-c'],
+}
+_MAGIC_NUMBERS = (
+    ('zstd', '\x28\xb5\x2f\xfd'),
+    ('xz', '\xfd7zXZ\x00'),
+)
+
+
+class CompressionError(cliapp.AppException):
+
+    def __init__(self, argv, returncode):
+        cliapp.AppException.__init__(
+            self, 'Command %s failed with exit code %d' %
+            (' '.join(argv), returncode))
+
+
+def detect_compression(f):
+    '''Return the compression format of the binary in open file ``f``.
+
+    The file position is left unchanged.
+
+    '''
+
+    pos = f.tell()
+    head = f.read(max(len(magic) for name, magic in _MAGIC_NUMBERS))
+    f.seek(pos)
+    for name, magic in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return name
+    return 'none'
+
+
+@contextlib.contextmanager
+def compressed_writer(f, compression):
+    '''Write to open file ``f`` through a compressor.
+
+    This is a context manager giving a file object to write the
+    uncompressed data to. With the ``none`` format, that is ``f`` itself.
+
+    '''
+
+    if compression in (None, 'none'):
+        yield f
+        return
+
+    argv = _COMPRESS_COMMANDS[compression]
+    f.flush()
+    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=f,
+                         close_fds=True)
+    try:
+        yield p.stdin
+    except BaseException:
+        p.stdin.close()
+        p.wait()
+        raise
+    p.stdin.close()
+    if p.wait() != 0:
+        raise CompressionError(argv, p.returncode)
+
+
+@contextlib.contextmanager
+def _decompressed(f):
+    '''Give a tarfile mode and file object for reading a binary.'''
+
+    compression = detect_compression(f)
+    if compression == 'none':
+        yield 'r', f
+        return
+
+    argv = _DECOMPRESS_COMMANDS[compression]
+    # The decompressor reads from the file descriptor, whose position may
+    # be beyond what was read from ``f`` because of buffering.
+    os.lseek(f.fileno(), f.tell(), os.SEEK_SET)
+    p = subprocess.Popen(argv, stdin=f, stdout=subprocess.PIPE,
+                         close_fds=True)
+    try:
+        yield 'r|', p.stdout
+    except BaseException:
+        p.stdout.close()
+        p.wait()
+        raise
+    # Drain the pipe, tarfile need not read the end-of-archive padding.
+    while p.stdout.read(tarfile.RECORDSIZE):
+        pass
+    p.stdout.close()
+    if p.wait() != 0:
+        raise CompressionError(argv, p.returncode)
+
+
+@contextlib.contextmanager
+def open_binary(f, errorlevel=1):
+    '''Open a binary, compressed or not, as a ``tarfile.TarFile``.
+
+    Compressed binaries can only be read sequentially.
+
+    '''
+
+    with _decompressed(f) as (mode, fileobj):
+        tf = tarfile.open(fileobj=fileobj, mode=mode, errorlevel=errorlevel)
+        try:
+            yield tf
+        finally:
+            tf.close()
+
+
+# Files are read ahead of the tar writer by this many threads, in batches
+# of this many files. Files up to ``_SMALL_FILE_SIZE`` bytes are read into
+# memory by the readers, larger files are streamed in ``_COPY_BUFSIZE``
+# pieces by the writer.
+_READER_THREADS = 4
+_READ_BATCH = 256
+_SMALL_FILE_SIZE = 64 * 1024
+_COPY_BUFSIZE = 1024 * 1024
+
+
+def _read_chunk_entry(filename):
+    '''Collect what create_chunk needs to know about one file.'''
+
+    st = os.lstat(filename)
+    linkname = ''
+    data = None
+    if stat.S_ISLNK(st.st_mode):
+        linkname = os.readlink(filename)
+    elif stat.S_ISREG(st.st_mode) and st.st_size <= _SMALL_FILE_SIZE:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    return st, linkname, data
+
+
+def _chunk_tarinfo(relname, st, linkname, inodes, names, mtime):
+    '''Create a TarInfo, like TarFile.gettarinfo, from an lstat result.
+
+    ``inodes`` maps the inodes of regular files already in the tarball to
+    their names, so further links to them are stored as hardlinks.
+    ``names`` caches user and group names.
+
+    '''
+
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        inode = (st.st_ino, st.st_dev)
+        if st.st_nlink > 1 and inode in inodes:
+            tartype = tarfile.LNKTYPE
+            linkname = inodes[inode]
+        else:
+            tartype = tarfile.REGTYPE
+            if inode[0]:
+                inodes[inode] = relname
+    elif stat.S_ISDIR(mode):
+        tartype = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        tartype = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        tartype = tarfile.SYMTYPE
+    elif stat.S_ISCHR(mode):
+        tartype = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        tartype = tarfile.BLKTYPE
+    else:
+        raise IOError('Cannot add %s to a chunk. Unsupported type.' % relname)
+
+    def lookup(key, function):
+        if key not in names:
+            try:
+                names[key] = function(key[1])[0]
+            except KeyError:
+                names[key] = ''
+        return names[key]
+
+    tarinfo = tarfile.TarInfo(relname)
+    tarinfo.mode = mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.size = st.st_size if tartype == tarfile.REGTYPE else 0
+    tarinfo.mtime = mtime
+    tarinfo.type = tartype
+    tarinfo.linkname = linkname
+    tarinfo.uname = lookup(('u', st.st_uid), pwd.getpwuid)
+    tarinfo.gname = lookup(('g', st.st_gid), grp.getgrgid)
+    if tartype in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    return tarinfo
+
+
+def _copy_file_data(filename, f, size):
+    '''Copy exactly ``size`` bytes of a file, in large pieces.'''
+
+    with open(filename, 'rb') as src:
+        remaining = size
+        while remaining > 0:
+            buf = src.read(min(remaining, _COPY_BUFSIZE))
+            if not buf:
+                raise IOError('%s changed size while creating chunk' %
+                              filename)
+            f.write(buf)
+            remaining -= len(buf)
+
+
+def _write_chunk_tar(f, batches, mtime):
+    '''Write a tar file of batches of ``(relname, filename)`` pairs.
+
+    Return ``(filename, is_dir)`` for every file added.
+
+    '''
+
+    inodes = {}
+    names = {}
+    added = []
+    offset = 0
+    pool = ThreadPool(_READER_THREADS)
+    try:
+        pending = None
+        if batches:
+            pending = pool.map_async(_read_chunk_entry,
+                                     [x[1] for x in batches[0]])
+        for i, batch in enumerate(batches):
+            entries = pending.get()
+            if i + 1 < len(batches):
+                pending = pool.map_async(_read_chunk_entry,
+                                         [x[1] for x in batches[i + 1]])
+            for (relname, filename), (st, linkname, data) in \
+                    zip(batch, entries):
+                tarinfo = _chunk_tarinfo(relname, st, linkname, inodes,
+                                         names, mtime)
+                buf = tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING,
+                                    'strict')
+                f.write(buf)
+                offset += len(buf)
+                if tarinfo.isreg():
+                    if data is not None and len(data) == tarinfo.size:
+                        f.write(data)
+                    else:
+                        _copy_file_data(filename, f, tarinfo.size)
+                    blocks, remainder = divmod(tarinfo.size,
+                                               tarfile.BLOCKSIZE)
+                    if remainder > 0:
+                        f.write(tarfile.NUL *
+                                (tarfile.BLOCKSIZE - remainder))
+                        blocks += 1
+                    offset += blocks * tarfile.BLOCKSIZE
+                added.append((filename, stat.S_ISDIR(st.st_mode)))
+    finally:
+        pool.close()
+        pool.join()
+
+    # End of archive marker, padded to a whole record like TarFile does.
+    f.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+    offset += tarfile.BLOCKSIZE * 2
+    blocks, remainder = divmod(offset, tarfile.RECORDSIZE)
+    if remainder > 0:
+        f.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+    return added
+
+
+def create_chunk(rootdir, f, include, dump_memory_profile=None,
+                 compression='none'):
     '''Create a chunk from the contents of a directory.
     
-    ``f`` is an open file handle, to which the tar file is written.
+    ``f`` is an open file handle, to which the tar file is written,
+    compressed with the format named by ``compression``.
+
+    The tar file is written directly rather than with ``tarfile.TarFile``.
+    While one batch of files is written, the next batch is stat()ed and,
+    for small files, read by a pool of threads, so the writer rarely
+    waits for the disk.
 
     '''
 
@@ -98,120 +376,212 @@ def create_chunk(rootdir, f, include, dump_memory_profile=None):
     
     path_pairs = [(relname, os.path.join(rootdir, relname))
                   for relname in include]
-    tar = tarfile.open(fileobj=f, mode='w')
-    for relname, filename in path_pairs:
-        # Normalize mtime for everything.
-        tarinfo = tar.gettarinfo(filename,
-                                 arcname=relname)
-        tarinfo.ctime = normalized_timestamp
-        tarinfo.mtime = normalized_timestamp
-        if tarinfo.isreg():
-            with open(filename, 'rb') as f:
-                tar.addfile(tarinfo, fileobj=f)
-        else:
-            tar.addfile(tarinfo)
-    tar.close()
+    batches = [path_pairs[i:i + _READ_BATCH]
+               for i in xrange(0, len(path_pairs), _READ_BATCH)]
 
-    for relname, filename in reversed(path_pairs):
-        if os.path.isdir(filename) and not os.path.islink(filename):
-            continue
-        else:
+    with compressed_writer(f, compression) as out:
+        added = _write_chunk_tar(out, batches, normalized_timestamp)
+
+    for filename, is_dir in reversed(added):
+        if not is_dir:
             os.remove(filename)
     dump_memory_profile('after removing in create_chunks')
 
 
-def unpack_binary_from_file(f, dirname):  # pragma: no cover
-    '''Unpack a binary into a directory.
+def _follow_symlink(path):  # pragma: no cover
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
 
-    The directory must exist already.
 
-    '''
+def _prepare_extract(tarinfo, targetpath):  # pragma: no cover
+    '''Prepare to extract a tar file member onto targetpath?
 
-    # This is evil, but necessary. For some reason Python's system
-    # call wrappers (os.mknod and such) do not (always?) set the
-    # filename attribute of the OSError exception they raise. We
-    # fix that by monkey patching the tf instance with wrappers
-    # for the relevant methods to add things. The wrapper further
-    # ignores EEXIST errors, since we do not (currently!) care about
-    # overwriting files.
+    If the target already exist, and we can live with it or
+    remove it, we do so. Otherwise, raise an error.
 
-    def follow_symlink(path):  # pragma: no cover
-        try:
-            return os.stat(path)
-        except OSError:
-            return None
+    It's OK to extract if:
+
+    * the target does not exist
+    * the member is a directory a directory and the
+      target is a directory or a symlink to a directory
+      (just extract, no need to remove)
+    * the member is not a directory, and the target is not a directory
+      or a symlink to a directory (remove target, then extract)
 
-    def prepare_extract(tarinfo, targetpath):  # pragma: no cover
-        '''Prepare to extract a tar file member onto targetpath?
+    '''
+
+    try:
+        existing = os.lstat(targetpath)
+    except OSError:
+        return True  # target does not exist
+
+    if tarinfo.isdir():
+        if stat.S_ISDIR(existing.st_mode):
+            return True
+        elif stat.S_ISLNK(existing.st_mode):
+            st = _follow_symlink(targetpath)
+            return st and stat.S_ISDIR(st.st_mode)
+    else:
+        if stat.S_ISDIR(existing.st_mode):
+            return False
+        elif stat.S_ISLNK(existing.st_mode):
+            st = _follow_symlink(targetpath)
+            if st and not stat.S_ISDIR(st.st_mode):
+                os.remove(targetpath)
+                return True
+        else:
+            os.remove(targetpath)
+            return True
+    return False
 
-        If the target already exist, and we can live with it or
-        remove it, we do so. Otherwise, raise an error.
 
-        It's OK to extract if:
+class Extractor(object):
 
-        * the target does not exist
-        * the member is a directory a directory and the
-          target is a directory or a symlink to a directory
-          (just extract, no need to remove)
-        * the member is not a directory, and the target is not a directory
-          or a symlink to a directory (remove target, then extract)
+    '''Extract the members of a tar stream into a directory.
 
-        '''
+    This does what ``tarfile.TarFile.extractall`` does, in a single
+    pass over the stream, but with fewer system calls: directories that
+    are known to exist are not checked again, file data is copied in
+    large pieces, and owner and group names are looked up once.
 
-        try:
-            existing = os.lstat(targetpath)
-        except OSError:
-            return True  # target does not exist
+    ``extract_all`` takes a ``tarfile.TarFile`` or any iterable of
+    ``tarfile.TarInfo`` objects. Subclasses can override ``write_file``
+    to get the contents of regular files from somewhere else.
 
-        if tarinfo.isdir():
-            if stat.S_ISDIR(existing.st_mode):
-                return True
-            elif stat.S_ISLNK(existing.st_mode):
-                st = follow_symlink(targetpath)
-                return st and stat.S_ISDIR(st.st_mode)
-        else:
-            if stat.S_ISDIR(existing.st_mode):
-                return False
-            elif stat.S_ISLNK(existing.st_mode):
-                st = follow_symlink(targetpath)
-                if st and not stat.S_ISDIR(st.st_mode):
-                    os.remove(targetpath)
-                    return True
-            else:
-                os.remove(targetpath)
-                return True
-        return False
+    '''
 
-    def monkey_patcher(real):
-        def make_something(tarinfo, targetpath):  # pragma: no cover
-            prepare_extract(tarinfo, targetpath)
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.is_root = hasattr(os, 'geteuid') and os.geteuid() == 0
+        self.known_dirs = set()
+        self.ids = {}
+
+    def extract_all(self, tf):
+        directories = []
+        for tarinfo in tf:
+            targetpath = os.path.join(self.dirname, tarinfo.name).rstrip('/')
+            self._make_parents(targetpath)
+            # The target is replaced if possible. Otherwise the error
+            # from creating the member tells the user what went wrong.
+            _prepare_extract(tarinfo, targetpath)
             try:
-                ret = real(tarinfo, targetpath)
+                self._make(tf, tarinfo, targetpath)
             except (IOError, OSError), e:
+                # EEXIST is ignored, since we do not (currently!) care
+                # about overwriting files. For some reason Python's system
+                # call wrappers (os.mknod and such) do not (always?) set
+                # the filename attribute of the OSError exception they
+                # raise, so it is added here.
                 if e.errno != errno.EEXIST:
                     if e.filename is None:
                         e.filename = targetpath
                     raise
+            if tarinfo.isdir():
+                # Like extractall, set directory attributes last, deepest
+                # first, so that extracting into them is not affected.
+                directories.append((tarinfo, targetpath))
             else:
-                return ret
-        return make_something
+                self.set_attributes(tarinfo, targetpath)
 
-    tf = tarfile.open(fileobj=f, errorlevel=2)
-    tf.makedir = monkey_patcher(tf.makedir)
-    tf.makefile = monkey_patcher(tf.makefile)
-    tf.makeunknown = monkey_patcher(tf.makeunknown)
-    tf.makefifo = monkey_patcher(tf.makefifo)
-    tf.makedev = monkey_patcher(tf.makedev)
-    tf.makelink = monkey_patcher(tf.makelink)
+        directories.sort(key=lambda x: x[0].name, reverse=True)
+        for tarinfo, targetpath in directories:
+            self.set_attributes(tarinfo, targetpath)
+
+    def _make_parents(self, targetpath):
+        upperdir = os.path.dirname(targetpath)
+        if upperdir in self.known_dirs:
+            return
+        if upperdir and not os.path.exists(upperdir):
+            os.makedirs(upperdir)
+        self.known_dirs.add(upperdir)
+
+    def _make(self, tf, tarinfo, targetpath):
+        if tarinfo.isdir():
+            os.mkdir(targetpath, 0700)
+        elif tarinfo.issym():
+            os.symlink(tarinfo.linkname, targetpath)
+        elif tarinfo.islnk():
+            os.link(os.path.join(self.dirname, tarinfo.linkname), targetpath)
+        elif tarinfo.isfifo():
+            os.mkfifo(targetpath)
+        elif tarinfo.ischr() or tarinfo.isblk():
+            mode = tarinfo.mode & 07777
+            mode |= stat.S_IFCHR if tarinfo.ischr() else stat.S_IFBLK
+            os.mknod(targetpath, mode,
+                     os.makedev(tarinfo.devmajor, tarinfo.devminor))
+        else:
+            # Regular files, and unknown types as tarfile does.
+            self.write_file(tf, tarinfo, targetpath)
+
+    def write_file(self, tf, tarinfo, targetpath):
+        src = tf.extractfile(tarinfo)
+        with open(targetpath, 'wb') as dst:
+            remaining = tarinfo.size
+            while remaining > 0:
+                buf = src.read(min(remaining, _COPY_BUFSIZE))
+                if not buf:
+                    raise tarfile.ReadError('unexpected end of data')
+                dst.write(buf)
+                remaining -= len(buf)
+
+    def _lookup_id(self, kind, name, default):
+        key = (kind, name)
+        if key not in self.ids:
+            try:
+                if kind == 'u':
+                    self.ids[key] = pwd.getpwnam(name)[2]
+                else:
+                    self.ids[key] = grp.getgrnam(name)[2]
+            except KeyError:
+                self.ids[key] = None
+        if self.ids[key] is None:
+            return default
+        return self.ids[key]
+
+    def set_attributes(self, tarinfo, targetpath):
+        if self.is_root:
+            uid = self._lookup_id('u', tarinfo.uname, tarinfo.uid)
+            gid = self._lookup_id('g', tarinfo.gname, tarinfo.gid)
+            if tarinfo.issym():
+                os.lchown(targetpath, uid, gid)
+            else:
+                os.chown(targetpath, uid, gid)
+        if not tarinfo.issym():
+            os.chmod(targetpath, tarinfo.mode & 07777)
+            os.utime(targetpath, (tarinfo.mtime, tarinfo.mtime))
 
-    try:
-        tf.extractall(path=dirname)
-    finally:
-        tf.close()
+
+def unpack_binary_from_file(f, dirname):  # pragma: no cover
+    '''Unpack a binary, compressed or not, into a directory.
+
+    The directory must exist already.
+
+    Existing files are replaced, but existing directories and symlinks
+    to directories are kept, so that for example a chunk's ``usr``
+    directory is unpacked into a ``usr`` symlink from another chunk.
+
+    '''
+
+    with _decompressed(f) as (mode, fileobj):
+        tf = tarfile.open(fileobj=fileobj, mode='r|', errorlevel=2,
+                          bufsize=_COPY_BUFSIZE)
+        try:
+            Extractor(dirname).extract_all(tf)
+        finally:
+            tf.close()
 
 
 def unpack_binary(filename, dirname):
-    with open(filename, "rb") as f:
+    '''Unpack a binary file into a directory.
+
+    The file may be a chunk stored as a manifest by the 'dedup' artifact
+    cache backend, in which case the chunk is rebuilt from its blobs.
+
+    '''
+
+    with morphcacheserver.chunkmanifest.open_artifact(filename) as f:
         unpack_binary_from_file(f, dirname)
 
 
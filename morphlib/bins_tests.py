@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import distutils.spawn
 import gzip
 import os
 import shutil
@@ -135,12 +136,52 @@ class ChunkTests(BinsTest):
         self.assertEqual([x for x, y in self.recursive_lstat(self.instdir)],
                          ['.', 'bin', 'lib', 'lib/libfoo.so'])
 
+    def test_stores_hardlinks_symlinks_and_large_files(self):
+        self.populate_instdir()
+        big = os.path.join(self.instdir, 'lib', 'big')
+        with open(big, 'w') as f:
+            f.write('x' * (morphlib.bins._SMALL_FILE_SIZE * 3 + 1))
+        os.link(big, os.path.join(self.instdir, 'lib', 'big.link'))
+        os.symlink('big', os.path.join(self.instdir, 'lib', 'big.sym'))
+        morphlib.bins.create_chunk(
+            self.instdir, self.chunk_f,
+            ['lib', 'lib/big', 'lib/big.link', 'lib/big.sym'])
+        self.chunk_f.close()
+        with tarfile.open(self.chunk_file) as tf:
+            members = dict((m.name, m) for m in tf.getmembers())
+            self.assertEqual(tf.extractfile('lib/big').read(),
+                             'x' * (morphlib.bins._SMALL_FILE_SIZE * 3 + 1))
+        self.assertTrue(members['lib/big.link'].islnk())
+        self.assertEqual(members['lib/big.link'].linkname, 'lib/big')
+        self.assertTrue(members['lib/big.sym'].issym())
+        self.assertEqual(members['lib/big.sym'].linkname, 'big')
+
     def test_does_not_compress_artifact(self):
         self.create_chunk(['bin'])
         f = gzip.open(self.chunk_file)
         self.assertRaises(IOError, f.read)
         f.close()
 
+    def test_detects_uncompressed_chunk(self):
+        self.create_chunk(['bin'])
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'none')
+            self.assertEqual(f.tell(), 0)
+
+    @unittest.skipUnless(distutils.spawn.find_executable('xz'),
+                         'xz is not installed')
+    def test_creates_and_unpacks_compressed_chunk_exactly(self):
+        self.populate_instdir()
+        morphlib.bins.create_chunk(
+            self.instdir, self.chunk_f,
+            ['bin', 'bin/foo', 'lib', 'lib/libfoo.so'], compression='xz')
+        self.chunk_f.close()
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'xz')
+        self.unpack_chunk()
+        self.assertEqual(self.instdir_orig_files,
+                         self.recursive_lstat(self.unpacked))
+
 
 class ExtractTests(unittest.TestCase):
 
@@ -215,3 +256,20 @@ class ExtractTests(unittest.TestCase):
         morphlib.bins.unpack_binary_from_file(dirtar, self.unpacked)
         mode = os.lstat(os.path.join(self.unpacked, 'foo')).st_mode
         self.assertTrue(stat.S_ISREG(mode))
+
+    def test_extracts_hardlinks_and_modes(self):
+        def make_files(basedir):
+            filename = os.path.join(basedir, 'foo')
+            with open(filename, 'w') as f:
+                f.write('foo')
+            os.chmod(filename, 0751)
+            os.link(filename, os.path.join(basedir, 'bar'))
+            return ['bar', 'foo']
+        tar = self.create_chunk(make_files)
+
+        morphlib.bins.unpack_binary_from_file(tar, self.unpacked)
+        st = os.lstat(os.path.join(self.unpacked, 'foo'))
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0751)
+        self.assertEqual(st.st_nlink, 2)
+        with open(os.path.join(self.unpacked, 'bar')) as f:
+            self.assertEqual(f.read(), 'foo')
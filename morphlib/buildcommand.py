@@ -15,8 +15,9 @@
 
 
 import itertools
+import json
 import os
-import shutil
+import signal
 import logging
 import tempfile
 import datetime
@@ -49,6 +50,7 @@ class BuildCommand(object):
         self.app = app
         self.lac, self.rac = self.new_artifact_caches()
         self.lrc, self.rrc = self.new_repo_caches()
+        self.source_cache = morphlib.util.new_source_cache(self.app)
 
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Build a given system morphology.'''
@@ -62,7 +64,16 @@ class BuildCommand(object):
             repo_name, ref, filename, original_ref)
         self.validate_sources(srcpool)
         root_artifact = self.resolve_artifacts(srcpool)
-        self.build_in_order(root_artifact)
+        to_fetch, to_build = self.plan_build(root_artifact)
+        if self.app.settings['dry-run']:
+            self.report_plan(root_artifact, to_fetch, to_build)
+            return
+        if to_fetch:
+            self.prefetch_artifacts(to_fetch)
+        if self.app.settings['parallel-builds'] > 1:
+            self.build_in_parallel(root_artifact)
+        else:
+            self.build_in_order(root_artifact)
 
         self.app.status(
             msg='Build of %(repo_name)s %(ref)s %(filename)s ended '
@@ -98,7 +109,8 @@ class BuildCommand(object):
             self.lrc, self.rrc, repo_name, ref, filename,
             original_ref=original_ref,
             update_repos=not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            source_cache=self.source_cache)
         return srcpool
 
     def validate_sources(self, srcpool):
@@ -165,14 +177,34 @@ class BuildCommand(object):
         build_env = self.new_build_env(arch)
 
         self.app.status(msg='Computing cache keys', chatty=True)
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        memo = morphlib.cachekeycomputer.CacheKeyMemo(
+            os.path.join(self.app.settings['cachedir'], 'cache-keys'))
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(
+            build_env, self.app.settings['artifact-compression'], memo)
 
-        for source in set(a.source for a in root_artifact.walk()):
+        sources = set(a.source for a in root_artifact.walk())
+        for source in sources:
             source.cache_key = ckc.compute_key(source)
             source.cache_id = ckc.get_cache_id(source)
+        memo.save()
+        self._report_cache_key_changes(ckc.changes, len(sources))
 
         root_artifact.build_env = build_env
 
+    def _report_cache_key_changes(self, changes, count):
+        for source, fields in sorted(changes.iteritems(),
+                                     key=lambda x: x[0].name):
+            if fields is None:
+                self.app.status(msg='Cache key of %(name)s computed for the '
+                                'first time', name=source.name, chatty=True)
+            else:
+                self.app.status(msg='Cache key of %(name)s changed because '
+                                'of %(fields)s', name=source.name,
+                                fields=', '.join(fields), chatty=True)
+        self.app.status(msg='%(changed)d of %(count)d cache keys changed '
+                        'since they were last computed',
+                        changed=len(changes), count=count, chatty=True)
+
     def resolve_artifacts(self, srcpool):
         '''Resolve the artifacts that will be built for a set of sources'''
 
@@ -287,13 +319,126 @@ class BuildCommand(object):
 
         self.app.status_prefix = old_prefix
 
-    def cache_or_build_source(self, source, build_env):
-        '''Make artifacts of the built source available in the local cache.
+    def build_in_parallel(self, root_artifact):
+        '''Build independent sources concurrently.
 
-        This can be done by retrieving from a remote artifact cache, or if
-        that doesn't work for some reason, by building the source locally.
+        Each source is built by a forked child process in its own staging
+        area, with at most the number of builds given by the
+        ``parallel-builds`` setting running at once. Each of those builds
+        may run up to ``max-jobs`` jobs itself.
+
+        Fetching git repositories and artifacts is done by the parent
+        process before forking, so the local caches are only ever updated
+        by one process at a time.
+
+        '''
+
+        max_builds = self.app.settings['parallel-builds']
+        self.app.status(msg='Building a set of sources, %(max)d at a time',
+                        max=max_builds, chatty=True)
+        build_env = root_artifact.build_env
+        scheduler = morphlib.buildscheduler.BuildScheduler(
+            self.get_ordered_sources(root_artifact.walk()))
+        running = {}
+        failed = []
+        started = 0
+
+        try:
+            while not scheduler.finished():
+                while (not failed and scheduler.has_ready() and
+                       len(running) < max_builds):
+                    source = scheduler.pop_ready()
+                    started += 1
+                    prefix = '[Build %(index)d/%(total)d] [%(name)s] ' % {
+                        'index': started,
+                        'total': len(scheduler),
+                        'name': source.name,
+                    }
+                    pid = self._start_build(source, build_env, prefix)
+                    if pid is None:
+                        scheduler.mark_done(source)
+                    else:
+                        running[pid] = (source, datetime.datetime.now())
+
+                if not running:
+                    break
+
+                pid, status = os.waitpid(-1, 0)
+                if pid not in running:
+                    continue
+                source, starttime = running.pop(pid)
+                if status == 0:
+                    self.app.status(
+                        msg='Finished building %(kind)s %(name)s '
+                            'in %(duration)s',
+                        kind=source.morphology['kind'], name=source.name,
+                        duration=self._format_elapsed(starttime))
+                    scheduler.mark_done(source)
+                    self._report_cached(source)
+                else:
+                    self.app.status(msg='Building %(kind)s %(name)s failed',
+                                    kind=source.morphology['kind'],
+                                    name=source.name, error=True)
+                    failed.append(source)
+        except BaseException:
+            for pid in running:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError: # pragma: no cover
+                    pass
+            for pid in running:
+                os.waitpid(pid, 0)
+            raise
+
+        if failed:
+            raise morphlib.Error(
+                'Failed to build %s' % ', '.join(s.name for s in failed))
+
+    def _start_build(self, source, build_env, prefix):
+        '''Start building ``source`` in a child process.
+
+        Return the process id of the child, or None if all the artifacts
+        of the source were already available and nothing was started.
+
+        '''
+
+        old_prefix = self.app.status_prefix
+        self.app.status_prefix = old_prefix + prefix
+        try:
+            if self.fetch_cached_artifacts(source):
+                self._report_cached(source)
+                return None
+
+            self.app.status(msg='Building %(kind)s %(name)s',
+                            name=source.name,
+                            kind=source.morphology['kind'])
+            deps = self.fetch_build_inputs(source)
+
+            # Anything buffered now would otherwise be written twice.
+            self.app.output.flush()
+            pid = os.fork()
+            if pid == 0: # pragma: no cover
+                exit_code = 1
+                try:
+                    self.build_from_inputs(source, deps, build_env)
+                    exit_code = 0
+                except BaseException, e:
+                    logging.exception('Building %s failed' % source.name)
+                    self.app.status(msg='%(error)s', error=str(e))
+                finally:
+                    self.app.output.flush()
+                    os._exit(exit_code)
+            return pid
+        finally:
+            self.app.status_prefix = old_prefix
+
+    def fetch_cached_artifacts(self, source):
+        '''Make the artifacts of ``source`` local, if they are cached.
+
+        Return True if every artifact is now in the local artifact cache.
 
         '''
+
         artifacts = source.artifacts.values()
         if self.rac is not None:
             try:
@@ -302,15 +447,27 @@ class BuildCommand(object):
                 # Error is logged by the RemoteArtifactCache object.
                 pass
 
-        if any(not self.lac.has(artifact) for artifact in artifacts):
-            self.build_source(source, build_env)
+        return all(self.lac.has(artifact) for artifact in artifacts)
 
-        for a in artifacts:
+    def _report_cached(self, source):
+        for a in source.artifacts.values():
             self.app.status(msg='%(kind)s %(name)s is cached at %(cachepath)s',
                             kind=source.morphology['kind'], name=a.name,
                             cachepath=self.lac.artifact_filename(a),
                             chatty=(source.morphology['kind'] != "system"))
 
+    def cache_or_build_source(self, source, build_env):
+        '''Make artifacts of the built source available in the local cache.
+
+        This can be done by retrieving from a remote artifact cache, or if
+        that doesn't work for some reason, by building the source locally.
+
+        '''
+        if not self.fetch_cached_artifacts(source):
+            self.build_source(source, build_env)
+
+        self._report_cached(source)
+
     def build_source(self, source, build_env):
         '''Build all artifacts for one source.
 
@@ -323,6 +480,20 @@ class BuildCommand(object):
                         name=source.name,
                         kind=source.morphology['kind'])
 
+        deps = self.fetch_build_inputs(source)
+        self.build_from_inputs(source, deps, build_env)
+
+        self.app.status(msg="Elapsed time %(duration)s",
+                        duration=self._format_elapsed(starttime))
+
+    def fetch_build_inputs(self, source):
+        '''Fetch the git sources and dependency artifacts of ``source``.
+
+        Return the list of artifacts ``source`` depends on, all of which
+        are in the local artifact cache afterwards.
+
+        '''
+
         self.fetch_sources(source)
         # TODO: Make an artifact.walk() that takes multiple root artifacts.
         # as this does a walk for every artifact. This was the status
@@ -330,6 +501,15 @@ class BuildCommand(object):
         # now do better.
         deps = self.get_recursive_deps(source.artifacts.values())
         self.cache_artifacts_locally(deps)
+        return deps
+
+    def build_from_inputs(self, source, deps, build_env):
+        '''Build ``source`` in a new staging area.
+
+        The git sources and the artifacts in ``deps`` must already have
+        been fetched, see ``fetch_build_inputs``.
+
+        '''
 
         use_chroot = False
         setup_mounts = False
@@ -344,7 +524,7 @@ class BuildCommand(object):
             if build_mode not in ['bootstrap', 'staging', 'test']:
                 logging.warning('Unknown build mode %s for chunk %s. '
                                 'Defaulting to staging mode.' %
-                                (build_mode, artifact.name))
+                                (build_mode, source.name))
                 build_mode = 'staging'
 
             if build_mode == 'staging':
@@ -366,11 +546,12 @@ class BuildCommand(object):
         self.build_and_cache(staging_area, source, setup_mounts)
         self.remove_staging_area(staging_area)
 
+    @staticmethod
+    def _format_elapsed(starttime):
         td = datetime.datetime.now() - starttime
         hours, remainder = divmod(int(td.total_seconds()), 60*60)
         minutes, seconds = divmod(remainder, 60)
-        td_string = "%02d:%02d:%02d" % (hours, minutes, seconds)
-        self.app.status(msg="Elapsed time %(duration)s", duration=td_string)
+        return "%02d:%02d:%02d" % (hours, minutes, seconds)
 
     def get_recursive_deps(self, artifacts):
         deps = set()
@@ -420,49 +601,123 @@ class BuildCommand(object):
             self.lrc, source.repo.url,
             source.sha1, done)
 
-    def cache_artifacts_locally(self, artifacts):
-        '''Get artifacts missing from local cache from remote cache.'''
+    def new_prefetcher(self):
+        return morphlib.artifactprefetcher.ArtifactPrefetcher(
+            self.lac, self.rac,
+            self.app.settings['artifact-fetch-connections'])
+
+    @staticmethod
+    def _prefetch_requests(artifacts):
+        for artifact in artifacts:
+            if artifact.source.morphology.needs_artifact_metadata_cached:
+                yield artifact, ('meta',)
+            else:
+                yield artifact, ()
+
+    def plan_build(self, root_artifact):
+        '''Find out what needs fetching and what needs building.
+
+        The remote artifact cache is asked about every artifact missing
+        from the local cache in one request. Return a pair of lists: the
+        artifacts to fetch from the remote cache, and the sources that
+        need to be built, in build order.
 
-        def fetch_files(to_fetch):
-            '''Fetch a set of files atomically.
+        '''
 
-            If an error occurs during the transfer of any files, all downloaded
-            data is deleted, to ensure integrity of the local cache.
+        self.app.status(msg='Checking cache state of artifacts', chatty=True)
+        artifacts = root_artifact.walk()
+        not_local = [a for a in artifacts if not self.lac.has(a)]
 
-            '''
+        remote = {}
+        if self.rac is not None and not_local:
             try:
-                for remote, local in to_fetch:
-                    shutil.copyfileobj(remote, local)
-            except BaseException:
-                for remote, local in to_fetch:
-                    local.abort()
-                raise
+                remote = self.rac.has_many(not_local)
+            except morphlib.remoteartifactcache.HasManyError:
+                # Error is logged by the RemoteArtifactCache object. Try to
+                # fetch everything, and build whatever is not there.
+                remote = dict((a, True) for a in not_local)
+
+        to_build = list(self.get_ordered_sources(
+            a for a in not_local if not remote.get(a)))
+        building = set(to_build)
+        to_fetch = [a for a in not_local
+                    if remote.get(a) and a.source not in building]
+
+        self.app.status(msg='%(fetch)d artifacts to fetch, '
+                            '%(build)d sources to build',
+                        fetch=len(to_fetch), build=len(to_build))
+        return to_fetch, to_build
+
+    def report_plan(self, root_artifact, to_fetch, to_build):
+        '''Show what a build would do, for --dry-run.'''
+
+        history = morphlib.buildplan.BuildTimeHistory(self.lac)
+        plan = morphlib.buildplan.BuildPlan(
+            root_artifact, to_fetch, to_build, history)
+        fmt = morphlib.buildplan.format_seconds
+
+        for source in plan.to_build:
+            seconds, how = plan.estimates[source]
+            if seconds is None:
+                estimate = 'no previous build'
+            elif how == 'cache-key':
+                estimate = fmt(seconds)
             else:
-                for remote, local in to_fetch:
-                    remote.close()
-                    local.close()
+                estimate = '%s, from a build of another version' % (
+                    fmt(seconds))
+            self.app.status(msg='Would build %(kind)s %(name)s '
+                                '(%(estimate)s)',
+                            kind=source.morphology['kind'],
+                            name=source.name, estimate=estimate)
+        for name, seconds in sorted(plan.strata_seconds.iteritems()):
+            self.app.status(msg='Stratum %(name)s: %(time)s',
+                            name=name, time=fmt(seconds))
+        self.app.status(msg='Critical path: %(path)s',
+                        path=' -> '.join(s.name for s in plan.critical_path))
+        self.app.status(msg='Expected build time: %(total)s in total, '
+                            '%(critical)s along the critical path',
+                        total=fmt(plan.total_seconds),
+                        critical=fmt(plan.critical_path_seconds))
+        if plan.unknown:
+            self.app.status(msg='%(count)d sources have never been built '
+                                'and are not counted',
+                            count=len(plan.unknown))
+
+        if self.app.settings['plan-file']:
+            with morphlib.savefile.SaveFile(
+                    self.app.settings['plan-file'], 'w') as f:
+                json.dump(plan.as_dict(), f, indent=4, sort_keys=True)
+                f.write('\n')
+
+    def prefetch_artifacts(self, artifacts):
+        '''Fetch artifacts from the remote cache before building.
+
+        This happens once the cache keys are known and before anything
+        is built, so the build is not held up by fetching one artifact
+        at a time just before each source is built.
 
-        for artifact in artifacts:
-            # This block should fetch all artifact files in one go, using the
-            # 1.0/artifacts method of morph-cache-server. The code to do that
-            # needs bringing in from the distbuild.worker_build_connection
-            # module into morphlib.remoteartififactcache first.
-            to_fetch = []
-            if not self.lac.has(artifact):
-                to_fetch.append((self.rac.get(artifact),
-                                 self.lac.put(artifact)))
+        '''
 
-            if artifact.source.morphology.needs_artifact_metadata_cached:
-                if not self.lac.has_artifact_metadata(artifact, 'meta'):
-                    to_fetch.append((
-                        self.rac.get_artifact_metadata(artifact, 'meta'),
-                        self.lac.put_artifact_metadata(artifact, 'meta')))
+        self.app.status(msg='Fetching %(count)d artifacts from %(cache)s',
+                        count=len(artifacts), cache=self.rac)
+        missing = self.new_prefetcher().fetch(
+            self._prefetch_requests(artifacts))
+        for artifact in missing:
+            self.app.status(msg='Failed to fetch %(name)s, it will be built',
+                            name=artifact.name)
+
+    def cache_artifacts_locally(self, artifacts):
+        '''Get artifacts missing from local cache from remote cache.
 
-            if len(to_fetch) > 0:
-                self.app.status(
-                    msg='Fetching to local cache: artifact %(name)s',
-                    name=artifact.name)
-                fetch_files(to_fetch)
+        Each artifact is fetched atomically with its metadata. If any
+        artifact is not available, GetError is raised.
+
+        '''
+
+        missing = self.new_prefetcher().fetch(
+            self._prefetch_requests(artifacts))
+        if missing:
+            raise morphlib.remoteartifactcache.GetError(self.rac, missing[0])
 
     def create_staging_area(self, build_env, use_chroot=True, extra_env={},
                             extra_path=[]):
@@ -513,12 +768,14 @@ class BuildCommand(object):
 
         '''
 
+        installed = []
         for artifact in artifacts:
             if artifact.source.morphology['kind'] != 'chunk':
                 continue
             if artifact.source.build_mode == 'bootstrap':
                if not self.in_same_stratum(artifact.source, target_source):
                     continue
+            installed.append(artifact.basename())
             self.app.status(
                 msg='Installing chunk %(chunk_name)s from cache %(cache)s',
                 chunk_name=artifact.name,
@@ -526,9 +783,13 @@ class BuildCommand(object):
                 chatty=True)
             handle = self.lac.get(artifact)
             staging_area.install_artifact(handle)
+        staging_area.finish_installing()
 
         if target_source.build_mode == 'staging':
-            morphlib.builder.ldconfig(self.app.runcmd, staging_area.dirname)
+            morphlib.builder.cached_ldconfig(
+                self.app.runcmd, staging_area.dirname,
+                os.path.join(self.app.settings['tempdir'], 'ldconfig'),
+                installed)
 
     def build_and_cache(self, staging_area, source, setup_mounts):
         '''Build a source and put its artifacts into the local cache.'''
@@ -556,6 +817,11 @@ class InitiatorBuildCommand(BuildCommand):
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Initiate a distributed build on a controller'''
 
+        if self.app.settings['dry-run']:
+            # Plan against the caches, as a local build would.
+            return super(InitiatorBuildCommand, self).build(
+                repo_name, ref, filename, original_ref)
+
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
 
         if self.addr == '':
@@ -17,6 +17,7 @@
 from collections import defaultdict
 import datetime
 import errno
+import hashlib
 import json
 import logging
 import os
@@ -28,6 +29,7 @@ import time
 import traceback
 import subprocess
 import tempfile
+import threading
 import gzip
 
 import cliapp
@@ -106,52 +108,136 @@ def ldconfig(runcmd, rootdir):  # pragma: no cover
 
     '''
 
-    # FIXME: use the version in ROOTDIR, since even in
-    # bootstrap it will now always exist due to being part of build-essential
-
     conf = os.path.join(rootdir, 'etc', 'ld.so.conf')
     if os.path.exists(conf):
         logging.debug('Running ldconfig for %s' % rootdir)
-        cache = os.path.join(rootdir, 'etc', 'ld.so.cache')
-
-        # The following trickery with $PATH is necessary during the Baserock
-        # bootstrap build: we are not guaranteed that PATH contains the
-        # directory (/sbin conventionally) that ldconfig is in. Then again,
-        # it might, and if so, we don't want to hardware a particular
-        # location. So we add the possible locations to the end of $PATH
-        env = dict(os.environ)
-        old_path = env['PATH']
-        env['PATH'] = '%s:/sbin:/usr/sbin:/usr/local/sbin' % old_path
-        runcmd(['ldconfig', '-r', rootdir], env=env)
+        _run_ldconfig(runcmd, rootdir)
     else:
         logging.debug('No %s, not running ldconfig' % conf)
 
 
-def download_depends(constituents, lac, rac, metadatas=None):
-    for constituent in constituents:
-        if not lac.has(constituent):
-            source = rac.get(constituent)
-            target = lac.put(constituent)
-            shutil.copyfileobj(source, target)
-            target.close()
-            source.close()
-        if metadatas is not None:
-            for metadata in metadatas:
-                if not lac.has_artifact_metadata(constituent, metadata):
-                    if rac.has_artifact_metadata(constituent, metadata):
-                        src = rac.get_artifact_metadata(constituent, metadata)
-                        dst = lac.put_artifact_metadata(constituent, metadata)
-                        shutil.copyfileobj(src, dst)
-                        dst.close()
-                        src.close()
+def _run_ldconfig(runcmd, rootdir, *args):  # pragma: no cover
+    # FIXME: use the version in ROOTDIR, since even in
+    # bootstrap it will now always exist due to being part of build-essential
+
+    # The following trickery with $PATH is necessary during the Baserock
+    # bootstrap build: we are not guaranteed that PATH contains the
+    # directory (/sbin conventionally) that ldconfig is in. Then again,
+    # it might, and if so, we don't want to hardware a particular
+    # location. So we add the possible locations to the end of $PATH
+    env = dict(os.environ)
+    old_path = env['PATH']
+    env['PATH'] = '%s:/sbin:/usr/sbin:/usr/local/sbin' % old_path
+    return runcmd(['ldconfig'] + list(args) + ['-r', rootdir], env=env)
+
+
+def parse_ldconfig_links(output, rootdir):
+    '''Parse the output of ``ldconfig -v`` into the links it manages.
+
+    Return a list of ``(dirname, link, target)`` tuples, where
+    ``dirname`` is relative to ``rootdir``.
+
+    '''
+
+    links = []
+    dirname = None
+    for line in output.splitlines():
+        if not line.startswith('\t'):
+            # A directory, such as "/usr/lib:" or
+            # "/usr/lib: (from /etc/ld.so.conf:1)"
+            dirname = line.split(':', 1)[0] if ':' in line else None
+            if dirname is not None and dirname.startswith(rootdir):
+                dirname = dirname[len(rootdir):] or '/'
+            continue
+        if dirname is None or ' -> ' not in line:
+            continue
+        link, target = line.strip().split(' -> ', 1)
+        # Newer versions of ldconfig append " (changed)" or similar.
+        target = target.split(' ', 1)[0]
+        links.append((dirname, link, target))
+    return links
+
+
+def cached_ldconfig(runcmd, rootdir, cachedir, artifact_keys):
+    '''Run ldconfig for ``rootdir``, reusing earlier results if possible.
+
+    ``artifact_keys`` identifies everything installed in ``rootdir``,
+    such as the basenames of the installed artifacts, which contain
+    their cache keys. The same set of artifacts always gives the same
+    ``ld.so.cache`` and library links, so these are saved in
+    ``cachedir`` and restored instead of running ldconfig again when
+    the same set is installed in another staging area.
+
+    '''
+
+    conf = os.path.join(rootdir, 'etc', 'ld.so.conf')
+    if not os.path.exists(conf):
+        logging.debug('No %s, not running ldconfig' % conf)
+        return
+
+    key = hashlib.sha256('\n'.join(sorted(set(artifact_keys)))).hexdigest()
+    saved_cache = os.path.join(cachedir, key + '.cache')
+    saved_links = os.path.join(cachedir, key + '.links')
+    cache = os.path.join(rootdir, 'etc', 'ld.so.cache')
+
+    if os.path.exists(saved_cache) and os.path.exists(saved_links):
+        logging.debug('Reusing ld.so.cache %s for %s' % (key, rootdir))
+        with open(saved_links) as f:
+            links = json.load(f)
+        for dirname, link, target in links:
+            path = os.path.join(rootdir, dirname.lstrip('/'), link)
+            if os.path.islink(path):
+                if os.readlink(path) == target:
+                    continue
+                os.remove(path)
+            elif os.path.lexists(path):
+                # ldconfig leaves files that are not symlinks alone.
+                continue
+            os.symlink(target, path)
+        # The staging area may have hardlinked an ld.so.cache from a
+        # chunk, so replace the file rather than writing into it.
+        with morphlib.savefile.SaveFile(cache, 'w') as dst:
+            with open(saved_cache) as src:
+                shutil.copyfileobj(src, dst)
+            os.chmod(dst.name, 0644)
+        return
+
+    logging.debug('Running ldconfig for %s' % rootdir)
+    output = _run_ldconfig(runcmd, rootdir, '-v')
+    if not os.path.exists(cache):
+        return  # pragma: no cover
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    with morphlib.savefile.SaveFile(saved_links, 'w') as f:
+        json.dump(parse_ldconfig_links(output, rootdir), f)
+    with morphlib.savefile.SaveFile(saved_cache, 'w') as dst:
+        with open(cache) as src:
+            shutil.copyfileobj(src, dst)
+
+
+def download_depends(constituents, lac, rac, metadatas=None, connections=4):
+    '''Fetch any of ``constituents`` missing from the local cache.
+
+    The artifacts must be in the remote cache if they are not local. The
+    named ``metadatas`` are fetched as well where the remote cache has them.
+    At most ``connections`` are made to the remote cache at once.
+
+    '''
+
+    prefetcher = morphlib.artifactprefetcher.ArtifactPrefetcher(
+        lac, rac, connections)
+    missing = prefetcher.fetch((c, ()) for c in constituents)
+    if missing:
+        raise morphlib.remoteartifactcache.GetError(rac, missing[0])
+    if metadatas is not None:
+        prefetcher.fetch((c, metadatas) for c in constituents)
 
 
 def get_chunk_files(f):  # pragma: no cover
-    tar = tarfile.open(fileobj=f)
-    for member in tar.getmembers():
-        if member.type is not tarfile.DIRTYPE:
-            yield member.name
-    tar.close()
+    with morphlib.bins.open_binary(f) as tar:
+        for member in tar:
+            if member.type is not tarfile.DIRTYPE:
+                yield member.name
 
 
 def get_stratum_files(f, lac):  # pragma: no cover
@@ -180,6 +266,11 @@ class BuilderBase(object):
         self.build_watch = morphlib.stopwatch.Stopwatch()
         self.setup_mounts = setup_mounts
 
+    @property
+    def fetch_connections(self):
+        '''How many connections to fetch dependencies over at once.'''
+        return self.app.settings['artifact-fetch-connections']
+
     def save_build_times(self):
         '''Write the times captured by the stopwatch'''
         meta = {
@@ -458,22 +549,26 @@ class ChunkBuilder(BuilderBase):
 
         system_integration = morphology.get(sys_tag) or {}
 
+        def all_parents(path):
+            while path != '':
+                yield path
+                path = os.path.dirname(path)
+
+        def parentify(filenames):
+            names = set()
+            for name in filenames:
+                names.update(all_parents(name))
+            return sorted(names)
+
         with self.build_watch('create-chunks'):
+            # The split artifacts have no files in common, apart from
+            # directories, which create_chunk leaves in place. So all the
+            # metadata is written first and then the chunks are created
+            # concurrently.
+            to_create = []
             for chunk_artifact_name, chunk_artifact \
                 in source.artifacts.iteritems():
                 file_paths = matches[chunk_artifact_name]
-                chunk_artifact = source.artifacts[chunk_artifact_name]
-
-                def all_parents(path):
-                    while path != '':
-                        yield path
-                        path = os.path.dirname(path)
-
-                def parentify(filenames):
-                    names = set()
-                    for name in filenames:
-                        names.update(all_parents(name))
-                    return sorted(names)
 
                 extra_files = self.write_system_integration_commands(
                                   destdir, system_integration,
@@ -481,14 +576,35 @@ class ChunkBuilder(BuilderBase):
                 extra_files += ['baserock/%s.meta' % chunk_artifact_name]
                 parented_paths = parentify(file_paths + extra_files)
 
-                with self.local_artifact_cache.put(chunk_artifact) as f:
-                    self.write_metadata(destdir, chunk_artifact_name,
-                                        parented_paths)
+                self.write_metadata(destdir, chunk_artifact_name,
+                                    parented_paths)
+                to_create.append((chunk_artifact, parented_paths))
+
+            errors = []
+            compression = self.app.settings['artifact-compression']
 
+            def create_chunk(chunk_artifact, parented_paths):
+                try:
                     self.app.status(msg='Creating chunk artifact %(name)s',
-                                    name=chunk_artifact_name)
-                    morphlib.bins.create_chunk(destdir, f, parented_paths)
-                built_artifacts.append(chunk_artifact)
+                                    name=chunk_artifact.name)
+                    with self.local_artifact_cache.put(chunk_artifact) as f:
+                        morphlib.bins.create_chunk(
+                            destdir, f, parented_paths,
+                            compression=compression)
+                except BaseException, e:
+                    logging.exception('Creating chunk artifact %s failed' %
+                                      chunk_artifact.name)
+                    errors.append(e)
+
+            threads = [threading.Thread(target=create_chunk, args=args)
+                       for args in to_create]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            built_artifacts.extend(a for a, paths in to_create)
 
         for dirname, subdirs, files in os.walk(destdir):
             if files:
@@ -521,7 +637,8 @@ class StratumBuilder(BuilderBase):
                     # download the chunk artifact if necessary
                     download_depends(constituents,
                                      self.local_artifact_cache,
-                                     self.remote_artifact_cache)
+                                     self.remote_artifact_cache,
+                                     connections=self.fetch_connections)
 
             with self.build_watch('create-chunk-list'):
                 lac = self.local_artifact_cache
@@ -568,11 +685,17 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                             info.linkname = relpath(info.linkname,
                                                     unslashy_root)
                         return info
-                    tar = tarfile.open(fileobj=handle, mode="w", name=a_name)
-                    self.app.status(msg='Constructing tarball of rootfs',
-                                    chatty=True)
-                    tar.add(fs_root, recursive=True, filter=uproot_info)
-                    tar.close()
+                    compression = self.app.settings['artifact-compression']
+                    with morphlib.bins.compressed_writer(
+                            handle, compression) as f:
+                        # A compressor is a pipe, which can only be
+                        # written to as a stream.
+                        mode = 'w' if f is handle else 'w|'
+                        tar = tarfile.open(fileobj=f, mode=mode, name=a_name)
+                        self.app.status(msg='Constructing tarball of rootfs',
+                                        chatty=True)
+                        tar.add(fs_root, recursive=True, filter=uproot_info)
+                        tar.close()
                 except BaseException as e:
                     logging.error(traceback.format_exc())
                     self.app.status(msg='Error while building system',
@@ -614,7 +737,8 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                 download_depends(self.source.dependencies,
                                  self.local_artifact_cache,
                                  self.remote_artifact_cache,
-                                 ('meta',))
+                                 ('meta',),
+                                 connections=self.fetch_connections)
 
                 # download the chunk artifacts if necessary
                 for stratum_artifact in self.source.dependencies:
@@ -622,14 +746,18 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                     chunks = [ArtifactCacheReference(c) for c in json.load(f)]
                     download_depends(chunks,
                                      self.local_artifact_cache,
-                                     self.remote_artifact_cache)
+                                     self.remote_artifact_cache,
+                                     connections=self.fetch_connections)
                     f.close()
 
                 # unpack it from the local artifact cache
                 for stratum_artifact in self.source.dependencies:
                     self.unpack_one_stratum(stratum_artifact, path)
 
-            ldconfig(self.app.runcmd, path)
+            cached_ldconfig(
+                self.app.runcmd, path,
+                os.path.join(self.app.settings['tempdir'], 'ldconfig'),
+                (a.basename() for a in self.source.dependencies))
 
     def write_metadata(self, instdir, artifact_name):
         BuilderBase.write_metadata(self, instdir, artifact_name)
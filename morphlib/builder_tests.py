@@ -16,7 +16,9 @@
 
 import json
 import os
+import shutil
 import StringIO
+import tempfile
 import unittest
 
 import morphlib
@@ -68,6 +70,9 @@ class FakeArtifact(object):
         self.cache_key = 'blahblah'
         self.cache_id = {}
 
+    def basename(self):
+        return '%s.%s' % (self.cache_key, self.name)
+
 
 class FakeBuildEnv(object):
 
@@ -135,6 +140,12 @@ class FakeArtifactCache(object):
     def has_source_metadata(self, source, cachekey, name):
         return (cachekey, name) in self._cached
 
+    def connection(self):
+        return self
+
+    def close(self):
+        pass
+
 
 class BuilderBaseTests(unittest.TestCase):
 
@@ -198,6 +209,22 @@ class BuilderBaseTests(unittest.TestCase):
         morphlib.builder.download_depends(afacts, lac, rac)
         self.assertTrue(all(lac.has(a) for a in afacts))
 
+    def test_downloads_depends_over_given_connections(self):
+        lac = FakeArtifactCache()
+        rac = FakeArtifactCache()
+        afacts = [FakeArtifact(name) for name in ('a', 'b', 'c')]
+        for a in afacts:
+            with rac.put(a) as fh:
+                fh.write(a.name)
+        connections = []
+        def connection():
+            connections.append(rac)
+            return rac
+        rac.connection = connection
+        morphlib.builder.download_depends(afacts, lac, rac, connections=1)
+        self.assertEqual(len(connections), 1)
+        self.assertTrue(all(lac.has(a) for a in afacts))
+
     def test_downloads_depends_metadata(self):
         lac = FakeArtifactCache()
         rac = FakeArtifactCache()
@@ -221,3 +248,73 @@ class ChunkBuilderTests(unittest.TestCase):
         self.app = FakeApp()
         self.build = morphlib.builder.ChunkBuilder(self.app, None, None,
                                                     None, None, None, 1, False)
+
+
+class LdconfigCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'ldconfig')
+        self.ldconfig_runs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_root(self, name):
+        rootdir = os.path.join(self.tempdir, name)
+        os.makedirs(os.path.join(rootdir, 'etc'))
+        os.makedirs(os.path.join(rootdir, 'lib'))
+        with open(os.path.join(rootdir, 'etc', 'ld.so.conf'), 'w'):
+            pass
+        with open(os.path.join(rootdir, 'lib', 'libfoo.so.1.2'), 'w'):
+            pass
+        return rootdir
+
+    def fake_ldconfig(self, argv, **kwargs):
+        self.ldconfig_runs += 1
+        rootdir = argv[-1]
+        with open(os.path.join(rootdir, 'etc', 'ld.so.cache'), 'w') as f:
+            f.write('cache')
+        os.symlink('libfoo.so.1.2',
+                   os.path.join(rootdir, 'lib', 'libfoo.so.1'))
+        return '/lib: (from <builtin>:0)\n\tlibfoo.so.1 -> libfoo.so.1.2\n'
+
+    def test_parses_links_from_verbose_output(self):
+        output = ('/usr/lib:\n'
+                  '\tlibbar.so.2 -> libbar.so.2.0 (changed)\n'
+                  '/root/lib: (from /etc/ld.so.conf:1)\n'
+                  '\tlibfoo.so.1 -> libfoo.so.1.2\n')
+        self.assertEqual(
+            morphlib.builder.parse_ldconfig_links(output, '/root'),
+            [('/usr/lib', 'libbar.so.2', 'libbar.so.2.0'),
+             ('/lib', 'libfoo.so.1', 'libfoo.so.1.2')])
+
+    def test_reuses_result_for_same_artifacts(self):
+        first = self.make_root('first')
+        morphlib.builder.cached_ldconfig(
+            self.fake_ldconfig, first, self.cachedir, ['a', 'b'])
+        second = self.make_root('second')
+        morphlib.builder.cached_ldconfig(
+            self.fake_ldconfig, second, self.cachedir, ['b', 'a'])
+        self.assertEqual(self.ldconfig_runs, 1)
+        with open(os.path.join(second, 'etc', 'ld.so.cache')) as f:
+            self.assertEqual(f.read(), 'cache')
+        self.assertEqual(
+            os.readlink(os.path.join(second, 'lib', 'libfoo.so.1')),
+            'libfoo.so.1.2')
+
+    def test_runs_ldconfig_for_different_artifacts(self):
+        morphlib.builder.cached_ldconfig(
+            self.fake_ldconfig, self.make_root('first'), self.cachedir,
+            ['a'])
+        morphlib.builder.cached_ldconfig(
+            self.fake_ldconfig, self.make_root('second'), self.cachedir,
+            ['a', 'b'])
+        self.assertEqual(self.ldconfig_runs, 2)
+
+    def test_does_nothing_without_ld_so_conf(self):
+        rootdir = self.make_root('root')
+        os.remove(os.path.join(rootdir, 'etc', 'ld.so.conf'))
+        morphlib.builder.cached_ldconfig(
+            self.fake_ldconfig, rootdir, self.cachedir, ['a'])
+        self.assertEqual(self.ldconfig_runs, 0)
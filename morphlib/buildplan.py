@@ -0,0 +1,219 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import json
+import logging
+import os
+
+import morphlib
+
+
+def format_seconds(seconds):
+    '''Format a duration in seconds as H:MM:SS.'''
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+
+class BuildTimeHistory(object):
+
+    '''Find how long sources took to build before.
+
+    Every build writes the time each of its steps took to the
+    ``CACHEKEY.meta`` source metadata file in the local artifact cache
+    (see ``BuilderBase.save_build_times``). A source is expected to take
+    as long as the last build with the same cache key did. Failing that,
+    it is expected to take as long as the most recent build of a source
+    that produced an artifact of the same name.
+
+    '''
+
+    def __init__(self, lac):
+        self._lac = lac
+        self._with_times = None
+        self._by_artifact = None
+
+    def _index(self):
+        self._with_times = set()
+        self._by_artifact = collections.defaultdict(list)
+        for filename in self._lac.cachefs.listdir():
+            parts = filename.split('.', 1)
+            if len(parts) != 2:
+                continue
+            cache_key, rest = parts
+            if rest == 'meta':
+                self._with_times.add(cache_key)
+            elif not rest.endswith('.meta'):
+                # An artifact called 'KIND.NAME'.
+                self._by_artifact[rest].append(cache_key)
+
+    def _read_time(self, cache_key):
+        filename = self._lac.get_source_metadata_filename(
+            None, cache_key, 'meta')
+        try:
+            with open(filename) as f:
+                meta = json.load(f)
+            return float(meta['build-times']['overall-build']['delta'])
+        except (IOError, OSError, ValueError, KeyError, TypeError), e:
+            logging.debug('No build time in %s: %s' % (filename, e))
+            return None
+
+    def _mtime(self, cache_key):
+        filename = self._lac.get_source_metadata_filename(
+            None, cache_key, 'meta')
+        try:
+            return os.stat(filename).st_mtime
+        except OSError: # pragma: no cover
+            return 0
+
+    def estimate(self, source):
+        '''Return (seconds, how) for building a source.
+
+        ``how`` is 'cache-key' if the same source was built before, 'name'
+        if the estimate comes from a build of a source with artifacts of
+        the same names, or None if there is no estimate, in which case
+        ``seconds`` is None too.
+
+        '''
+
+        if self._with_times is None:
+            self._index()
+
+        if source.cache_key in self._with_times:
+            seconds = self._read_time(source.cache_key)
+            if seconds is not None:
+                return seconds, 'cache-key'
+
+        candidates = set()
+        for artifact in source.artifacts.itervalues():
+            name = '%s.%s' % (source.morphology['kind'], artifact.name)
+            candidates.update(key for key in self._by_artifact.get(name, ())
+                              if key in self._with_times)
+        for cache_key in sorted(candidates, key=self._mtime, reverse=True):
+            seconds = self._read_time(cache_key)
+            if seconds is not None:
+                return seconds, 'name'
+        return None, None
+
+
+class BuildPlan(object):
+
+    '''What a build will do, and how long it is expected to take.
+
+    ``to_fetch`` is the list of artifacts that will be fetched from the
+    remote artifact cache and ``to_build`` the list of sources that will
+    be built, in build order, as returned by ``BuildCommand.plan_build``.
+    Sources that nothing is known about are counted as taking no time,
+    and listed in ``unknown``.
+
+    The critical path is the chain of sources to build, each depending
+    on the one before it, that is expected to take longest. No matter how
+    many builds run in parallel, the build cannot finish sooner.
+
+    '''
+
+    def __init__(self, root_artifact, to_fetch, to_build, history):
+        self.root_artifact = root_artifact
+        self.to_fetch = list(to_fetch)
+        self.to_build = list(to_build)
+
+        self.estimates = {}
+        self.unknown = []
+        for source in self.to_build:
+            seconds, how = history.estimate(source)
+            self.estimates[source] = (seconds, how)
+            if seconds is None:
+                self.unknown.append(source)
+
+        self.total_seconds = sum(self._seconds(s) for s in self.to_build)
+        self.critical_path, self.critical_path_seconds = \
+            self._find_critical_path()
+        self.strata_seconds = self._sum_by_stratum()
+
+    def _seconds(self, source):
+        return self.estimates[source][0] or 0
+
+    def _build_dependencies(self, source):
+        return set(a.source for a in source.dependencies
+                   if a.source in self.estimates and a.source is not source)
+
+    def _find_critical_path(self):
+        # Sources are in build order, so the dependencies of each source
+        # have been seen before it.
+        finish = {}
+        previous = {}
+        for source in self.to_build:
+            start = 0
+            deps = self._build_dependencies(source)
+            if deps:
+                dep = max(deps, key=lambda d: (finish[d], d.name))
+                previous[source] = dep
+                start = finish[dep]
+            finish[source] = start + self._seconds(source)
+
+        if not finish:
+            return [], 0
+        # On a tie, end the path at the source built last, which is
+        # nearer the root.
+        last = max(reversed(self.to_build), key=lambda s: finish[s])
+        path = [last]
+        while path[-1] in previous:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return path, finish[last]
+
+    def _sum_by_stratum(self):
+        strata = collections.defaultdict(float)
+        chunk_strata = collections.defaultdict(set)
+        for artifact in self.root_artifact.walk():
+            source = artifact.source
+            if source.morphology['kind'] != 'stratum':
+                continue
+            stratum_name = source.morphology['name']
+            for dep in source.dependencies:
+                if dep.source.morphology['kind'] == 'chunk':
+                    chunk_strata[dep.source].add(stratum_name)
+            if source in self.estimates:
+                strata[stratum_name] += self._seconds(source)
+        for source in self.to_build:
+            for stratum_name in chunk_strata.get(source, ()):
+                strata[stratum_name] += self._seconds(source)
+        return dict(strata)
+
+    def as_dict(self):
+        '''Return the plan as a dict that can be written out as JSON.'''
+
+        def describe(source):
+            seconds, how = self.estimates[source]
+            return {
+                'name': source.name,
+                'kind': source.morphology['kind'],
+                'cache-key': source.cache_key,
+                'estimated-seconds': seconds,
+                'estimated-from': how,
+                'build-depends': sorted(
+                    d.cache_key for d in self._build_dependencies(source)),
+            }
+
+        return {
+            'system': self.root_artifact.source.name,
+            'to-fetch': [a.basename() for a in self.to_fetch],
+            'to-build': [describe(s) for s in self.to_build],
+            'critical-path': [s.cache_key for s in self.critical_path],
+            'critical-path-seconds': self.critical_path_seconds,
+            'total-seconds': self.total_seconds,
+            'strata-seconds': self.strata_seconds,
+        }
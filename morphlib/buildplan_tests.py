@@ -0,0 +1,157 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import fs.osfs
+
+import morphlib
+
+
+class FakeSource(object):
+
+    def __init__(self, name, kind, *deps):
+        self.name = name
+        self.morphology = {'kind': kind, 'name': name}
+        self.cache_key = name + '-key'
+        self.dependencies = [FakeArtifact(d, d.name) for d in deps]
+        self.artifacts = {name: FakeArtifact(self, name)}
+
+    def __repr__(self):
+        return 'FakeSource(%s)' % self.name
+
+
+class FakeArtifact(object):
+
+    def __init__(self, source, name):
+        self.source = source
+        self.name = name
+
+    def basename(self):
+        return '%s.%s.%s' % (self.source.cache_key,
+                             self.source.morphology['kind'], self.name)
+
+    def walk(self):
+        done = set()
+        def depth_first(artifact):
+            if artifact in done:
+                return
+            for dep in artifact.source.dependencies:
+                for ret in depth_first(dep):
+                    yield ret
+            done.add(artifact)
+            yield artifact
+        return list(depth_first(self))
+
+
+class BuildTimeHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.lac = morphlib.localartifactcache.LocalArtifactCache(
+            fs.osfs.OSFS(self.tempdir))
+        self.history = morphlib.buildplan.BuildTimeHistory(self.lac)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def add_build(self, cache_key, artifact_name, seconds, age=0):
+        with open(os.path.join(self.tempdir, '%s.chunk.%s' %
+                               (cache_key, artifact_name)), 'w'):
+            pass
+        filename = os.path.join(self.tempdir, '%s.meta' % cache_key)
+        with open(filename, 'w') as f:
+            json.dump({'build-times': {'overall-build': {
+                'start': '', 'stop': '', 'delta': '%.4f' % seconds}}}, f)
+        then = time.time() - age
+        os.utime(filename, (then, then))
+
+    def test_uses_time_of_same_cache_key(self):
+        self.add_build('foo-key', 'foo', 10)
+        self.add_build('old-key', 'foo', 20)
+        self.assertEqual(self.history.estimate(FakeSource('foo', 'chunk')),
+                         (10, 'cache-key'))
+
+    def test_uses_latest_time_of_same_name(self):
+        self.add_build('old-key', 'foo', 20, age=100)
+        self.add_build('new-key', 'foo', 30)
+        self.add_build('bar-key', 'bar', 40)
+        self.assertEqual(self.history.estimate(FakeSource('foo', 'chunk')),
+                         (30, 'name'))
+
+    def test_gives_no_estimate_without_history(self):
+        self.add_build('bar-key', 'bar', 40)
+        self.assertEqual(self.history.estimate(FakeSource('foo', 'chunk')),
+                         (None, None))
+
+
+class FakeHistory(object):
+
+    def __init__(self, times):
+        self.times = times
+
+    def estimate(self, source):
+        if source.name in self.times:
+            return self.times[source.name], 'cache-key'
+        return None, None
+
+
+class BuildPlanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FakeSource('a', 'chunk')
+        self.b = FakeSource('b', 'chunk', self.a)
+        self.c = FakeSource('c', 'chunk')
+        self.d = FakeSource('d', 'chunk', self.b, self.c)
+        self.stratum = FakeSource('s', 'stratum', self.a, self.b, self.c,
+                                  self.d)
+        self.system = FakeSource('system', 'system', self.stratum)
+        self.root = self.system.artifacts['system']
+        self.to_build = [self.a, self.b, self.c, self.d, self.stratum,
+                         self.system]
+        self.history = FakeHistory({'a': 10, 'b': 20, 'c': 100, 'd': 5,
+                                    's': 1})
+
+    def test_finds_critical_path(self):
+        plan = morphlib.buildplan.BuildPlan(self.root, [], self.to_build,
+                                            self.history)
+        self.assertEqual(plan.critical_path,
+                         [self.c, self.d, self.stratum, self.system])
+        self.assertEqual(plan.critical_path_seconds, 106)
+        self.assertEqual(plan.total_seconds, 136)
+        self.assertEqual(plan.unknown, [self.system])
+
+    def test_sums_times_by_stratum(self):
+        plan = morphlib.buildplan.BuildPlan(self.root, [], self.to_build[1:],
+                                            self.history)
+        self.assertEqual(plan.strata_seconds, {'s': 126})
+
+    def test_plan_can_be_written_as_json(self):
+        plan = morphlib.buildplan.BuildPlan(self.root, [],
+                                            [self.c, self.d], self.history)
+        data = json.loads(json.dumps(plan.as_dict()))
+        self.assertEqual(data['critical-path'], ['c-key', 'd-key'])
+        self.assertEqual(data['to-build'][1]['build-depends'], ['c-key'])
+        self.assertEqual(data['total-seconds'], 105)
+
+    def test_formats_seconds(self):
+        self.assertEqual(morphlib.buildplan.format_seconds(3725.4),
+                         '1:02:05')
@@ -0,0 +1,92 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import heapq
+
+
+class BuildScheduler(object):
+
+    '''Decide which sources of a build graph can be built next.
+
+    The scheduler is given every source that takes part in a build,
+    in a valid build order (dependencies first, as produced by
+    ``Artifact.walk()``). A source becomes ready once every source it
+    depends on has been marked as done. Ready sources are handed out
+    in the order they were given, so with only one build running at a
+    time the result is the same as building in the original order.
+
+    '''
+
+    def __init__(self, sources):
+        self._index = {}
+        self._unmet = {}
+        self._dependents = collections.defaultdict(set)
+        self._ready = []
+        self._running = set()
+        self._done = set()
+
+        sources = list(sources)
+        for index, source in enumerate(sources):
+            self._index[source] = index
+
+        for source in sources:
+            deps = set(a.source for a in source.dependencies
+                       if a.source in self._index and a.source is not source)
+            self._unmet[source] = len(deps)
+            for dep in deps:
+                self._dependents[dep].add(source)
+            if not deps:
+                self._push_ready(source)
+
+    def _push_ready(self, source):
+        heapq.heappush(self._ready, (self._index[source], source))
+
+    def has_ready(self):
+        '''Is there a source that can be built now?'''
+        return len(self._ready) > 0
+
+    def pop_ready(self):
+        '''Return the next source to build, and mark it as running.'''
+        index, source = heapq.heappop(self._ready)
+        self._running.add(source)
+        return source
+
+    def mark_done(self, source):
+        '''Record that ``source`` has been built or fetched from a cache.
+
+        Any source whose last unbuilt dependency was ``source`` becomes
+        ready.
+
+        '''
+
+        self._running.discard(source)
+        self._done.add(source)
+        for dependent in self._dependents[source]:
+            self._unmet[dependent] -= 1
+            if self._unmet[dependent] == 0:
+                self._push_ready(dependent)
+
+    def running(self):
+        '''Return the set of sources currently being built.'''
+        return set(self._running)
+
+    def finished(self):
+        '''Have all sources been built?'''
+        return len(self._done) == len(self._index)
+
+    def __len__(self):
+        return len(self._index)
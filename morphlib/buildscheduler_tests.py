@@ -0,0 +1,77 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import morphlib
+
+
+class FakeSource(object):
+
+    def __init__(self, name, *deps):
+        self.name = name
+        self.dependencies = [FakeArtifact(d) for d in deps]
+
+    def __repr__(self):
+        return 'FakeSource(%s)' % self.name
+
+
+class FakeArtifact(object):
+
+    def __init__(self, source):
+        self.source = source
+
+
+class BuildSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FakeSource('a')
+        self.b = FakeSource('b')
+        self.c = FakeSource('c', self.a, self.b)
+        self.d = FakeSource('d', self.c)
+        self.sched = morphlib.buildscheduler.BuildScheduler(
+            [self.a, self.b, self.c, self.d])
+
+    def test_independent_sources_are_ready_together(self):
+        self.assertEqual(self.sched.pop_ready(), self.a)
+        self.assertEqual(self.sched.pop_ready(), self.b)
+        self.assertFalse(self.sched.has_ready())
+        self.assertEqual(self.sched.running(), set([self.a, self.b]))
+
+    def test_source_waits_for_all_dependencies(self):
+        self.sched.pop_ready()
+        self.sched.pop_ready()
+        self.sched.mark_done(self.b)
+        self.assertFalse(self.sched.has_ready())
+        self.sched.mark_done(self.a)
+        self.assertEqual(self.sched.pop_ready(), self.c)
+
+    def test_serial_order_matches_input_order(self):
+        order = []
+        while not self.sched.finished():
+            source = self.sched.pop_ready()
+            order.append(source)
+            self.sched.mark_done(source)
+        self.assertEqual(order, [self.a, self.b, self.c, self.d])
+
+    def test_ignores_dependencies_outside_the_graph(self):
+        outside = FakeSource('outside')
+        e = FakeSource('e', outside)
+        sched = morphlib.buildscheduler.BuildScheduler([e])
+        self.assertEqual(sched.pop_ready(), e)
+
+    def test_len_is_number_of_sources(self):
+        self.assertEqual(len(self.sched), 4)
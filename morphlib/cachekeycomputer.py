@@ -14,18 +14,76 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import cPickle
 import hashlib
 import logging
 
 import morphlib
 
 
+class CacheKeyMemo(object):
+
+    '''Cache keys computed by earlier runs of Morph, kept in a file.
+
+    For every source, the memo remembers the cache key it had last time
+    and a digest of each field of the cache id it was computed from. If
+    the fields are unchanged the key can be reused without hashing the
+    cache id again, and if they have changed the memo tells which ones.
+
+    A memo written by a different version of Morph is ignored, since the
+    way cache keys are computed may have changed.
+
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = {}
+        self._changed = False
+        try:
+            with open(filename, 'rb') as f:
+                version, entries = cPickle.load(f)
+            if version == morphlib.__version__:
+                self._entries = entries
+        except (IOError, OSError):
+            pass
+        except Exception:
+            logging.warning('Ignoring corrupt cache key memo %s' % filename)
+
+    def get(self, identity):
+        '''Return the (digests, cache key) remembered for a source.'''
+        return self._entries.get(identity)
+
+    def put(self, identity, digests, cache_key):
+        self._entries[identity] = (digests, cache_key)
+        self._changed = True
+
+    def save(self):
+        '''Write the memo back to its file, if anything changed.'''
+        if self._changed:
+            with morphlib.savefile.SaveFile(self.filename, 'wb') as f:
+                cPickle.dump((morphlib.__version__, self._entries), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            self._changed = False
+
+
 class CacheKeyComputer(object):
 
-    def __init__(self, build_env):
+    '''Compute the cache keys of sources.
+
+    If a CacheKeyMemo is given, keys whose inputs have not changed since
+    they were last computed are taken from it. The ``changes`` attribute
+    then maps every source whose key changed to the sorted list of cache
+    id fields that changed, or to None if the source was not in the memo.
+
+    '''
+
+    def __init__(self, build_env, artifact_compression='none', memo=None):
         self._build_env = build_env
+        self._artifact_compression = artifact_compression
+        self._memo = memo
         self._calculated = {}
         self._hashed = {}
+        self.changes = {}
 
     def _filterenv(self, env):
         keys = ["LOGNAME", "MORPH_ARCH", "TARGET", "TARGET_STAGE1",
@@ -36,13 +94,44 @@ class CacheKeyComputer(object):
         try:
             return self._hashed[source]
         except KeyError:
-            ret = self._hash_id(self.get_cache_id(source))
+            if self._memo is None:
+                ret = self._hash_id(self.get_cache_id(source))
+            else:
+                ret = self._compute_key_with_memo(source)
             self._hashed[source] = ret
             logging.debug(
                 'computed cache key %s for artifact %s from source ',
                  ret, (source.repo_name, source.sha1, source.filename))
             return ret
 
+    def _memo_identity(self, source):
+        return (self._build_env.env.get('MORPH_ARCH'), source.repo_name,
+                source.filename, source.name)
+
+    def _compute_key_with_memo(self, source):
+        cache_id = self.get_cache_id(source)
+        # Pickling is much cheaper than _hash_thing. Equal pickles mean
+        # equal fields, so a key is never reused wrongly, although equal
+        # fields may occasionally pickle differently and be rehashed.
+        digests = dict(
+            (field, hashlib.sha1(cPickle.dumps(value, 2)).digest())
+            for field, value in cache_id.iteritems())
+        identity = self._memo_identity(source)
+        previous = self._memo.get(identity)
+        if previous is not None and previous[0] == digests:
+            return previous[1]
+
+        ret = self._hash_id(cache_id)
+        if previous is None:
+            self.changes[source] = None
+        elif previous[1] != ret:
+            old_digests = previous[0]
+            self.changes[source] = sorted(
+                field for field in set(digests) | set(old_digests)
+                if digests.get(field) != old_digests.get(field))
+        self._memo.put(identity, digests, ret)
+        return ret
+
     def _hash_id(self, cache_id):
         sha = hashlib.sha256()
         self._hash_dict(sha, cache_id)
@@ -123,6 +212,12 @@ class CacheKeyComputer(object):
             for key in morph_dict:
                 if key not in ignored_fields:
                     keys[key] = morph_dict[key]
+        # Compressed chunk and system artifacts get different cache keys,
+        # so clients that do not compress never fetch them. The key is
+        # unchanged for uncompressed artifacts.
+        if (kind in ('chunk', 'system') and
+                self._artifact_compression not in (None, 'none')):
+            keys['artifact-compression'] = self._artifact_compression
         if kind == 'stratum':
             keys['stratum-format-version'] = 1
         elif kind == 'system':
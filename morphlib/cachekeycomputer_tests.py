@@ -15,6 +15,9 @@
 
 
 import copy
+import os
+import shutil
+import tempfile
 import unittest
 
 import morphlib
@@ -102,6 +105,10 @@ class CacheKeyComputerTests(unittest.TestCase):
         self.artifacts = self.artifact_resolver._resolve_artifacts(
             self.source_pool)
         self.ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env)
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
 
     def _find_artifact(self, name):
         for artifact in self.artifacts:
@@ -160,3 +167,73 @@ class CacheKeyComputerTests(unittest.TestCase):
         ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
 
         self.assertNotEqual(oldsha, ckc.compute_key(artifact.source))
+
+    def test_compression_gives_different_key(self):
+        artifact = self._find_artifact('system-rootfs')
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env,
+                                                         'xz')
+        self.assertNotEqual(self.ckc.compute_key(artifact.source),
+                            ckc.compute_key(artifact.source))
+
+    def test_no_compression_gives_same_key(self):
+        artifact = self._find_artifact('system-rootfs')
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env,
+                                                         'none')
+        self.assertEqual(self.ckc.compute_key(artifact.source),
+                         ckc.compute_key(artifact.source))
+
+    def compute_with_memo(self, build_env=None):
+        memo = morphlib.cachekeycomputer.CacheKeyMemo(
+            os.path.join(self.tempdir, 'cache-keys'))
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(
+            build_env or self.build_env, memo=memo)
+        key = ckc.compute_key(self._find_artifact('system-rootfs').source)
+        memo.save()
+        return key, ckc
+
+    def test_memo_gives_same_key(self):
+        artifact = self._find_artifact('system-rootfs')
+        self.assertEqual(self.compute_with_memo()[0],
+                         self.ckc.compute_key(artifact.source))
+        key, ckc = self.compute_with_memo()
+        self.assertEqual(key, self.ckc.compute_key(artifact.source))
+
+    def test_memo_does_not_rehash_unchanged_sources(self):
+        self.compute_with_memo()
+        hashed = []
+        original = morphlib.cachekeycomputer.CacheKeyComputer._hash_id
+        def count(ckc, cache_id):
+            hashed.append(cache_id)
+            return original(ckc, cache_id)
+        morphlib.cachekeycomputer.CacheKeyComputer._hash_id = count
+        try:
+            key, ckc = self.compute_with_memo()
+        finally:
+            morphlib.cachekeycomputer.CacheKeyComputer._hash_id = original
+        self.assertEqual(hashed, [])
+        self.assertEqual(ckc.changes, {})
+
+    def test_memo_reports_new_sources(self):
+        key, ckc = self.compute_with_memo()
+        sources = set(a.source for a in self.artifacts)
+        self.assertEqual(set(ckc.changes), sources)
+        self.assertEqual(set(ckc.changes.values()), set([None]))
+
+    def test_memo_reports_changed_fields(self):
+        old_key = self.compute_with_memo()[0]
+        chunk = self._find_artifact('chunk-bins').source
+        chunk.tree = 'other-tree'
+        key, ckc = self.compute_with_memo()
+        self.assertNotEqual(key, old_key)
+        self.assertEqual(ckc.changes[chunk], ['tree'])
+        stratum = self._find_artifact('stratum-runtime').source
+        self.assertEqual(ckc.changes[stratum], ['kids'])
+        chunk2 = self._find_artifact('chunk2-bins').source
+        self.assertFalse(chunk2 in ckc.changes)
+
+    def test_ignores_corrupt_memo(self):
+        with open(os.path.join(self.tempdir, 'cache-keys'), 'w') as f:
+            f.write('garbage')
+        self.assertEqual(self.compute_with_memo()[0],
+                         self.ckc.compute_key(
+                            self._find_artifact('system-rootfs').source))
@@ -0,0 +1,173 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import json
+import logging
+import os
+import shutil
+
+import morphcacheserver.chunkmanifest
+from morphcacheserver.chunkmanifest import (
+    BlobStore, MANIFEST_ENCODING, MANIFEST_MAGIC, entry_tarinfo, is_manifest,
+    manifest_entry, read_manifest)
+
+import morphlib
+import morphlib.bins
+import morphlib.localartifactcache
+import morphlib.savefile
+
+
+class _BlobLinker(morphlib.bins.Extractor):
+
+    '''Extract a manifest by hardlinking its blobs.'''
+
+    def __init__(self, dirname, blobs):
+        morphlib.bins.Extractor.__init__(self, dirname)
+        self.blobs = blobs
+        self.copied = set()
+
+    def write_file(self, tf, tarinfo, targetpath):
+        blob = self.blobs.path(tarinfo.blob)
+        try:
+            os.link(blob, targetpath)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(blob, targetpath)
+            self.copied.add(targetpath)
+
+    def set_attributes(self, tarinfo, targetpath):
+        # Blobs already have the right attributes, and changing them
+        # would change every file sharing the blob.
+        if tarinfo.blob is None or targetpath in self.copied:
+            morphlib.bins.Extractor.set_attributes(self, tarinfo, targetpath)
+
+
+class ManifestReader(morphcacheserver.chunkmanifest.ManifestReader):
+
+    '''A chunk artifact reconstructed from its manifest and blobs.
+
+    This is a read-only file object giving the chunk as a tarball,
+    generated on demand. ``link_into`` extracts the chunk by hardlinking
+    the blobs instead.
+
+    '''
+
+    def can_link_into(self, dirname):
+        '''Can the blobs be hardlinked into ``dirname``?'''
+        return os.stat(self.blobs.dirname).st_dev == os.stat(dirname).st_dev
+
+    def link_into(self, dirname):
+        '''Extract the chunk into ``dirname`` by hardlinking blobs.
+
+        Blobs are copied instead if ``dirname`` is on another filesystem.
+
+        '''
+
+        _BlobLinker(dirname, self.blobs).extract_all(
+            entry_tarinfo(entry) for entry in self.entries)
+
+
+class ManifestWriter(morphlib.savefile.SaveFile):
+
+    '''Store a chunk artifact as a manifest and blobs.
+
+    The tarball is written to a temporary file first, since it may
+    arrive compressed, and split into blobs when the file is closed.
+
+    '''
+
+    def __init__(self, filename, blobs):
+        morphlib.savefile.SaveFile.__init__(self, filename, mode='w')
+        self.blobs = blobs
+
+    def close(self):
+        file.close(self)
+        try:
+            entries = []
+            with open(self._savefile_tempname, 'rb') as f:
+                with morphlib.bins.open_binary(f) as tf:
+                    for tarinfo in tf:
+                        blob = None
+                        if tarinfo.isreg():
+                            blob = self.blobs.add(tf.extractfile(tarinfo),
+                                                  tarinfo)
+                        entries.append(manifest_entry(tarinfo, blob))
+            with morphlib.savefile.SaveFile(self.real_filename, 'w') as f:
+                f.write(MANIFEST_MAGIC)
+                json.dump({'entries': entries}, f,
+                          encoding=MANIFEST_ENCODING)
+        finally:
+            os.remove(self._savefile_tempname)
+
+
+class DedupLocalArtifactCache(morphlib.localartifactcache.LocalArtifactCache):
+
+    '''A local artifact cache storing chunks as manifests and blobs.
+
+    Chunk artifacts are split into a manifest, stored where the tarball
+    would be, and a blob for each regular file, shared by every chunk
+    with an identical file. ``get`` gives a tarball reconstructed from
+    the blobs, which can be extracted by hardlinking the blobs with
+    ``link_into``. Other artifacts are stored as they are.
+
+    Removing artifacts leaves their blobs behind until ``prune_blobs``
+    is called.
+
+    '''
+
+    def __init__(self, cachefs, blobdir):
+        morphlib.localartifactcache.LocalArtifactCache.__init__(self, cachefs)
+        self.blobs = BlobStore(blobdir)
+
+    def put(self, artifact):
+        if artifact.source.morphology['kind'] != 'chunk':
+            return morphlib.localartifactcache.LocalArtifactCache.put(
+                self, artifact)
+        return ManifestWriter(self.artifact_filename(artifact), self.blobs)
+
+    def get(self, artifact):
+        handle = morphlib.localartifactcache.LocalArtifactCache.get(
+            self, artifact)
+        if handle.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+            handle.seek(0)
+            return handle
+        handle.close()
+        return ManifestReader(self.artifact_filename(artifact), self.blobs)
+
+    def prune_blobs(self, min_age=3600):
+        '''Remove blobs that no artifact in the cache uses any more.
+
+        Return the number of blobs removed.
+
+        '''
+
+        referenced = set()
+        for filename in self.cachefs.walkfiles():
+            path = self._join(filename)
+            try:
+                if not is_manifest(path):
+                    continue
+                manifest = read_manifest(path)
+            except (IOError, ValueError):  # pragma: no cover
+                logging.warning('Cannot read %s' % path)
+                # Without knowing which blobs it uses, none are safe to
+                # remove.
+                return 0
+            referenced.update(entry['blob'] for entry in manifest['entries']
+                              if entry['blob'] is not None)
+        return self.blobs.prune(referenced, min_age)
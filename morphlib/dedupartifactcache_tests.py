@@ -0,0 +1,158 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import fs.osfs
+
+import morphlib
+
+
+class FakeSource(object):
+
+    def __init__(self, kind):
+        self.morphology = {'kind': kind}
+
+
+class FakeArtifact(object):
+
+    def __init__(self, name, kind='chunk'):
+        self.name = name
+        self.source = FakeSource(kind)
+
+    def basename(self):
+        return '%s.chunk.%s' % ('0' * 64, self.name)
+
+
+class DedupLocalArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.artifactdir = os.path.join(self.tempdir, 'artifacts')
+        os.mkdir(self.artifactdir)
+        # Where Morph keeps them, for morphlib.bins.unpack_binary.
+        self.blobdir = os.path.join(self.tempdir, 'blobs')
+        self.lac = morphlib.dedupartifactcache.DedupLocalArtifactCache(
+            fs.osfs.OSFS(self.artifactdir), self.blobdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_chunk(self, files):
+        instdir = tempfile.mkdtemp(dir=self.tempdir)
+        os.mkdir(os.path.join(instdir, 'usr'))
+        for name, contents in files.iteritems():
+            with open(os.path.join(instdir, 'usr', name), 'w') as f:
+                f.write(contents)
+        os.symlink('a', os.path.join(instdir, 'usr', 'link'))
+        names = ['usr', 'usr/link'] + ['usr/%s' % n for n in sorted(files)]
+        f = StringIO.StringIO()
+        morphlib.bins.create_chunk(instdir, f, names)
+        return f.getvalue()
+
+    def put(self, artifact, data):
+        with self.lac.put(artifact) as f:
+            f.write(data)
+
+    def list_blobs(self):
+        return [name for dirname, subdirs, names in os.walk(self.blobdir)
+                for name in names]
+
+    def test_get_gives_back_identical_tarball(self):
+        data = self.create_chunk({'a': 'aaa', 'b': 'bb' * 100000})
+        artifact = FakeArtifact('foo')
+        self.put(artifact, data)
+        self.assertTrue(self.lac.has(artifact))
+        self.assertTrue(morphlib.dedupartifactcache.is_manifest(
+            self.lac.artifact_filename(artifact)))
+        with self.lac.get(artifact) as f:
+            self.assertEqual(f.read(), data)
+
+    def test_shares_identical_files_between_chunks(self):
+        artifact1 = FakeArtifact('foo')
+        artifact2 = FakeArtifact('bar')
+        self.put(artifact1, self.create_chunk({'a': 'same', 'b': 'one'}))
+        self.put(artifact2, self.create_chunk({'a': 'same', 'b': 'two'}))
+        self.assertEqual(len(self.list_blobs()), 3)
+
+    def test_stores_other_artifacts_as_they_are(self):
+        artifact = FakeArtifact('foo', kind='stratum')
+        self.put(artifact, '[]')
+        with self.lac.get(artifact) as f:
+            self.assertEqual(f.read(), '[]')
+        self.assertEqual(self.list_blobs(), [])
+
+    def test_aborting_put_stores_nothing(self):
+        artifact = FakeArtifact('foo')
+        f = self.lac.put(artifact)
+        f.write(self.create_chunk({'a': 'aaa'}))
+        f.abort()
+        self.assertFalse(self.lac.has(artifact))
+        self.assertEqual(self.list_blobs(), [])
+
+    def test_detects_compression_of_reconstructed_tarball(self):
+        artifact = FakeArtifact('foo')
+        self.put(artifact, self.create_chunk({'a': 'aaa'}))
+        with self.lac.get(artifact) as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'none')
+            self.assertEqual(f.tell(), 0)
+
+    def test_links_blobs_into_directory(self):
+        artifact = FakeArtifact('foo')
+        self.put(artifact, self.create_chunk({'a': 'aaa'}))
+        target = os.path.join(self.tempdir, 'target')
+        os.mkdir(target)
+        with self.lac.get(artifact) as f:
+            self.assertTrue(f.can_link_into(target))
+            f.link_into(target)
+        st = os.stat(os.path.join(target, 'usr', 'a'))
+        self.assertEqual(st.st_nlink, 2)
+        self.assertEqual(os.readlink(os.path.join(target, 'usr', 'link')),
+                         'a')
+
+    def test_prunes_blobs_of_removed_artifacts(self):
+        artifact1 = FakeArtifact('foo')
+        artifact2 = FakeArtifact('bar')
+        self.put(artifact1, self.create_chunk({'a': 'same', 'b': 'one'}))
+        self.put(artifact2, self.create_chunk({'a': 'same', 'b': 'two'}))
+        os.remove(self.lac.artifact_filename(artifact1))
+        self.assertEqual(self.lac.prune_blobs(min_age=0), 1)
+        self.assertEqual(len(self.list_blobs()), 2)
+        with self.lac.get(artifact2) as f:
+            f.read()
+
+    def test_keeps_new_blobs_when_pruning(self):
+        artifact = FakeArtifact('foo')
+        self.put(artifact, self.create_chunk({'a': 'aaa'}))
+        os.remove(self.lac.artifact_filename(artifact))
+        self.assertEqual(self.lac.prune_blobs(), 0)
+        self.assertEqual(len(self.list_blobs()), 1)
+
+    def test_unpack_binary_rebuilds_chunk_from_manifest(self):
+        artifact = FakeArtifact('foo')
+        self.put(artifact, self.create_chunk({'a': 'aaa'}))
+        target = os.path.join(self.tempdir, 'target')
+        os.mkdir(target)
+        morphlib.bins.unpack_binary(self.lac.artifact_filename(artifact),
+                                    target)
+        with open(os.path.join(target, 'usr', 'a')) as f:
+            self.assertEqual(f.read(), 'aaa')
+        self.assertEqual(os.stat(os.path.join(target, 'usr', 'a')).st_nlink,
+                         1)
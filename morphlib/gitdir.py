@@ -16,10 +16,15 @@
 # =*= License: GPL-2 =*=
 
 
+import atexit
 import cliapp
+import collections
+import fcntl
 import itertools
 import os
 import re
+import subprocess
+import threading
 
 import morphlib
 
@@ -348,6 +353,147 @@ class Remote(object):
         return ret
 
 
+class CatFileError(Exception):
+
+    '''A ``git cat-file`` process could not be used.'''
+
+
+class CatFile(object):
+
+    '''A long-lived ``git cat-file --batch`` process for a repository.
+
+    Looking up an object is a round trip over a pipe to a process that
+    keeps running, instead of starting a new git process every time.
+    ``option`` is ``--batch`` to read the contents of objects as well,
+    or ``--batch-check`` if only their SHA1 and type are needed.
+
+    The process is started when it is first needed, and again if it has
+    been closed. Use ``get_cat_file`` rather than creating these, so the
+    number of processes stays bounded.
+
+    '''
+
+    def __init__(self, dirname, option):
+        self.dirname = dirname
+        self.option = option
+        self.lock = threading.Lock()
+        self._process = None
+
+    def _start(self):
+        env = dict(os.environ)
+        env['GIT_NO_REPLACE_OBJECTS'] = '1'
+        try:
+            self._process = subprocess.Popen(
+                ['git', 'cat-file', self.option], cwd=self.dirname, env=env,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True)
+        except OSError, e:
+            raise CatFileError(str(e))
+        # Commands run later must not keep the pipes open, or git would
+        # never see the end of its input when the process is stopped.
+        for f in (self._process.stdin, self._process.stdout):
+            flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def lookup(self, name):
+        '''Look up an object by any name git rev-parse understands.
+
+        Returns (sha1, type, contents), where contents is None unless this
+        is a ``--batch`` process, or None if there is no such object.
+        Raises CatFileError if the name cannot be looked up this way.
+
+        '''
+
+        if '\n' in name:
+            raise CatFileError('Cannot look up names with newlines')
+        with self.lock:
+            if self._process is None:
+                self._start()
+            try:
+                self._process.stdin.write(name + '\n')
+                self._process.stdin.flush()
+                header = self._process.stdout.readline()
+                if not header:
+                    raise CatFileError('git cat-file exited')
+                fields = header.split()
+                if (len(fields) != 3 or
+                        not morphlib.git.is_valid_sha1(fields[0]) or
+                        not fields[2].isdigit()):
+                    # '<name> missing' or '<name> ambiguous'.
+                    return None
+                sha1, kind, size = fields
+                contents = None
+                if self.option == '--batch':
+                    contents = self._process.stdout.read(int(size))
+                    self._process.stdout.read(1)
+                return sha1, kind, contents
+            except (IOError, OSError, CatFileError), e:
+                self._stop()
+                raise CatFileError(str(e))
+
+    def _stop(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.stdout.close()
+            except IOError: # pragma: no cover
+                pass
+            self._process.wait()
+            self._process = None
+
+    def close(self):
+        '''Stop the process. It is started again if it is needed.'''
+        with self.lock:
+            self._stop()
+
+
+# The most cat-file processes to keep running at once.
+_MAX_CAT_FILES = 32
+
+_cat_files = collections.OrderedDict()
+_cat_files_lock = threading.Lock()
+
+
+def get_cat_file(dirname, option):
+    '''Return the shared CatFile for a repository.
+
+    The processes are shared by every GitDirectory for the repository.
+    When there are more than ``_MAX_CAT_FILES`` of them, the least
+    recently used processes that are not busy are stopped.
+
+    '''
+
+    key = (os.path.abspath(dirname), option)
+    with _cat_files_lock:
+        cat_file = _cat_files.pop(key, None)
+        if cat_file is None:
+            cat_file = CatFile(dirname, option)
+        _cat_files[key] = cat_file
+        for other_key, other in list(_cat_files.iteritems()):
+            if len(_cat_files) <= _MAX_CAT_FILES:
+                break
+            if other.lock.acquire(False):
+                try:
+                    other._stop()
+                finally:
+                    other.lock.release()
+                del _cat_files[other_key]
+    return cat_file
+
+
+def close_cat_files(dirname=None):
+    '''Stop the cat-file processes of a repository, or of all of them.'''
+
+    with _cat_files_lock:
+        for key, cat_file in list(_cat_files.iteritems()):
+            if dirname is None or key[0] == os.path.abspath(dirname):
+                cat_file.close()
+                del _cat_files[key]
+
+
+atexit.register(close_cat_files)
+
+
 class GitDirectory(object):
 
     '''Represents a local Git repository.
@@ -458,9 +604,17 @@ class GitDirectory(object):
         blob_id = '%s:%s' % (ref, filename)
         return self.get_blob_contents(blob_id)
 
-    def get_blob_contents(self, blob_id): # pragma: no cover
+    def get_blob_contents(self, blob_id):
         '''Get file contents from git by ID'''
-        return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'blob', blob_id)
+        try:
+            found = get_cat_file(self.dirname, '--batch').lookup(blob_id)
+        except CatFileError: # pragma: no cover
+            return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'blob',
+                                       blob_id)
+        if found is None or found[1] != 'blob':
+            raise cliapp.AppException('%s is not a blob in %s' %
+                                      (blob_id, self.dirname))
+        return found[2]
 
     def get_commit_contents(self, commit_id): # pragma: no cover
         '''Get commit contents from git by ID'''
@@ -508,6 +662,8 @@ class GitDirectory(object):
         '''Run "git remote update --prune".'''
         morphlib.git.gitcmd(self._runcmd, 'remote', 'update', '--prune',
                             echo_stderr=echo_stderr)
+        # Start looking up objects afresh, now the repository has changed.
+        close_cat_files(self.dirname)
 
     def is_bare(self):
         '''Determine whether the repository has no work tree (is bare)'''
@@ -532,10 +688,16 @@ class GitDirectory(object):
 
     def _rev_parse(self, ref):
         try:
-            return morphlib.git.gitcmd(self._runcmd, 'rev-parse',
-                                       '--verify', ref).strip()
-        except cliapp.AppException as e:
+            found = get_cat_file(self.dirname, '--batch-check').lookup(ref)
+        except CatFileError:
+            try:
+                return morphlib.git.gitcmd(self._runcmd, 'rev-parse',
+                                           '--verify', ref).strip()
+            except cliapp.AppException as e:
+                raise InvalidRefError(self, ref)
+        if found is None:
             raise InvalidRefError(self, ref)
+        return found[0]
 
     def disambiguate_ref(self, ref): # pragma: no cover
         try:
@@ -589,9 +751,29 @@ class GitDirectory(object):
                 filepath = os.path.join(dirpath, filename)
                 yield os.path.relpath(filepath, start=self.dirname)
 
+    @staticmethod
+    def _parse_tree_names(contents):
+        # Each entry of a tree object is '<mode> <name>\0' followed by
+        # the 20 byte SHA1 of the object.
+        names = []
+        pos = 0
+        while pos < len(contents):
+            end = contents.index('\0', pos)
+            names.append(contents[pos:end].split(' ', 1)[1])
+            pos = end + 21
+        return names
+
     def _list_files_in_ref(self, ref, recurse=True):
         tree = self.resolve_ref_to_tree(ref)
 
+        if not recurse:
+            try:
+                found = get_cat_file(self.dirname, '--batch').lookup(tree)
+            except CatFileError: # pragma: no cover
+                found = None
+            if found is not None:
+                return self._parse_tree_names(found[2])
+
         command = ['ls-tree', '--name-only', '-z']
         if recurse:
             command.append('-r')
@@ -115,6 +115,7 @@ class GitDirectoryContentsTests(unittest.TestCase):
                             self.mirror)
 
     def tearDown(self):
+        morphlib.gitdir.close_cat_files()
         shutil.rmtree(self.tempdir)
 
     def test_lists_files_in_work_tree(self):
@@ -165,6 +166,37 @@ class GitDirectoryContentsTests(unittest.TestCase):
             self.assertEqual(gd.read_file('bar.morph', 'master'),
                              'dummy morphology text')
 
+    def test_lists_top_of_tree_in_ref(self):
+        gd = morphlib.gitdir.GitDirectory(self.dirname)
+        os.mkdir(os.path.join(self.dirname, 'sub dir'))
+        with open(os.path.join(self.dirname, 'sub dir', 'file'), 'w') as f:
+            f.write('text')
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Add sub dir')
+        self.assertEqual(sorted(gd.list_files('master', recurse=False)),
+                         ['bar.morph', 'baz.morph', 'foo.morph', 'quux',
+                          'sub dir'])
+        self.assertEqual(gd.read_file('sub dir/file', 'master'), 'text')
+
+    def test_shares_cat_file_processes(self):
+        gd = morphlib.gitdir.GitDirectory(self.dirname)
+        gd.read_file('bar.morph', 'master')
+        cat_file = morphlib.gitdir.get_cat_file(self.dirname, '--batch')
+        self.assertTrue(cat_file._process is not None)
+        self.assertTrue(morphlib.gitdir.get_cat_file(
+            self.dirname + '/', '--batch') is cat_file)
+
+    def test_stops_least_recently_used_cat_file_processes(self):
+        with monkeypatch(morphlib.gitdir, '_MAX_CAT_FILES', 1):
+            first = morphlib.gitdir.GitDirectory(self.dirname)
+            second = morphlib.gitdir.GitDirectory(self.mirror)
+            first.resolve_ref_to_commit('master')
+            old = morphlib.gitdir.get_cat_file(self.dirname, '--batch-check')
+            second.resolve_ref_to_commit('master')
+            self.assertEqual(old._process, None)
+            self.assertEqual(first.resolve_ref_to_commit('master'),
+                             second.resolve_ref_to_commit('master'))
+
     def test_list_raises_invalid_ref(self):
         gd = morphlib.gitdir.GitDirectory(self.dirname)
         self.assertRaises(morphlib.gitdir.InvalidRefError,
@@ -17,6 +17,7 @@
 
 
 import collections
+import hashlib
 import logging
 import warnings
 import yaml
@@ -24,6 +25,10 @@ import yaml
 import morphlib
 
 
+# Use the much faster libyaml parser if PyYAML was built with it.
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 class MorphologyObsoleteFieldWarning(UserWarning):
 
     def __init__(self, morphology, spec, field):
@@ -307,9 +312,28 @@ class MorphologyDumper(yaml.SafeDumper):
         self.add_representer(unicode, self._represent_unicode)
 
 
+def _copy_data(obj):
+    '''Copy the dicts and lists of a parsed morphology.'''
+    if isinstance(obj, dict):
+        return dict((k, _copy_data(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [_copy_data(v) for v in obj]
+    return obj
+
+
 class MorphologyLoader(object):
 
-    '''Load morphologies from disk, or save them back to disk.'''
+    '''Load morphologies from disk, or save them back to disk.
+
+    Loading the same text again is cheap: the result of parsing,
+    validating and setting defaults is remembered by the SHA1 of the text,
+    for every loader in the process, and a copy of it is returned.
+
+    '''
+
+    # The most morphologies to remember before starting again.
+    _max_loaded = 4096
+    _loaded = {}
 
     _required_fields = {
         'chunk': [
@@ -389,7 +413,7 @@ class MorphologyLoader(object):
         '''
 
         try:
-            obj = yaml.safe_load(text)
+            obj = yaml.load(text, Loader=_SafeLoader)
         except yaml.error.YAMLError as e:
             raise MorphologyNotYamlError(morph_filename, e)
 
@@ -405,11 +429,22 @@ class MorphologyLoader(object):
 
         '''
 
-        m = self.parse_morphology_text(string, filename)
+        if isinstance(string, unicode):
+            key = hashlib.sha1(string.encode('utf-8')).hexdigest()
+        else:
+            key = hashlib.sha1(string).hexdigest()
+        loaded = self._loaded.get(key)
+        if loaded is None:
+            loaded = self.parse_morphology_text(string, filename)
+            loaded.filename = filename
+            self.validate(loaded)
+            self.set_commands(loaded)
+            self.set_defaults(loaded)
+            if len(self._loaded) >= self._max_loaded:
+                self._loaded.clear()
+            self._loaded[key] = loaded
+        m = morphlib.morphology.Morphology(_copy_data(loaded.data))
         m.filename = filename
-        self.validate(m)
-        self.set_commands(m)
-        self.set_defaults(m)
         return m
 
     def load_from_file(self, filename):
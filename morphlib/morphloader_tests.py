@@ -542,6 +542,25 @@ build-system: dummy
         self.assertEqual(morph['name'], 'foo')
         self.assertEqual(morph['build-system'], 'dummy')
 
+    def test_loading_same_text_again_gives_independent_copy(self):
+        string = '''\
+name: foo
+kind: stratum
+chunks:
+- name: bar
+  repo: test:bar
+  ref: master
+  build-depends: []
+  build-mode: bootstrap
+'''
+        first = self.loader.load_from_string(string, filename='a.morph')
+        first['chunks'][0]['name'] = 'changed'
+        second = morphlib.morphloader.MorphologyLoader().load_from_string(
+            string, filename='b.morph')
+        self.assertEqual(second['chunks'][0]['name'], 'bar')
+        self.assertEqual(second.filename, 'b.morph')
+        self.assertEqual(second['chunks'][0]['prefix'], '/usr')
+
     def test_loads_from_file(self):
         with open(self.filename, 'w') as f:
             f.write('''\
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import collections
 import os
 
 import morphlib
@@ -42,15 +43,35 @@ class MorphologyFactory(object):
     '''A way of creating morphologies which will provide a default'''
 
     def __init__(self, local_repo_cache, remote_repo_cache=None,
-                 status_cb=None):
+                 status_cb=None, source_cache=None):
         self._lrc = local_repo_cache
         self._rrc = remote_repo_cache
+        self._source_cache = source_cache
 
         null_status_function = lambda **kwargs: None
         self.status = status_cb or null_status_function
 
     def get_morphology(self, reponame, sha1, filename):
-        morph_name = os.path.splitext(os.path.basename(filename))[0]
+        if self._source_cache is not None:
+            morph = self._source_cache.get_morphology(reponame, sha1, filename)
+            if morph is not None:
+                return morph
+        morph = self._load_morphology(reponame, sha1, filename)
+        if self._source_cache is not None:
+            self._source_cache.put_morphology(reponame, sha1, filename, morph)
+        return morph
+
+    def _list_files(self, reponame, sha1, list_files):
+        if self._source_cache is not None:
+            file_list = self._source_cache.get_file_list(reponame, sha1)
+            if file_list is not None:
+                return file_list
+        file_list = list_files()
+        if self._source_cache is not None:
+            self._source_cache.put_file_list(reponame, sha1, file_list)
+        return file_list
+
+    def _load_morphology(self, reponame, sha1, filename):
         loader = morphlib.morphloader.MorphologyLoader()
         if self._lrc.has_repo(reponame):
             self.status(msg="Looking for %s in local repo cache" % filename,
@@ -61,7 +82,9 @@ class MorphologyFactory(object):
                 morph = loader.load_from_string(text)
             except IOError:
                 morph = None
-                file_list = repo.list_files(ref=sha1, recurse=False)
+                file_list = self._list_files(
+                    reponame, sha1,
+                    lambda: repo.list_files(ref=sha1, recurse=False))
         elif self._rrc is not None:
             self.status(msg="Retrieving %(reponame)s %(sha1)s %(filename)s"
                         " from the remote git cache.",
@@ -72,19 +95,94 @@ class MorphologyFactory(object):
                 morph = loader.load_from_string(text)
             except morphlib.remoterepocache.CatFileError:
                 morph = None
-                file_list = self._rrc.ls_tree(reponame, sha1)
+                file_list = self._list_files(
+                    reponame, sha1, lambda: self._rrc.ls_tree(reponame, sha1))
         else:
             raise NotcachedError(reponame)
 
         if morph is None:
-            self.status(msg="File %s doesn't exist: attempting to infer "
-                            "chunk morph from repo's build system"
-                        % filename, chatty=True)
-            bs = morphlib.buildsystem.detect_build_system(file_list)
-            if bs is None:
-                raise MorphologyNotFoundError(filename)
-            morph = bs.get_morphology(morph_name)
-            loader.validate(morph)
-            loader.set_commands(morph)
-            loader.set_defaults(morph)
+            morph = self._infer_morphology(loader, filename, file_list)
+        return morph
+
+    def get_morphologies(self, keys):
+        '''Get many morphologies at once.
+
+        ``keys`` is an iterable of (reponame, sha1, filename) triplets, as
+        passed to ``get_morphology``. Returns a dict mapping each triplet
+        to its morphology.
+
+        Morphologies in repos that are not in the local repo cache are
+        read from the remote repo cache with one request for all of the
+        files, and one more to list the trees of any that have to be
+        inferred from the repo's build system. Anything the bulk requests
+        cannot provide is loaded by ``get_morphology``.
+
+        '''
+        keys = list(collections.OrderedDict.fromkeys(keys))
+        morphs = {}
+        if self._source_cache is not None:
+            for key in keys:
+                morph = self._source_cache.get_morphology(*key)
+                if morph is not None:
+                    morphs[key] = morph
+        cached = set(morphs)
+
+        remote = []
+        if self._rrc is not None:
+            remote = [key for key in keys
+                      if key not in morphs and not self._lrc.has_repo(key[0])]
+        if remote:
+            self.status(msg="Retrieving %(count)d morphologies from the "
+                        "remote git cache.", count=len(remote), chatty=True)
+            loader = morphlib.morphloader.MorphologyLoader()
+            texts = self._rrc.cat_files(remote)
+            for key in remote:
+                if key in texts:
+                    morphs[key] = loader.load_from_string(texts[key])
+
+            trees = collections.OrderedDict.fromkeys(
+                (reponame, sha1) for reponame, sha1, filename in remote
+                if (reponame, sha1, filename) not in morphs)
+            file_lists = {}
+            if self._source_cache is not None:
+                for pair in trees:
+                    file_list = self._source_cache.get_file_list(*pair)
+                    if file_list is not None:
+                        file_lists[pair] = file_list
+            listed = self._rrc.ls_trees(
+                pair for pair in trees if pair not in file_lists)
+            if self._source_cache is not None:
+                for pair, file_list in listed.iteritems():
+                    self._source_cache.put_file_list(
+                        pair[0], pair[1], file_list)
+            file_lists.update(listed)
+            for reponame, sha1, filename in remote:
+                key = (reponame, sha1, filename)
+                if key not in morphs and (reponame, sha1) in file_lists:
+                    morphs[key] = self._infer_morphology(
+                        loader, filename, file_lists[reponame, sha1])
+
+        if self._source_cache is not None:
+            for key, morph in morphs.iteritems():
+                if key not in cached:
+                    self._source_cache.put_morphology(
+                        key[0], key[1], key[2], morph)
+
+        for key in keys:
+            if key not in morphs:
+                morphs[key] = self.get_morphology(*key)
+        return morphs
+
+    def _infer_morphology(self, loader, filename, file_list):
+        self.status(msg="File %s doesn't exist: attempting to infer "
+                        "chunk morph from repo's build system"
+                    % filename, chatty=True)
+        bs = morphlib.buildsystem.detect_build_system(file_list)
+        if bs is None:
+            raise MorphologyNotFoundError(filename)
+        morph_name = os.path.splitext(os.path.basename(filename))[0]
+        morph = bs.get_morphology(morph_name)
+        loader.validate(morph)
+        loader.set_commands(morph)
+        loader.set_defaults(morph)
         return morph
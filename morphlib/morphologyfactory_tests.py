@@ -14,6 +14,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import shutil
+import tempfile
 import unittest
 
 import morphlib
@@ -37,6 +39,18 @@ class FakeRemoteRepoCache(object):
     def ls_tree(self, reponame, sha1):
         return []
 
+    def cat_files(self, triplets):
+        contents = {}
+        for triplet in triplets:
+            try:
+                contents[triplet] = self.cat_file(*triplet)
+            except CatFileError:
+                pass
+        return contents
+
+    def ls_trees(self, pairs):
+        return dict((pair, self.ls_tree(*pair)) for pair in pairs)
+
 
 class FakeLocalRepo(object):
 
@@ -211,6 +225,52 @@ class MorphologyFactoryTests(unittest.TestCase):
                                        'assumed-remote.morph')
         self.assertEqual('assumed-remote', morph['name'])
 
+    def test_gets_many_morphs_from_remote_repo(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_file = self.noremotemorph
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        requests = []
+        cat_files = self.rrc.cat_files
+        def count_requests(triplets):
+            requests.append(triplets)
+            return cat_files(triplets)
+        self.rrc.cat_files = count_requests
+        keys = [('reponame', 'sha1', 'assumed-remote.morph'),
+                ('reponame', 'sha1', 'other-remote.morph')]
+        morphs = self.mf.get_morphologies(keys)
+        self.assertEqual(morphs[keys[0]]['name'], 'assumed-remote')
+        self.assertEqual(morphs[keys[1]]['name'], 'other-remote')
+        self.assertEqual(requests, [keys])
+
+    def test_gets_many_morphs_one_by_one_if_bulk_requests_fail(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_files = lambda triplets: {}
+        self.rrc.ls_trees = lambda pairs: {}
+        key = ('reponame', 'sha1', 'remote-chunk.morph')
+        morphs = self.mf.get_morphologies([key])
+        self.assertEqual(morphs[key]['name'], 'remote-chunk')
+
+    def test_gets_many_morphs_from_local_repo(self):
+        key = ('reponame', 'sha1', 'chunk.morph')
+        morphs = self.mf.get_morphologies([key, key])
+        self.assertEqual(morphs.keys(), [key])
+        self.assertEqual(morphs[key]['name'], 'chunk')
+
+    def test_reuses_morphs_from_source_cache(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            source_cache = morphlib.sourcecache.SourceCache(tempdir)
+            mf = MorphologyFactory(self.lrc, self.rrc,
+                                   source_cache=source_cache)
+            key = ('reponame', 'sha1', 'chunk.morph')
+            mf.get_morphology(*key)
+            self.lr.read_file = self.nolocalfile
+            self.assertEqual(mf.get_morphology(*key)['name'], 'chunk')
+            self.assertEqual(mf.get_morphologies([key])[key]['name'],
+                             'chunk')
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_raises_error_when_no_local_morph(self):
         self.lr.read_file = self.nolocalfile
         self.assertRaises(MorphologyNotFoundError, self.mf.get_morphology,
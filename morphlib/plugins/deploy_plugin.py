@@ -19,7 +19,6 @@ import logging
 import os
 import shutil
 import sys
-import tarfile
 import tempfile
 import uuid
 
@@ -555,8 +554,8 @@ class DeployPlugin(cliapp.Plugin):
                                           ' not yet built.\nPlease ensure'
                                           ' the system is built before'
                                           ' deployment.')
-            tf = tarfile.open(fileobj=f)
-            tf.extractall(path=system_tree)
+            with morphlib.bins.open_binary(f) as tf:
+                tf.extractall(path=system_tree)
 
             self.app.status(
                 msg='System unpacked at %(system_tree)s',
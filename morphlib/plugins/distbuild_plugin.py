@@ -73,7 +73,6 @@ class SerialiseArtifactPlugin(cliapp.Plugin):
             repo_name, ref, filename, original_ref=original_ref)
         artifact = build_command.resolve_artifacts(srcpool)
         self.app.output.write(distbuild.serialise_artifact(artifact))
-        self.app.output.write('\n')
 
 
 class WorkerBuild(cliapp.Plugin):
@@ -95,7 +94,7 @@ class WorkerBuild(cliapp.Plugin):
         
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
 
-        serialized = sys.stdin.readline()
+        serialized = sys.stdin.read()
         artifact = distbuild.deserialise_artifact(serialized)
         
         bc = morphlib.buildcommand.BuildCommand(self.app)
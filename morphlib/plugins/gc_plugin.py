@@ -66,6 +66,9 @@ class GCPlugin(cliapp.Plugin):
            won't be e.g. if morph gets a SIGKILL or the machine running
            morph loses power.
 
+           Cached refs and morphologies that have not been used for
+           --cachedir-artifact-delete-older-than are removed too.
+
         '''
 
         tempdir = self.app.settings['tempdir']
@@ -76,6 +79,7 @@ class GCPlugin(cliapp.Plugin):
                 cachedir, self.app.settings['cachedir-min-space'])
 
         self.cleanup_tempdir(tempdir, tempdir_min_space)
+        self.cleanup_source_cache(cachedir)
         self.cleanup_cachedir(cachedir, cachedir_min_space)
         
     def cleanup_tempdir(self, temp_path, min_space):
@@ -83,7 +87,7 @@ class GCPlugin(cliapp.Plugin):
         # assumes that they exist in various places.
         self.app.status(msg='Cleaning up temp dir %(temp_path)s',
                         temp_path=temp_path, chatty=True)
-        for subdir in ('deployments', 'failed', 'chunks'):
+        for subdir in ('deployments', 'failed', 'ldconfig', 'chunks'):
             if morphlib.util.get_bytes_free_in_path(temp_path) >= min_space:
                 self.app.status(msg='Not Removing subdirectory '
                                     '%(subdir)s, enough space already cleared',
@@ -93,10 +97,32 @@ class GCPlugin(cliapp.Plugin):
             self.app.status(msg='Removing temp subdirectory: %(subdir)s',
                             subdir=subdir)
             path = os.path.join(temp_path, subdir)
+            if subdir == 'chunks' and os.path.exists(path):
+                # Other builds may be using some of the unpacked chunks.
+                chunk_cache = morphlib.unpackedchunkcache.UnpackedChunkCache(
+                    path)
+                chunk_cache.clear()
+                continue
             if os.path.exists(path):
                 shutil.rmtree(path)
             os.mkdir(path)
 
+    def cleanup_source_cache(self, cache_path):
+        path = os.path.join(cache_path, 'sources')
+        if not os.path.exists(path):
+            return
+        source_cache = morphlib.sourcecache.SourceCache(path)
+        removed = source_cache.prune(
+            self.app.settings['cachedir-artifact-delete-older-than'])
+        self.app.status(msg='Removed %(removed)d unused source cache entries',
+                        removed=removed, chatty=True)
+
+    def prune_blobs(self, lac):
+        self.app.status(msg='Removing unused blobs', chatty=True)
+        removed = lac.prune_blobs()
+        self.app.status(msg='Removed %(removed)d unused blobs',
+                        removed=removed, chatty=True)
+
     def calculate_delete_range(self):
         now = time.time()
         always_delete_age =  \
@@ -126,8 +152,13 @@ class GCPlugin(cliapp.Plugin):
                                 'sufficient space already cleared',
                             chatty=True)
             return
-        lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(os.path.join(cache_path, 'artifacts')))
+        artifacts = fs.osfs.OSFS(os.path.join(cache_path, 'artifacts'))
+        dedup = self.app.settings['artifact-cache-backend'] == 'dedup'
+        if dedup:
+            lac = morphlib.dedupartifactcache.DedupLocalArtifactCache(
+                artifacts, os.path.join(cache_path, 'blobs'))
+        else:
+            lac = morphlib.localartifactcache.LocalArtifactCache(artifacts)
         max_age, min_age = self.calculate_delete_range()
         logging.debug('Must remove artifacts older than timestamp %d'
                       % max_age)
@@ -144,6 +175,8 @@ class GCPlugin(cliapp.Plugin):
                             cachekey=cachekey, chatty=True)
             lac.remove(cachekey)
             removed += 1
+        if dedup:
+            self.prune_blobs(lac)
 
         # Maybe remove remaining middle-aged artifacts
         for cachekey in may_delete:
@@ -157,6 +190,9 @@ class GCPlugin(cliapp.Plugin):
                             cachekey=cachekey, chatty=True)
             lac.remove(cachekey)
             removed += 1
+            if dedup:
+                # Removing a source frees nothing until its blobs are gone.
+                self.prune_blobs(lac)
 
         if sufficient_free():
             self.app.status(msg='Made sufficient space in %(cache_path)s '
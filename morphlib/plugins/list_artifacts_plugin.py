@@ -59,6 +59,7 @@ class ListArtifactsPlugin(cliapp.Plugin):
                                args[2:])
 
         self.lrc, self.rrc = morphlib.util.new_repo_caches(self.app)
+        self.source_cache = morphlib.util.new_source_cache(self.app)
         self.resolver = morphlib.artifactresolver.ArtifactResolver()
 
         artifact_files = set()
@@ -87,7 +88,8 @@ class ListArtifactsPlugin(cliapp.Plugin):
         source_pool = morphlib.sourceresolver.create_source_pool(
             self.lrc, self.rrc, repo, ref, system_filename,
             update_repos = not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            source_cache=self.source_cache)
 
         self.app.status(
             msg='Resolving artifacts for %s' % system_filename, chatty=True)
@@ -106,7 +108,8 @@ class ListArtifactsPlugin(cliapp.Plugin):
             msg='Computing cache keys for %s' % system_filename, chatty=True)
         build_env = morphlib.buildenvironment.BuildEnvironment(
             self.app.settings, system_artifact.source.morphology['arch'])
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(
+            build_env, self.app.settings['artifact-compression'])
 
         for source in set(a.source for a in system_artifact.walk()):
             source.cache_key = ckc.compute_key(source)
@@ -15,7 +15,10 @@
 
 
 import cliapp
+import httplib
+import json
 import logging
+import socket
 import urllib
 import urllib2
 import urlparse
@@ -54,6 +57,14 @@ class GetSourceMetadataError(GetError):
                   (name, source, cache_key, cache))
 
 
+class HasManyError(cliapp.AppException):
+
+    def __init__(self, cache, count):
+        cliapp.AppException.__init__(
+            self, 'Failed to query the artifact cache %s '
+                  'for the state of %d artifacts' % (cache, count))
+
+
 class RemoteArtifactCache(object):
 
     def __init__(self, server_url):
@@ -62,6 +73,24 @@ class RemoteArtifactCache(object):
     def has(self, artifact):
         return self._has_file(artifact.basename())
 
+    def has_many(self, artifacts, log=logging.error):
+        '''Find out which of ``artifacts`` are in the cache.
+
+        This asks the cache server about every artifact in a single
+        request. Return a dict mapping each artifact to True or False.
+
+        '''
+
+        artifacts = list(artifacts)
+        if not artifacts:
+            return {}
+        try:
+            state = self._has_files([a.basename() for a in artifacts])
+        except (urllib2.URLError, ValueError), e:
+            log(str(e))
+            raise HasManyError(self, len(artifacts))
+        return dict((a, bool(state.get(a.basename()))) for a in artifacts)
+
     def has_artifact_metadata(self, artifact, name):
         return self._has_file(artifact.metadata_basename(name))
 
@@ -100,6 +129,14 @@ class RemoteArtifactCache(object):
         except (urllib2.HTTPError, urllib2.URLError):
             return False
 
+    def _has_files(self, filenames):  # pragma: no cover
+        url = urlparse.urljoin(self.server_url, '/1.0/artifacts')
+        logging.debug('RemoteArtifactCache._has_files: url=%s, %d files' %
+                      (url, len(filenames)))
+        request = urllib2.Request(url, data=json.dumps(filenames),
+                                  headers={'Content-type': 'application/json'})
+        return json.load(urllib2.urlopen(request))
+
     def _get_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._get_file: url=%s' % url)
@@ -113,5 +150,85 @@ class RemoteArtifactCache(object):
             server_url, '/1.0/artifacts?filename=%s' % 
             urllib.quote(filename))
 
+    def connection(self):
+        '''Return a persistent connection to this cache.
+
+        See ``RemoteArtifactCacheConnection``.
+
+        '''
+        return RemoteArtifactCacheConnection(self.server_url)
+
     def __str__(self):  # pragma: no cover
         return self.server_url
+
+
+class RemoteArtifactCacheConnection(RemoteArtifactCache):
+
+    '''A remote artifact cache accessed over one persistent connection.
+
+    Every request is sent over the same HTTP/1.1 connection, which saves
+    setting up a new TCP connection for each file when fetching many
+    artifacts. The connection is re-established if the server closes it.
+
+    A connection must only be used by one thread at a time, and each
+    file returned by ``get`` must be read completely before the next
+    request is made.
+
+    Failing to get a file is expected when looking for artifacts that
+    may not have been built yet, so it is only logged at debug level.
+
+    '''
+
+    def __init__(self, server_url):
+        RemoteArtifactCache.__init__(self, server_url)
+        self._conn = None
+
+    def get(self, artifact, log=logging.debug):
+        return RemoteArtifactCache.get(self, artifact, log=log)
+
+    def get_artifact_metadata(self, artifact, name, log=logging.debug):
+        return RemoteArtifactCache.get_artifact_metadata(
+            self, artifact, name, log=log)
+
+    def close(self):  # pragma: no cover
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _has_file(self, filename):  # pragma: no cover
+        try:
+            response = self._request('HEAD', filename)
+        except urllib2.URLError:
+            return False
+        response.read()
+        return True
+
+    def _get_file(self, filename):  # pragma: no cover
+        return self._request('GET', filename)
+
+    def _request(self, method, filename):  # pragma: no cover
+        url = self._request_url(filename)
+        logging.debug('RemoteArtifactCacheConnection: %s %s' % (method, url))
+        parsed = urlparse.urlparse(url)
+        path = '%s?%s' % (parsed.path, parsed.query)
+
+        # A kept-alive connection may have been closed by the server since
+        # it was last used, so retry once on a fresh connection.
+        for attempt in (1, 2):
+            if self._conn is None:
+                self._conn = httplib.HTTPConnection(parsed.hostname,
+                                                    parsed.port)
+            try:
+                self._conn.request(method, path)
+                response = self._conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                if attempt == 2:
+                    raise urllib2.URLError(e)
+
+        if response.status != httplib.OK:
+            response.read()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        return response
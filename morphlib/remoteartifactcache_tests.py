@@ -162,3 +162,38 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         returned_url = self.cache._request_url('gtk+')
         correct_url = '%s/1.0/artifacts?filename=gtk%%2B' % self.server_url
         self.assertEqual(returned_url, correct_url)
+
+    def test_connection_uses_same_server(self):
+        conn = self.cache.connection()
+        self.assertEqual(conn.server_url, self.server_url)
+
+    def test_connection_fails_to_get_a_non_existent_artifact(self):
+        conn = self.cache.connection()
+        conn._get_file = self._get_file
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          conn.get, self.doc_artifact)
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetArtifactMetadataError,
+            conn.get_artifact_metadata, self.runtime_artifact,
+            'non-existent-meta')
+
+    def _has_files(self, filenames):
+        return dict((f, f in self.existing_files) for f in filenames)
+
+    def test_has_many_reports_each_artifact(self):
+        self.cache._has_files = self._has_files
+        state = self.cache.has_many([self.runtime_artifact,
+                                     self.doc_artifact])
+        self.assertEqual(state, {self.runtime_artifact: True,
+                                 self.doc_artifact: False})
+
+    def test_has_many_of_nothing_makes_no_request(self):
+        self.assertEqual(self.cache.has_many([]), {})
+
+    def test_has_many_fails_when_the_request_fails(self):
+        def fail(filenames):
+            raise urllib2.URLError('foo')
+        self.cache._has_files = fail
+        self.assertRaises(morphlib.remoteartifactcache.HasManyError,
+                          self.cache.has_many, [self.runtime_artifact],
+                          log=lambda *args: None)
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import cliapp
 import json
 import logging
@@ -59,6 +60,34 @@ class RemoteRepoCache(object):
             logging.error('Caught exception: %s' % str(e))
             raise ResolveRefError(repo_name, ref)
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (repo_name, ref) pairs with a single request.
+
+        Returns a dict mapping each pair that the server could resolve
+        to a (commit sha1, tree sha1) pair. Pairs the server failed to
+        resolve are left out, so the caller can fall back to resolving
+        them some other way.
+
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        repo_urls = [(self._resolver.pull_url(repo_name), ref)
+                     for repo_name, ref in pairs]
+        try:
+            results = self._resolve_refs_for_repo_urls(repo_urls)
+        except BaseException, e:
+            logging.warning('Caught (and ignored) exception: %s' % str(e))
+            return {}
+        resolved = {}
+        for pair, result in zip(pairs, results):
+            if 'error' in result:
+                logging.debug('Failed to resolve ref %s for repo %s: %s' %
+                              (pair[1], pair[0], result['error']))
+                continue
+            resolved[pair] = result['sha1'], result['tree']
+        return resolved
+
     def cat_file(self, repo_name, ref, filename):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -69,6 +98,34 @@ class RemoteRepoCache(object):
                 raise CatFileError(repo_name, ref, filename)
             raise # pragma: no cover
 
+    def cat_files(self, triplets):
+        '''Read many (repo_name, ref, filename) triplets in one request.
+
+        Returns a dict mapping each triplet that the server could read to
+        the contents of the file. Like ``resolve_refs``, files that could
+        not be read are left out.
+
+        '''
+        triplets = list(triplets)
+        if not triplets:
+            return {}
+        requests = [(self._resolver.pull_url(repo_name), ref, filename)
+                    for repo_name, ref, filename in triplets]
+        try:
+            results = self._cat_files_for_repo_urls(requests)
+        except BaseException, e:
+            logging.warning('Caught (and ignored) exception: %s' % str(e))
+            return {}
+        contents = {}
+        for triplet, result in zip(triplets, results):
+            if 'error' in result:
+                logging.debug('Failed to cat file %s in ref %s of repo %s: '
+                              '%s' % (triplet[2], triplet[1], triplet[0],
+                                      result['error']))
+                continue
+            contents[triplet] = base64.b64decode(result['data'])
+        return contents
+
     def ls_tree(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -78,18 +135,63 @@ class RemoteRepoCache(object):
             logging.error('Caught exception: %s' % str(e))
             raise LsTreeError(repo_name, ref)
 
+    def ls_trees(self, pairs):
+        '''List the trees of many (repo_name, ref) pairs in one request.
+
+        Returns a dict mapping each pair that the server could list to the
+        names in the top level of its tree. Pairs that could not be listed
+        are left out.
+
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        repo_urls = [(self._resolver.pull_url(repo_name), ref)
+                     for repo_name, ref in pairs]
+        try:
+            results = self._ls_trees_for_repo_urls(repo_urls)
+        except BaseException, e:
+            logging.warning('Caught (and ignored) exception: %s' % str(e))
+            return {}
+        file_lists = {}
+        for pair, result in zip(pairs, results):
+            if 'error' in result:
+                logging.debug('Failed to list tree in ref %s of repo %s: %s' %
+                              (pair[1], pair[0], result['error']))
+                continue
+            file_lists[pair] = result['tree'].keys()
+        return file_lists
+
     def _resolve_ref_for_repo_url(self, repo_url, ref):  # pragma: no cover
         data = self._make_request(
             'sha1s?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
         info = json.loads(data)
         return info['sha1'], info['tree']
 
+    def _resolve_refs_for_repo_urls(self, repo_urls):  # pragma: no cover
+        data = self._make_post_request(
+            'sha1s', [{'repo': repo_url, 'ref': ref}
+                      for repo_url, ref in repo_urls])
+        return json.loads(data)
+
     def _cat_file_for_repo_url(self, repo_url, ref,
                                filename):  # pragma: no cover
         return self._make_request(
             'files?repo=%s&ref=%s&filename=%s'
             % self._quote_strings(repo_url, ref, filename))
 
+    def _cat_files_for_repo_urls(self, requests):  # pragma: no cover
+        data = self._make_post_request(
+            'files', [{'repo': repo_url, 'ref': ref, 'filename': filename}
+                      for repo_url, ref, filename in requests])
+        return json.loads(data)
+
+    def _ls_trees_for_repo_urls(self, repo_urls):  # pragma: no cover
+        data = self._make_post_request(
+            'trees', [{'repo': repo_url, 'ref': ref}
+                      for repo_url, ref in repo_urls])
+        return json.loads(data)
+
     def _ls_tree_for_repo_url(self, repo_url, ref):  # pragma: no cover
         return self._make_request(
             'trees?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
@@ -104,3 +206,13 @@ class RemoteRepoCache(object):
         url = urlparse.urljoin(server_url, '/1.0/%s' % path)
         handle = urllib2.urlopen(url)
         return handle.read()
+
+    def _make_post_request(self, path, body):  # pragma: no cover
+        server_url = self.server_url
+        if not server_url.endswith('/'):
+            server_url += '/'
+        url = urlparse.urljoin(server_url, '/1.0/%s' % path)
+        request = urllib2.Request(url, json.dumps(body),
+                                  {'Content-Type': 'application/json'})
+        handle = urllib2.urlopen(request)
+        return handle.read()
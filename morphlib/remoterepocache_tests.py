@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import json
 import unittest
 import urllib2
@@ -26,6 +27,18 @@ class RemoteRepoCacheTests(unittest.TestCase):
     def _resolve_ref_for_repo_url(self, repo_url, ref):
         return self.sha1s[repo_url][ref]
 
+    def _resolve_refs_for_repo_urls(self, repo_urls):
+        results = []
+        for repo_url, ref in repo_urls:
+            try:
+                sha1 = self.sha1s[repo_url][ref]
+                results.append({'repo': repo_url, 'ref': ref,
+                                'sha1': sha1, 'tree': 'tree-' + sha1})
+            except KeyError:
+                results.append({'repo': repo_url, 'ref': ref,
+                                'error': 'not found'})
+        return results
+
     def _cat_file_for_repo_url(self, repo_url, sha1, filename):
         try:
             return self.files[repo_url][sha1][filename]
@@ -33,6 +46,25 @@ class RemoteRepoCacheTests(unittest.TestCase):
             raise urllib2.HTTPError(url='', code=404, msg='Not found',
                                     hdrs={}, fp=None)
 
+    def _cat_files_for_repo_urls(self, requests):
+        results = []
+        for repo_url, sha1, filename in requests:
+            try:
+                data = base64.b64encode(self.files[repo_url][sha1][filename])
+                results.append({'data': data})
+            except KeyError:
+                results.append({'error': 'not found'})
+        return results
+
+    def _ls_trees_for_repo_urls(self, repo_urls):
+        results = []
+        for repo_url, sha1 in repo_urls:
+            try:
+                results.append({'tree': self.files[repo_url][sha1]})
+            except KeyError:
+                results.append({'error': 'not found'})
+        return results
+
     def _ls_tree_for_repo_url(self, repo_url, sha1):
         return json.dumps({
             'repo': repo_url,
@@ -62,7 +94,11 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.cache = morphlib.remoterepocache.RemoteRepoCache(
             self.server_url, resolver)
         self.cache._resolve_ref_for_repo_url = self._resolve_ref_for_repo_url
+        self.cache._resolve_refs_for_repo_urls = \
+            self._resolve_refs_for_repo_urls
         self.cache._cat_file_for_repo_url = self._cat_file_for_repo_url
+        self.cache._cat_files_for_repo_urls = self._cat_files_for_repo_urls
+        self.cache._ls_trees_for_repo_urls = self._ls_trees_for_repo_urls
         self.cache._ls_tree_for_repo_url = self._ls_tree_for_repo_url
 
     def test_sets_server_url(self):
@@ -89,6 +125,23 @@ class RemoteRepoCacheTests(unittest.TestCase):
                           self.cache.resolve_ref, 'non-existent-repo',
                           'non-existent-ref')
 
+    def test_resolve_many_refs_at_once(self):
+        sha1 = self.sha1s['git://gitorious.org/baserock/morph']['master']
+        resolved = self.cache.resolve_refs(
+            [('baserock:morph', 'master'),
+             ('baserock:morph', 'non-existent-ref'),
+             ('non-existent-repo', 'master')])
+        self.assertEqual(resolved,
+                         {('baserock:morph', 'master'):
+                          (sha1, 'tree-' + sha1)})
+
+    def test_resolving_many_refs_ignores_server_errors(self):
+        def fail(repo_urls):
+            raise urllib2.URLError('connection refused')
+        self.cache._resolve_refs_for_repo_urls = fail
+        self.assertEqual(
+            self.cache.resolve_refs([('baserock:morph', 'master')]), {})
+
     def test_cat_existing_file_in_existing_repo_and_ref(self):
         content = self.cache.cat_file(
             'upstream:linux', 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9',
@@ -118,6 +171,23 @@ class RemoteRepoCacheTests(unittest.TestCase):
                           'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9',
                           'some-file')
 
+    def test_cat_many_files_at_once(self):
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        contents = self.cache.cat_files(
+            [('upstream:linux', sha1, 'linux.morph'),
+             ('upstream:linux', sha1, 'non-existent-file'),
+             ('non-existent-repo', sha1, 'linux.morph')])
+        self.assertEqual(contents,
+                         {('upstream:linux', sha1, 'linux.morph'):
+                          'linux morphology'})
+
+    def test_ls_many_trees_at_once(self):
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        file_lists = self.cache.ls_trees(
+            [('upstream:linux', sha1), ('upstream:linux', 'blablabla')])
+        self.assertEqual(file_lists,
+                         {('upstream:linux', sha1): ['linux.morph']})
+
     def test_ls_tree_in_existing_repo_and_ref(self):
         content = self.cache.ls_tree(
             'upstream:linux', 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9')
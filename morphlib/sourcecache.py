@@ -0,0 +1,150 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cPickle
+import errno
+import hashlib
+import logging
+import os
+import time
+
+import morphlib
+
+
+# Bump this when the format of the entries changes.
+_FORMAT_VERSION = 1
+
+
+class SourceCache(object):
+
+    '''A persistent cache of what was learnt about sources by earlier runs.
+
+    Resolving refs and loading morphologies needs a git command or a
+    request to the remote repo cache for every source, so the results
+    are kept in the cache directory for the next run of Morph. There are
+    three kinds of entry:
+
+    * ``morphologies`` -- loaded and validated morphologies, keyed by
+      (repo, commit sha1, filename)
+    * ``trees`` -- the files at the top of the tree of a commit, keyed by
+      (repo, commit sha1)
+    * ``refs`` -- the commit and tree sha1 a ref resolves to, keyed by
+      (repo, ref)
+
+    Morphologies and trees of a commit never change, so they are kept
+    until they have not been used for a while (see ``prune``). Refs that
+    are sha1s never change either, but named refs do, so those are only
+    used for ``ref_ttl`` seconds after they were resolved. With the
+    default ``ref_ttl`` of 0 they are not cached at all.
+
+    Every entry is also keyed by the version of Morph that made it, since
+    loading a morphology fills in defaults that can change between
+    versions.
+
+    '''
+
+    def __init__(self, dirname, ref_ttl=0):
+        self.dirname = dirname
+        self.ref_ttl = ref_ttl
+
+    def _path(self, kind, *key):
+        h = hashlib.sha1(repr((_FORMAT_VERSION, morphlib.__version__) + key))
+        digest = h.hexdigest()
+        return os.path.join(self.dirname, kind, digest[:2], digest[2:])
+
+    def _get(self, kind, key, max_age=None):
+        path = self._path(kind, *key)
+        try:
+            if max_age is not None:
+                if os.stat(path).st_mtime < time.time() - max_age:
+                    return None
+            else:
+                # Record that the entry is still in use, for prune.
+                os.utime(path, None)
+            with open(path, 'rb') as f:
+                entry_key, value = cPickle.load(f)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                logging.warning('Ignoring unreadable %s' % path)
+            return None
+        except Exception:
+            logging.warning('Ignoring corrupt %s' % path)
+            return None
+        if entry_key != key: # pragma: no cover
+            return None
+        return value
+
+    def _put(self, kind, key, value):
+        path = self._path(kind, *key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, e: # pragma: no cover
+                if e.errno != errno.EEXIST:
+                    raise
+        with morphlib.savefile.SaveFile(path, 'wb') as f:
+            cPickle.dump((key, value), f, cPickle.HIGHEST_PROTOCOL)
+
+    def get_morphology(self, reponame, sha1, filename):
+        '''Return a cached morphology, or None.'''
+        return self._get('morphologies', (reponame, sha1, filename))
+
+    def put_morphology(self, reponame, sha1, filename, morphology):
+        self._put('morphologies', (reponame, sha1, filename), morphology)
+
+    def get_file_list(self, reponame, sha1):
+        '''Return the cached files at the top of a commit's tree, or None.'''
+        return self._get('trees', (reponame, sha1))
+
+    def put_file_list(self, reponame, sha1, file_list):
+        self._put('trees', (reponame, sha1), list(file_list))
+
+    def _ref_max_age(self, ref):
+        if morphlib.git.is_valid_sha1(ref):
+            return None
+        return self.ref_ttl
+
+    def get_ref(self, reponame, ref):
+        '''Return the cached (commit sha1, tree sha1) for a ref, or None.'''
+        if self._ref_max_age(ref) == 0:
+            return None
+        return self._get('refs', (reponame, ref), self._ref_max_age(ref))
+
+    def put_ref(self, reponame, ref, commit_sha1, tree_sha1):
+        if self._ref_max_age(ref) == 0:
+            return
+        self._put('refs', (reponame, ref), (commit_sha1, tree_sha1))
+
+    def prune(self, max_age):
+        '''Remove entries that have not been used for max_age seconds.
+
+        Return the number of entries that were removed.
+
+        '''
+
+        removed = 0
+        limit = time.time() - max_age
+        for dirname, subdirs, basenames in os.walk(self.dirname):
+            for basename in basenames:
+                path = os.path.join(dirname, basename)
+                try:
+                    if os.stat(path).st_mtime < limit:
+                        os.remove(path)
+                        removed += 1
+                except OSError: # pragma: no cover
+                    pass
+        return removed
@@ -0,0 +1,90 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import morphlib
+
+
+class SourceCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = morphlib.sourcecache.SourceCache(self.tempdir)
+        self.sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def age_entries(self, seconds):
+        then = time.time() - seconds
+        for dirname, subdirs, basenames in os.walk(self.tempdir):
+            for basename in basenames:
+                os.utime(os.path.join(dirname, basename), (then, then))
+
+    def test_keeps_morphologies(self):
+        morph = morphlib.morphology.Morphology({'name': 'foo'})
+        morph.filename = 'foo.morph'
+        self.cache.put_morphology('repo', self.sha1, 'foo.morph', morph)
+        cached = self.cache.get_morphology('repo', self.sha1, 'foo.morph')
+        self.assertEqual(cached, morph)
+        self.assertEqual(cached.filename, 'foo.morph')
+        self.assertEqual(
+            self.cache.get_morphology('repo', self.sha1, 'bar.morph'), None)
+
+    def test_keeps_file_lists(self):
+        self.cache.put_file_list('repo', self.sha1, ['configure'])
+        self.assertEqual(self.cache.get_file_list('repo', self.sha1),
+                         ['configure'])
+        self.assertEqual(self.cache.get_file_list('other', self.sha1), None)
+
+    def test_keeps_sha1_refs(self):
+        self.cache.put_ref('repo', self.sha1, self.sha1, 'tree')
+        self.age_entries(3600)
+        self.assertEqual(self.cache.get_ref('repo', self.sha1),
+                         (self.sha1, 'tree'))
+
+    def test_does_not_keep_named_refs_by_default(self):
+        self.cache.put_ref('repo', 'master', self.sha1, 'tree')
+        self.assertEqual(self.cache.get_ref('repo', 'master'), None)
+
+    def test_keeps_named_refs_for_ttl(self):
+        self.cache.ref_ttl = 60
+        self.cache.put_ref('repo', 'master', self.sha1, 'tree')
+        self.assertEqual(self.cache.get_ref('repo', 'master'),
+                         (self.sha1, 'tree'))
+        self.age_entries(120)
+        self.assertEqual(self.cache.get_ref('repo', 'master'), None)
+
+    def test_ignores_corrupt_entries(self):
+        self.cache.put_file_list('repo', self.sha1, ['configure'])
+        with open(self.cache._path('trees', 'repo', self.sha1), 'w') as f:
+            f.write('garbage')
+        self.assertEqual(self.cache.get_file_list('repo', self.sha1), None)
+
+    def test_prunes_unused_entries(self):
+        self.cache.put_file_list('repo', self.sha1, ['configure'])
+        self.cache.put_file_list('other', self.sha1, ['configure'])
+        self.age_entries(3600)
+        self.cache.get_file_list('repo', self.sha1)
+        self.assertEqual(self.cache.prune(60), 1)
+        self.assertEqual(self.cache.get_file_list('repo', self.sha1),
+                         ['configure'])
+        self.assertEqual(self.cache.get_file_list('other', self.sha1), None)
@@ -18,10 +18,15 @@ import cliapp
 
 import collections
 import logging
+import multiprocessing.pool
 
 import morphlib
 
 
+# Number of local repositories whose refs are resolved at once.
+_RESOLVER_THREADS = 8
+
+
 class SourceResolver(object):
     '''Provides a way of resolving the set of sources for a given system.
 
@@ -47,7 +52,7 @@ class SourceResolver(object):
     '''
 
     def __init__(self, local_repo_cache, remote_repo_cache, update_repos,
-                 status_cb=None):
+                 status_cb=None, source_cache=None):
         self.lrc = local_repo_cache
         self.rrc = remote_repo_cache
 
@@ -55,12 +60,25 @@ class SourceResolver(object):
 
         self.status = status_cb
 
+        self.source_cache = source_cache
+
     def resolve_ref(self, reponame, ref):
         '''Resolves commit and tree sha1s of the ref in a repo and returns it.
 
         If update is True then this has the side-effect of updating
-        or cloning the repository into the local repo cache.
+        or cloning the repository into the local repo cache, unless the
+        ref was found in the source cache.
         '''
+        if self.source_cache is not None:
+            cached = self.source_cache.get_ref(reponame, ref)
+            if cached is not None:
+                return cached
+        absref, tree = self._resolve_ref(reponame, ref)
+        if self.source_cache is not None:
+            self.source_cache.put_ref(reponame, ref, absref, tree)
+        return absref, tree
+
+    def _resolve_ref(self, reponame, ref):
         absref = None
 
         if self.lrc.has_repo(reponame):
@@ -96,12 +114,78 @@ class SourceResolver(object):
             tree = repo.resolve_ref_to_tree(absref)
         return absref, tree
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (repo, ref) pairs at once.
+
+        Returns a dict mapping each pair to its (commit sha1, tree sha1),
+        with the same side-effects as calling ``resolve_ref`` for each.
+
+        Refs in repos that are already in the local repo cache are
+        resolved by a pool of threads, one repo per thread so a repo is
+        never updated twice at the same time. The rest are first sent to
+        the remote repo cache in a single request. Any that it cannot
+        resolve are resolved one by one, since that may mean cloning the
+        repo into the local repo cache.
+
+        '''
+        resolved = {}
+        if self.source_cache is not None:
+            for repo, ref in pairs:
+                cached = self.source_cache.get_ref(repo, ref)
+                if cached is not None:
+                    resolved[repo, ref] = cached
+
+        local = collections.OrderedDict()
+        remote = []
+        for repo, ref in pairs:
+            if (repo, ref) in resolved:
+                continue
+            if self.lrc.has_repo(repo):
+                local.setdefault(repo, []).append(ref)
+            else:
+                remote.append((repo, ref))
+
+        if remote and self.rrc is not None:
+            resolved_remotely = self.rrc.resolve_refs(remote)
+            if resolved_remotely:
+                self.status(msg='Resolved %(count)d refs via remote repo '
+                            'cache', count=len(resolved_remotely),
+                            chatty=True)
+            if self.source_cache is not None:
+                for (repo, ref), (absref, tree) in \
+                        resolved_remotely.iteritems():
+                    self.source_cache.put_ref(repo, ref, absref, tree)
+            resolved.update(resolved_remotely)
+
+        def resolve_refs_in_repo(item):
+            repo, refs = item
+            return [((repo, ref), self.resolve_ref(repo, ref))
+                    for ref in refs]
+
+        if len(local) > 1:
+            pool = multiprocessing.pool.ThreadPool(
+                min(_RESOLVER_THREADS, len(local)))
+            try:
+                results = pool.map(resolve_refs_in_repo, local.iteritems())
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(resolve_refs_in_repo, local.iteritems())
+        for result in results:
+            resolved.update(result)
+
+        for repo, ref in remote:
+            if (repo, ref) not in resolved:
+                resolved[repo, ref] = self.resolve_ref(repo, ref)
+        return resolved
+
     def traverse_morphs(self, definitions_repo, definitions_ref,
                         system_filenames,
                         visit=lambda rn, rf, fn, arf, m: None,
                         definitions_original_ref=None):
         morph_factory = morphlib.morphologyfactory.MorphologyFactory(
-            self.lrc, self.rrc, self.status)
+            self.lrc, self.rrc, self.status, self.source_cache)
         definitions_queue = collections.deque(system_filenames)
         chunk_in_definitions_repo_queue = []
         chunk_in_source_repo_queue = []
@@ -122,7 +206,12 @@ class SourceResolver(object):
 
             key = (definitions_repo, definitions_absref, filename)
             if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
+                # Load everything that is queued at the same time, so the
+                # remote repo cache is asked for them in one request.
+                keys = [(definitions_repo, definitions_absref, f)
+                        for f in [filename] + list(definitions_queue)]
+                resolved_morphologies.update(morph_factory.get_morphologies(
+                    k for k in keys if k not in resolved_morphologies))
             morphology = resolved_morphologies[key]
 
             visit(definitions_repo, definitions_ref, filename,
@@ -149,36 +238,45 @@ class SourceResolver(object):
                     chunk_in_definitions_repo_queue.append(
                         (c['repo'], c['ref'], c['morph']))
 
+        # Resolve the refs of all the chunks in one go, rather than one at
+        # a time as each chunk is visited.
+        chunk_refs = collections.OrderedDict()
+        for repo, ref, filename in (chunk_in_definitions_repo_queue +
+                                    chunk_in_source_repo_queue):
+            chunk_refs[repo, ref] = None
+        for (repo, ref), (commit_sha1, tree_sha1) in \
+                self.resolve_refs(chunk_refs).iteritems():
+            resolved_commits[repo, ref] = commit_sha1
+            resolved_trees[repo, commit_sha1] = tree_sha1
+
+        # Likewise, load the chunk morphologies in one go.
+        chunk_keys = [(definitions_repo, definitions_absref, filename)
+                      for repo, ref, filename
+                      in chunk_in_definitions_repo_queue]
+        chunk_keys.extend((repo, resolved_commits[repo, ref], filename)
+                          for repo, ref, filename
+                          in chunk_in_source_repo_queue)
+        resolved_morphologies.update(morph_factory.get_morphologies(
+            key for key in chunk_keys if key not in resolved_morphologies))
+
         for repo, ref, filename in chunk_in_definitions_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
             absref = resolved_commits[repo, ref]
             tree = resolved_trees[repo, absref]
             key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
             visit(repo, ref, filename, absref, tree, morphology)
 
         for repo, ref, filename in chunk_in_source_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
             absref = resolved_commits[repo, ref]
             tree = resolved_trees[repo, absref]
             key = (repo, absref, filename)
-            if key not in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
             visit(repo, ref, filename, absref, tree, morphology)
 
 
 def create_source_pool(lrc, rrc, repo, ref, filename,
                        original_ref=None, update_repos=True,
-                       status_cb=None):
+                       status_cb=None, source_cache=None):
     '''Find all the sources involved in building a given system.
 
     Given a system morphology, this function will traverse the tree of stratum
@@ -190,7 +288,8 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
     implementation, and so they must be handled separately.
 
     The 'lrc' and 'rrc' parameters specify the local and remote Git repository
-    caches used for resolving the sources.
+    caches used for resolving the sources. If 'source_cache' is given, it is
+    a SourceCache that keeps what was resolved for the next run of Morph.
 
     '''
     pool = morphlib.sourcepool.SourcePool()
@@ -202,7 +301,8 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
         for source in sources:
             pool.add(source)
 
-    resolver = SourceResolver(lrc, rrc, update_repos, status_cb)
+    resolver = SourceResolver(lrc, rrc, update_repos, status_cb,
+                              source_cache)
     resolver.traverse_morphs(repo, ref, [filename],
                              visit=add_to_pool,
                              definitions_original_ref=original_ref)
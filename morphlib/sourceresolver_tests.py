@@ -0,0 +1,127 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import morphlib
+
+
+class FakeCachedRepo(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def requires_update_for_ref(self, ref):
+        return False
+
+    def resolve_ref_to_commit(self, ref):
+        return '%s-%s-commit' % (self.name, ref)
+
+    def resolve_ref_to_tree(self, ref):
+        return ref.replace('-commit', '-tree')
+
+
+class FakeLocalRepoCache(object):
+
+    def __init__(self, repos):
+        self.repos = dict((name, FakeCachedRepo(name)) for name in repos)
+        self.resolved_in = {}
+        self.lock = threading.Lock()
+
+    def has_repo(self, name):
+        return name in self.repos
+
+    def get_repo(self, name):
+        with self.lock:
+            self.resolved_in.setdefault(name, set()).add(
+                threading.current_thread())
+        return self.repos[name]
+
+    def cache_repo(self, name):
+        raise AssertionError('unexpected clone of %s' % name)
+
+
+class FakeRemoteRepoCache(object):
+
+    def __init__(self, sha1s):
+        self.sha1s = sha1s
+        self.requests = []
+
+    def resolve_refs(self, pairs):
+        self.requests.append(list(pairs))
+        return dict((pair, self.sha1s[pair]) for pair in pairs
+                    if pair in self.sha1s)
+
+    def resolve_ref(self, repo, ref):
+        raise morphlib.remoterepocache.ResolveRefError(repo, ref)
+
+
+class SourceResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lrc = FakeLocalRepoCache(['a', 'b', 'c'])
+        self.rrc = FakeRemoteRepoCache({('remote', 'master'): ('1', '2')})
+        self.resolver = morphlib.sourceresolver.SourceResolver(
+            self.lrc, self.rrc, False, lambda **kwargs: None)
+
+    def test_resolves_local_refs(self):
+        resolved = self.resolver.resolve_refs(
+            [('a', 'master'), ('b', 'master'), ('b', 'other')])
+        self.assertEqual(resolved, {
+            ('a', 'master'): ('a-master-commit', 'a-master-tree'),
+            ('b', 'master'): ('b-master-commit', 'b-master-tree'),
+            ('b', 'other'): ('b-other-commit', 'b-other-tree'),
+        })
+        self.assertEqual(self.rrc.requests, [])
+
+    def test_resolves_each_local_repo_in_one_thread(self):
+        self.resolver.resolve_refs(
+            [(repo, 'ref%d' % i) for i in xrange(10) for repo in 'abc'])
+        for threads in self.lrc.resolved_in.itervalues():
+            self.assertEqual(len(threads), 1)
+
+    def test_resolves_remote_refs_in_one_request(self):
+        resolved = self.resolver.resolve_refs(
+            [('a', 'master'), ('remote', 'master')])
+        self.assertEqual(resolved[('remote', 'master')], ('1', '2'))
+        self.assertEqual(self.rrc.requests, [[('remote', 'master')]])
+
+    def test_falls_back_to_local_repo_cache(self):
+        self.lrc.cache_repo = lambda name: FakeCachedRepo(name)
+        self.lrc.get_repo = lambda name: FakeCachedRepo(name)
+        resolved = self.resolver.resolve_refs([('missing', 'master')])
+        self.assertEqual(
+            resolved,
+            {('missing', 'master'):
+             ('missing-master-commit', 'missing-master-tree')})
+
+    def test_reuses_sha1_refs_from_source_cache(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.resolver.source_cache = morphlib.sourcecache.SourceCache(
+                tempdir)
+            sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+            first = self.resolver.resolve_refs([('a', sha1)])
+            self.lrc.repos = {}
+            self.assertEqual(self.resolver.resolve_refs([('a', sha1)]),
+                             first)
+            self.assertEqual(self.resolver.resolve_ref('a', sha1),
+                             first[('a', sha1)])
+        finally:
+            shutil.rmtree(tempdir)
@@ -46,6 +46,8 @@ class FakeApplication(object):
         self.settings = {
             'cachedir': cachedir,
             'tempdir': tempdir,
+            'chunk-cache-max-size': 0,
+            'staging-area-backend': 'hardlink',
         }
         for leaf in ('chunks',):
             d = os.path.join(tempdir, leaf)
@@ -129,6 +131,20 @@ class StagingAreaTests(unittest.TestCase):
             self.sa.install_artifact(f)
         self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
 
+    def test_links_deduplicated_chunks_directly(self):
+        linked = []
+
+        class FakeDedupHandle(object):
+            name = 'chunk'
+            def can_link_into(self, dirname):
+                return True
+            def link_into(self, dirname):
+                linked.append(dirname)
+
+        self.sa.install_artifact(FakeDedupHandle())
+        self.assertEqual(linked, [self.staging])
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, 'chunks')), [])
+
     def test_removes_everything(self):
         chunk_tar = self.create_chunk()
         with open(chunk_tar, 'rb') as f:
@@ -141,3 +157,101 @@ class StagingAreaTests(unittest.TestCase):
             object(), self.staging, self.build_env, use_chroot=False)
         filename = os.path.join(self.staging, 'foobar')
         self.assertEqual(sa.relative(filename), filename)
+
+
+
+class OverlayStagingAreaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cachedir')
+        os.mkdir(self.cachedir)
+        self.staging = os.path.join(self.tempdir, 'staging')
+        self.app = FakeApplication(self.cachedir, self.tempdir)
+        self.app.settings['staging-area-backend'] = 'overlayfs'
+        self.sa = morphlib.stagingarea.StagingArea(
+            self.app, self.staging, FakeBuildEnvironment())
+        self.sa._overlayfs_supported = lambda: True
+        self.sa._mount_overlay = self.fake_mount_overlay
+        self.sa._unmount_overlay = self.fake_unmount_overlay
+        self.mounted = []
+        self.mount_fails = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def fake_mount_overlay(self, mount_point, options):
+        if self.mount_fails:
+            raise cliapp.AppException('mount failed')
+        self.mounted.append((mount_point, options))
+
+    def fake_unmount_overlay(self, mount_point):
+        self.mounted = [m for m in self.mounted if m[0] != mount_point]
+
+    def install_chunk(self, name, filename):
+        chunkdir = os.path.join(self.tempdir, name)
+        os.mkdir(chunkdir)
+        with open(os.path.join(chunkdir, filename), 'w'):
+            pass
+        chunk_tar = os.path.join(self.tempdir, name + '.chunk')
+        tf = tarfile.TarFile(name=chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifact(f)
+
+    def chunk_path(self, name):
+        return os.path.join(self.tempdir, 'chunks', name + '.chunk.d')
+
+    def test_mounts_chunks_as_layers_with_last_on_top(self):
+        self.install_chunk('a', 'a.txt')
+        self.install_chunk('b', 'b.txt')
+        self.assertEqual(os.listdir(self.staging), [])
+        self.sa.finish_installing()
+        self.assertEqual(
+            self.mounted,
+            [(self.staging, 'lowerdir=%s:%s,upperdir=%s.upper,'
+              'workdir=%s.work' % (self.chunk_path('b'),
+                                   self.chunk_path('a'),
+                                   self.staging, self.staging))])
+
+    def test_finish_installing_is_idempotent(self):
+        self.install_chunk('a', 'a.txt')
+        self.sa.finish_installing()
+        self.sa.finish_installing()
+        self.assertEqual(len(self.mounted), 1)
+
+    def test_keeps_chunks_in_use_until_removed(self):
+        self.install_chunk('a', 'a.txt')
+        self.sa.finish_installing()
+        cache = self.sa._get_chunk_cache()
+        self.assertEqual(cache.clear(), 0)
+        self.sa.remove()
+        self.assertEqual(self.mounted, [])
+        self.assertFalse(os.path.exists(self.staging))
+        self.assertFalse(os.path.exists(self.staging + '.upper'))
+        self.assertEqual(cache.clear(), 1)
+
+    def test_groups_layers_when_options_are_too_long(self):
+        self.sa._max_overlay_option = len(self.chunk_path('a')) * 2 + 1
+        for name in 'abcde':
+            self.install_chunk(name, name + '.txt')
+        self.sa.finish_installing()
+        self.assertEqual(
+            self.mounted[:2],
+            [(self.staging + '.lower0', 'lowerdir=%s:%s' %
+              (self.chunk_path('e'), self.chunk_path('d'))),
+             (self.staging + '.lower1', 'lowerdir=%s:%s' %
+              (self.chunk_path('c'), self.chunk_path('b')))])
+        self.sa.remove()
+        self.assertEqual(self.mounted, [])
+        self.assertFalse(os.path.exists(self.staging + '.lower0'))
+
+    def test_falls_back_to_hardlinks_if_mount_fails(self):
+        self.mount_fails = True
+        self.install_chunk('a', 'a.txt')
+        self.install_chunk('b', 'b.txt')
+        self.sa.finish_installing()
+        self.assertEqual(sorted(os.listdir(self.staging)),
+                         ['a.txt', 'b.txt'])
+        self.assertFalse(os.path.exists(self.staging + '.upper'))
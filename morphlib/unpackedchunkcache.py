@@ -0,0 +1,276 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+
+import morphlib
+
+
+class UnpackedChunkCache(object):
+
+    '''A store of unpacked chunk artifacts, shared between builds.
+
+    Staging areas are built by hardlinking files from unpacked chunks,
+    so each chunk only needs unpacking once for all the builds on a host.
+    Chunks are stored by artifact basename, which contains the cache key,
+    so an unpacked chunk never changes once it has been published.
+
+    For a chunk called NAME the store has these entries:
+
+    * ``NAME.d`` -- the unpacked chunk
+    * ``NAME.size`` -- the size of the chunk artifact, used as an
+      estimate of the size of the unpacked chunk
+    * ``NAME.lock`` -- a lock file, held shared by every build using or
+      unpacking the chunk, and exclusively when removing it; it is
+      removed along with the chunk
+    * ``NAME.d.tmpXXXXXX`` -- a chunk being unpacked
+
+    Chunks are unpacked into a temporary directory which is renamed into
+    place, so other builds never see a partially unpacked chunk. When
+    two builds unpack the same chunk at once, the first to finish wins
+    and the other build uses its result.
+
+    If ``max_size`` is not zero, the least recently used chunks that are
+    not in use are removed whenever a new chunk makes the store larger
+    than ``max_size`` bytes.
+
+    '''
+
+    def __init__(self, dirname, max_size=0, status_cb=None):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.status = status_cb or (lambda **kwargs: None)
+        self._held = {}
+
+    def _path(self, name, suffix):
+        return os.path.join(self.dirname, name + suffix)
+
+    def _lock(self, name, operation):
+        '''Open the lock file of a chunk and lock it.
+
+        The lock file is removed along with the chunk, so a lock taken
+        on a file that was removed meanwhile protects nothing, and is
+        taken again on the file that replaced it.
+
+        '''
+
+        path = self._path(name, '.lock')
+        while True:
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f.fileno(), operation)
+                try:
+                    current = os.stat(path)
+                except OSError, e: # pragma: no cover
+                    if e.errno != errno.ENOENT:
+                        raise
+                else:
+                    if os.path.samestat(os.fstat(f.fileno()), current):
+                        return f
+            except BaseException:
+                f.close()
+                raise
+            f.close() # pragma: no cover
+
+    @contextlib.contextmanager
+    def unpacked(self, handle):
+        '''Use the unpacked contents of a chunk artifact.
+
+        ``handle`` is an open file handle to the chunk artifact, as
+        returned by ``LocalArtifactCache.get``. This is a context manager
+        that gives the path to the unpacked chunk, which is unpacked first
+        if necessary. The chunk will not be removed from the store while
+        the context is active.
+
+        '''
+
+        unpacked = self.acquire(handle)
+        try:
+            yield unpacked
+        finally:
+            self.release(unpacked)
+
+    def acquire(self, handle):
+        '''Start using the unpacked contents of a chunk artifact.
+
+        This is like ``unpacked``, for when the chunk needs to stay in
+        use for longer than one block of code. The chunk will not be
+        removed from the store until ``release`` is called with the path
+        that is returned.
+
+        '''
+
+        name = os.path.basename(handle.name)
+        unpacked = self._path(name, '.d')
+        lock = self._lock(name, fcntl.LOCK_SH)
+        try:
+            if os.path.exists(unpacked):
+                os.utime(unpacked, None)
+            else:
+                self._unpack(handle, name)
+        except BaseException: # pragma: no cover
+            lock.close()
+            raise
+        self._held.setdefault(unpacked, []).append(lock)
+        return unpacked
+
+    def release(self, unpacked):
+        '''Stop using a chunk returned by ``acquire``.'''
+
+        lock = self._held[unpacked].pop()
+        if not self._held[unpacked]:
+            del self._held[unpacked]
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+
+        if self.max_size:
+            self.evict(self.max_size)
+
+    def _unpack(self, handle, name):
+        self.status(msg='Unpacking chunk from cache %(filename)s',
+                    filename=name)
+        savedir = tempfile.mkdtemp(dir=self.dirname, prefix=name + '.d.tmp')
+        try:
+            if hasattr(handle, 'link_into'):
+                # A chunk from a DedupLocalArtifactCache.
+                handle.link_into(savedir)
+                size = handle.size
+            else:
+                morphlib.bins.unpack_binary_from_file(handle, savedir + '/')
+                size = os.fstat(handle.fileno()).st_size
+            with morphlib.savefile.SaveFile(self._path(name, '.size'),
+                                            'w') as f:
+                f.write('%d\n' % size)
+        except BaseException: # pragma: no cover
+            shutil.rmtree(savedir)
+            raise
+
+        try:
+            os.rename(savedir, self._path(name, '.d'))
+        except OSError, e:
+            # Another build unpacked the same chunk and published it
+            # first. Both are identical, so use theirs.
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise # pragma: no cover
+            shutil.rmtree(savedir)
+
+    def _entry_size(self, name):
+        try:
+            with open(self._path(name, '.size')) as f:
+                return int(f.read())
+        except (IOError, ValueError): # pragma: no cover
+            return 0
+
+    def list_contents(self):
+        '''Return ``(name, size, last_used)`` for every unpacked chunk.'''
+
+        contents = []
+        for basename in os.listdir(self.dirname):
+            if not basename.endswith('.d'):
+                continue
+            name = basename[:-len('.d')]
+            try:
+                mtime = os.stat(self._path(name, '.d')).st_mtime
+            except OSError: # pragma: no cover
+                continue
+            contents.append((name, self._entry_size(name), mtime))
+        return contents
+
+    def size(self):
+        '''Return the estimated total size of the unpacked chunks.'''
+        return sum(size for name, size, mtime in self.list_contents())
+
+    def _try_remove(self, name):
+        '''Remove an unpacked chunk, unless another build is using it.'''
+
+        try:
+            f = self._lock(name, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise # pragma: no cover
+        with f:
+            try:
+                unpacked = self._path(name, '.d')
+                if os.path.exists(unpacked):
+                    # Unpublish the chunk atomically before removing it.
+                    doomed = tempfile.mkdtemp(dir=self.dirname,
+                                              prefix=name + '.d.tmp')
+                    os.rename(unpacked, os.path.join(doomed, 'old'))
+                    shutil.rmtree(doomed)
+                if os.path.exists(self._path(name, '.size')):
+                    os.remove(self._path(name, '.size'))
+                for basename in os.listdir(self.dirname):
+                    if basename.startswith(name + '.d.tmp'):
+                        # Left behind by a build that was killed while
+                        # unpacking this chunk.
+                        shutil.rmtree(os.path.join(self.dirname, basename))
+                # Remove the lock file while it is still locked, so that
+                # builds waiting for it know to lock its replacement.
+                os.remove(self._path(name, '.lock'))
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return True
+
+    def evict(self, max_size):
+        '''Remove least recently used chunks until at most max_size is used.
+
+        Chunks in use by a build are kept. Return the number of chunks
+        that were removed.
+
+        '''
+
+        contents = sorted(self.list_contents(), key=lambda x: x[2])
+        total = sum(size for name, size, mtime in contents)
+        removed = 0
+        for name, size, mtime in contents:
+            if total <= max_size:
+                break
+            if self._try_remove(name):
+                logging.debug('Removed unpacked chunk %s' % name)
+                total -= size
+                removed += 1
+        return removed
+
+    def clear(self):
+        '''Remove every unpacked chunk that is not in use.
+
+        Return the number of chunks that were removed.
+
+        '''
+
+        # Chunks unpacked by older versions of Morph have no lock file,
+        # so look for every kind of entry.
+        names = set()
+        for basename in os.listdir(self.dirname):
+            for suffix in ('.d', '.size', '.lock'):
+                if basename.endswith(suffix):
+                    names.add(basename[:-len(suffix)])
+            if '.d.tmp' in basename:
+                names.add(basename[:basename.rindex('.d.tmp')])
+
+        removed = 0
+        for name in sorted(names):
+            published = os.path.exists(self._path(name, '.d'))
+            if self._try_remove(name) and published:
+                removed += 1
+        return removed
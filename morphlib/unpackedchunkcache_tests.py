@@ -0,0 +1,158 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+
+
+class UnpackedChunkCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'chunks')
+        os.mkdir(self.cachedir)
+        self.cache = morphlib.unpackedchunkcache.UnpackedChunkCache(
+            self.cachedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_chunk(self, name, size=10):
+        chunkdir = os.path.join(self.tempdir, name + '-contents')
+        os.mkdir(chunkdir)
+        with open(os.path.join(chunkdir, 'file.txt'), 'w') as f:
+            f.write('x' * size)
+        chunk_tar = os.path.join(self.tempdir, name)
+        tf = tarfile.TarFile(name=chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        return chunk_tar
+
+    def use(self, chunk_tar):
+        with open(chunk_tar) as f:
+            with self.cache.unpacked(f) as dirname:
+                return dirname
+
+    def test_unpacks_chunk(self):
+        chunk_tar = self.create_chunk('a')
+        with open(chunk_tar) as f:
+            with self.cache.unpacked(f) as dirname:
+                self.assertEqual(os.listdir(dirname), ['file.txt'])
+        self.assertEqual(dirname, os.path.join(self.cachedir, 'a.d'))
+
+    def test_reuses_unpacked_chunk(self):
+        chunk_tar = self.create_chunk('a')
+        dirname = self.use(chunk_tar)
+        marker = os.path.join(dirname, 'marker')
+        open(marker, 'w').close()
+        self.use(chunk_tar)
+        self.assertTrue(os.path.exists(marker))
+
+    def test_uses_chunk_published_by_another_build(self):
+        chunk_tar = self.create_chunk('a')
+        unpack = self.cache._unpack
+        def unpack_twice(handle, name):
+            unpack(handle, name)
+            handle.seek(0)
+            unpack(handle, name)
+        self.cache._unpack = unpack_twice
+        dirname = self.use(chunk_tar)
+        self.assertEqual(os.listdir(dirname), ['file.txt'])
+        self.assertEqual(len(self.cache.list_contents()), 1)
+
+    def test_records_size(self):
+        chunk_tar = self.create_chunk('a')
+        self.use(chunk_tar)
+        self.assertEqual(self.cache.size(), os.path.getsize(chunk_tar))
+
+    def test_evicts_least_recently_used_chunks(self):
+        a = self.create_chunk('a')
+        b = self.create_chunk('b')
+        self.use(a)
+        self.use(b)
+        os.utime(os.path.join(self.cachedir, 'a.d'), (0, 0))
+        removed = self.cache.evict(os.path.getsize(b))
+        self.assertEqual(removed, 1)
+        self.assertEqual([name for name, size, mtime
+                          in self.cache.list_contents()], ['b'])
+
+    def test_keeps_chunks_in_use(self):
+        a = self.create_chunk('a')
+        with open(a) as f:
+            with self.cache.unpacked(f) as dirname:
+                self.assertEqual(self.cache.clear(), 0)
+                self.assertTrue(os.path.exists(dirname))
+        self.assertEqual(self.cache.clear(), 1)
+        self.assertFalse(os.path.exists(dirname))
+
+    def test_enforces_maximum_size(self):
+        a = self.create_chunk('a')
+        b = self.create_chunk('b')
+        self.cache.max_size = os.path.getsize(a)
+        self.use(a)
+        os.utime(os.path.join(self.cachedir, 'a.d'), (0, 0))
+        self.use(b)
+        self.assertEqual([name for name, size, mtime
+                          in self.cache.list_contents()], ['b'])
+
+    def test_clear_removes_abandoned_unpacking(self):
+        a = self.create_chunk('a')
+        self.use(a)
+        abandoned = tempfile.mkdtemp(dir=self.cachedir, prefix='a.d.tmp')
+        self.cache.clear()
+        self.assertFalse(os.path.exists(abandoned))
+
+    def test_keeps_acquired_chunks_until_released(self):
+        a = self.create_chunk('a')
+        with open(a) as f:
+            dirname = self.cache.acquire(f)
+        self.assertEqual(self.cache.clear(), 0)
+        self.cache.release(dirname)
+        self.assertEqual(self.cache.clear(), 1)
+
+    def test_clear_removes_chunks_without_lock_file(self):
+        unpacked = os.path.join(self.cachedir, 'a.d')
+        os.mkdir(unpacked)
+        with open(os.path.join(unpacked, 'file.txt'), 'w') as f:
+            f.write('x')
+        with open(os.path.join(self.cachedir, 'a.size'), 'w') as f:
+            f.write('1\n')
+        self.assertEqual(self.cache.clear(), 1)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_removes_lock_files_with_chunks(self):
+        a = self.create_chunk('a')
+        self.use(a)
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, 'a.lock')))
+        self.assertEqual(self.cache.clear(), 1)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_uses_chunk_again_after_removing_it(self):
+        a = self.create_chunk('a')
+        with open(a) as f:
+            dirname = self.cache.acquire(f)
+            self.cache.release(dirname)
+            self.assertEqual(self.cache.clear(), 1)
+            f.seek(0)
+            dirname = self.cache.acquire(f)
+        self.assertEqual(self.cache.clear(), 0)
+        self.assertTrue(os.path.exists(dirname))
+        self.cache.release(dirname)
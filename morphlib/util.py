@@ -132,8 +132,13 @@ def new_artifact_caches(settings):  # pragma: no cover
     if not os.path.exists(artifact_cachedir):
         os.mkdir(artifact_cachedir)
 
-    lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(artifact_cachedir))
+    if settings['artifact-cache-backend'] == 'dedup':
+        lac = morphlib.dedupartifactcache.DedupLocalArtifactCache(
+                fs.osfs.OSFS(artifact_cachedir),
+                os.path.join(cachedir, 'blobs'))
+    else:
+        lac = morphlib.localartifactcache.LocalArtifactCache(
+                fs.osfs.OSFS(artifact_cachedir))
 
     rac_url = get_artifact_cache_server(settings)
     rac = None
@@ -220,6 +225,14 @@ def new_repo_caches(app):  # pragma: no cover
 
     return lrc, rrc
 
+def new_source_cache(app):  # pragma: no cover
+    '''Create a new object for the persistent cache of sources.'''
+
+    cachedir = create_cachedir(app.settings)
+    return morphlib.sourcecache.SourceCache(
+        os.path.join(cachedir, 'sources'),
+        ref_ttl=app.settings['ref-cache-ttl'])
+
 def env_variable_is_password(key):  # pragma: no cover
     return 'PASSWORD' in key
 